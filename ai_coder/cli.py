@@ -5,6 +5,7 @@ Provides a Gemini-like conversational coding experience
 """
 
 import os
+import re
 import sys
 import json
 import asyncio
@@ -19,24 +20,39 @@ sys.path.append(os.path.dirname(__file__))
 from tools.ollama import OllamaClient
 from tools.files import FileTools  
 from tools.shell import ShellTool
+from utils.config import load_config
 from utils.logger import HistoryLogger
+from utils.interrupt import run_cancellable
+from utils.context import ContextBuilder, ContextFileCache, CHARS_PER_TOKEN, estimate_tokens, evict_turns, message_tokens
+from utils.fsx import resolve_path_safe
+
+# Share of the prompt budget given to context files in a conversation; earlier turns get the rest.
+CONTEXT_SHARE = 0.5
+# Evicted questions listed in the note that stands in for them.
+EARLIER_QUESTIONS = 10
+THINK_RE = re.compile(r'<think>.*?</think>\s*', re.S)
 
 class AiCoderCLI:
     def __init__(self, workspace_dir: str = None):
         self.workspace_dir = workspace_dir or os.getcwd()
-        self.history_dir = os.path.join(self.workspace_dir, '.codeas-history')
-        self.backup_dir = os.path.join(self.workspace_dir, '.codeas_backups')
+        self.config = load_config(self.workspace_dir)
+        self.history_dir = os.path.join(self.workspace_dir, self.config['workspace']['history_dir'])
+        self.backup_dir = os.path.join(self.workspace_dir, self.config['workspace']['backup_directory'])
         
         # Initialize components
-        self.logger = HistoryLogger(self.history_dir)
-        self.ollama = OllamaClient(logger=self.logger)
-        self.files = FileTools(root=self.workspace_dir, backup_dir='.codeas_backups', logger=self.logger)
-        self.shell = ShellTool(logger=self.logger)
+        self.logger = HistoryLogger.from_config(self.history_dir, self.config)
+        self.ollama = OllamaClient.from_config(self.config, logger=self.logger,
+                                               cache_dir=os.path.join(self.history_dir, 'llm-cache'))
+        self.files = FileTools.from_config(self.workspace_dir, self.config, logger=self.logger)
+        self.shell = ShellTool.from_config(self.workspace_dir, self.config, logger=self.logger)
+        self.context_cache = ContextFileCache.from_config(self.workspace_dir, self.config)
         
         # Session state
         self.session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.context_files: List[str] = []
         self.conversation_history: List[Dict] = []
+        self.messages: List[Dict] = []  # turns sent back to the model, oldest first
+        self.earlier_questions: List[str] = []
         
         # Setup readline for command history
         self._setup_readline()
@@ -95,50 +111,52 @@ class AiCoderCLI:
             'frameworks': set()
         }
         
-        # Get file list
+        # Get file list from the workspace index (recursive, honors ignore_patterns)
         try:
-            result = await self.files.list_dir({'dir': '.'})
-            context['files'] = result
+            result = await self.files.index_files({'dir': '.', 'type': 'file'})
+            context['files'] = result['entries']
             
             # Analyze file types and structure
-            for item in result:
-                if item['type'] == 'file':
-                    ext = Path(item['name']).suffix.lower()
-                    if ext in ['.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs']:
-                        context['languages'].add(ext[1:])
-                    
-                    # Detect frameworks
-                    if item['name'] in ['package.json', 'requirements.txt', 'Cargo.toml', 'go.mod']:
-                        context['frameworks'].add(item['name'])
+            for item in result['entries']:
+                name = Path(item['path']).name
+                ext = Path(name).suffix.lower()
+                if ext in ['.py', '.js', '.ts', '.java', '.cpp', '.c', '.go', '.rs']:
+                    context['languages'].add(ext[1:])
+                
+                # Detect frameworks
+                if name in ['package.json', 'requirements.txt', 'Cargo.toml', 'go.mod']:
+                    context['frameworks'].add(name)
                         
         except Exception as e:
             print(f"❌ Error scanning workspace: {e}")
         
         return context
     
-    async def read_project_files(self, extensions: List[str] = None) -> Dict[str, str]:
-        """Read important project files for context"""
+    async def read_project_files(self, extensions: List[str] = None, recursive: bool = False,
+                                 max_chars: int = None) -> Dict[str, Dict]:
+        """Read important project files for context (only the first max_chars of each, if given).
+
+        Returns {path: {'data', 'truncated'}}; truncated is set when max_chars cut the file short.
+        """
         if extensions is None:
             extensions = ['.py', '.js', '.ts', '.md', '.txt', '.json', '.yaml', '.yml']
         
         files_content = {}
         
         try:
-            # Get all files in workspace
-            result = await self.files.list_dir({'dir': '.'})
+            # Get files in workspace from the index
+            result = await self.files.index_files({'dir': '.', 'type': 'file', 'recursive': recursive})
+            
+            paths = [item['path'] for item in result['entries']
+                     if Path(item['path']).suffix.lower() in extensions and not Path(item['path']).name.startswith('.')]
+            batch = await self.files.read_many({'paths': paths, 'max_chars': max_chars})
             
-            for item in result:
-                if item['type'] == 'file':
-                    file_path = item['name']
-                    ext = Path(file_path).suffix.lower()
-                    
-                    if ext in extensions and not file_path.startswith('.'):
-                        try:
-                            content_result = await self.files.read_file({'path': file_path})
-                            files_content[file_path] = content_result['data']
-                        except Exception as e:
-                            print(f"⚠️  Could not read {file_path}: {e}")
-                            
+            for item in batch['files']:
+                if 'error' in item:
+                    print(f"⚠️  Could not read {item['path']}: {item['error']}")
+                else:
+                    files_content[item['path']] = {'data': item['data'], 'truncated': item.get('truncated', False)}
+                        
         except Exception as e:
             print(f"❌ Error reading project files: {e}")
         
@@ -148,17 +166,17 @@ class AiCoderCLI:
         """Analyze the entire codebase"""
         print("🔍 Analyzing codebase...")
         
-        # Read project files
-        files_content = await self.read_project_files()
+        # Read a preview of each project file
+        files_content = await self.read_project_files(max_chars=500)
         
         if not files_content:
             print("❌ No files found to analyze")
             return
         
         # Create analysis prompt
-        files_info = "\n".join([f"=== {path} ===\n{content[:500]}..." 
-                               if len(content) > 500 else f"=== {path} ===\n{content}"
-                               for path, content in files_content.items()])
+        files_info = "\n".join([f"=== {path} ===\n{item['data']}..." 
+                               if item['truncated'] else f"=== {path} ===\n{item['data']}"
+                               for path, item in files_content.items()])
         
         prompt = f"""Analyze this codebase and provide a comprehensive overview:
 
@@ -176,22 +194,13 @@ Please provide:
         await self._ask_ai(prompt, system_prompt="You are an expert code analyst. Provide detailed, actionable insights about codebases.")
     
     async def _ask_ai(self, user_prompt: str, system_prompt: str = None, include_context: bool = True):
-        """Ask AI with proper context and streaming response"""
+        """Ask AI with proper context and streaming response.
         
-        # Build context if requested
-        context_info = ""
-        if include_context and self.context_files:
-            context_info = "\n=== WORKSPACE CONTEXT ===\n"
-            for file_path in self.context_files[:5]:  # Limit to 5 files
-                try:
-                    result = await self.files.read_file({'path': file_path})
-                    content = result['data']
-                    context_info += f"\n--- {file_path} ---\n{content[:1000]}\n"
-                except Exception as e:
-                    context_info += f"\n--- {file_path} (Error: {e}) ---\n"
-        
-        # Prepare the full prompt
-        full_prompt = f"{context_info}\n=== USER QUERY ===\n{user_prompt}"
+        Without a custom system prompt the question continues the conversation:
+        messages are [system + context files] + earlier turns + the new query, so
+        consecutive turns share a prefix Ollama can reuse from its prompt cache.
+        """
+        converse = system_prompt is None
         
         # Default system prompt
         if not system_prompt:
@@ -205,11 +214,59 @@ Please provide:
 
 Always provide practical, actionable advice with code examples when relevant."""
         
+        # Files named in the query are pointed out in the query itself; the context block
+        # stays the same from turn to turn, so Ollama can reuse its prompt cache.
+        query = {'role': 'user', 'content': user_prompt}
+        mentioned = [p for p in self.context_files if p in user_prompt or os.path.basename(p) in user_prompt]
+        if mentioned and include_context:
+            query['content'] += "\n\n(Look closely at " + ', '.join(mentioned) + " in the workspace context.)"
+        
+        # Pack context files into the model window. In a conversation they get half the
+        # budget, leaving the rest for earlier turns and the query; a one-off question
+        # keeps its own tokens out of the budget instead. Either way the budget is fixed
+        # for a conversation.
+        context = ContextBuilder.from_config(self.config, share=CONTEXT_SHARE if converse else 1.0,
+                                             reserve=0 if converse else message_tokens(query))
+        context.add('system', system_prompt, required=True)
+        if include_context and self.context_files:
+            header = "\n\n=== WORKSPACE CONTEXT ===\n"
+            context.add('workspace', '', header=header, required=True)
+            # Every file gets a fixed share in the order added, so one file changing
+            # (or a new query) never moves the cut in the files around it.
+            share = max(0, context.budget - estimate_tokens(system_prompt) - estimate_tokens(header)) \
+                // len(self.context_files)
+            # Unchanged files come from the cache for the cost of a stat
+            items = await asyncio.to_thread(self.context_cache.read_many, list(self.context_files),
+                                            share * CHARS_PER_TOKEN)
+            for item in items:
+                path = item['path']
+                if 'error' in item:
+                    context.add(path, '', header=f"\n--- {path} (Error: {item['error']}) ---\n", max_tokens=share)
+                else:
+                    context.add(path, item['data'], header=f"\n--- {path} ---\n", max_tokens=share,
+                                truncated=item['truncated'], tokens=item['tokens'])
+        prefix, report = context.build()
+        files_report = [s for s in report['sections'] if not s['required']]
+        if files_report:
+            print(f"📎 Context: {report['used']}/{report['budget']} tokens · " + ', '.join(
+                f"{s['name']} " + ('omitted' if s['omitted'] else f"{s['tokens']}" + (' (cut)' if s['truncated'] else ''))
+                for s in files_report))
+        
+        messages = [{'role': 'system', 'content': prefix}]
+        if converse:
+            budget = context.max_context_length - context.max_tokens - report['used'] - message_tokens(query)
+            self.messages, dropped = evict_turns(self.messages, budget - self._earlier_tokens())
+            self.earlier_questions += [m['content'] for m in dropped if m['role'] == 'user']
+            if self.earlier_questions:
+                messages.append({'role': 'system', 'content': self._earlier_note()})
+            messages += self.messages
+        messages.append(query)
+        
         # Prepare request
         request_data = {
-            'prompt': full_prompt,
-            'system': system_prompt,
-            'model': 'deepseek-r1:8b'
+            'messages': messages,
+            'model': 'deepseek-r1:8b',
+            'options': context.options
         }
         
         print("\n🤖 AI Response:")
@@ -224,6 +281,13 @@ Always provide practical, actionable advice with code examples when relevant."""
             
             result = await self.ollama.chat(request_data, progress_cb=progress_handler)
             print("\n" + "-" * 50)
+            if result.get('tokens_per_sec'):
+                print(f"⚡ {result.get('eval_count', 0)} tokens at {result['tokens_per_sec']} tokens/sec")
+            
+            # Append the finished turn; the reasoning block is not worth resending
+            if converse:
+                reply = THINK_RE.sub('', result.get('content', ''))
+                self.messages += [query, {'role': 'assistant', 'content': reply}]
             
             # Save to conversation history
             self.conversation_history.append({
@@ -236,6 +300,16 @@ Always provide practical, actionable advice with code examples when relevant."""
         except Exception as e:
             print(f"\n❌ Error getting AI response: {e}")
     
+    def _earlier_note(self) -> str:
+        """Stand-in for evicted turns: the most recent questions they asked"""
+        recent = self.earlier_questions[-EARLIER_QUESTIONS:]
+        lines = [q if len(q) <= 120 else q[:117] + '...' for q in (' '.join(q.split()) for q in recent)]
+        return "Earlier in this conversation (no longer shown) the user asked:\n" + '\n'.join(f"- {q}" for q in lines)
+    
+    def _earlier_tokens(self) -> int:
+        # The note can only grow to EARLIER_QUESTIONS lines; budget for that up front.
+        return message_tokens({'content': "x " * 40 * EARLIER_QUESTIONS}) if self.earlier_questions else 0
+    
     def _parse_command(self, user_input: str) -> tuple[str, str]:
         """Parse user input into command and arguments"""
         parts = user_input.strip().split(' ', 1)
@@ -260,7 +334,7 @@ Always provide practical, actionable advice with code examples when relevant."""
                 if file_path not in self.context_files:
                     # Verify file exists
                     try:
-                        await self.files.read_file({'path': file_path})
+                        self._check_file(file_path)
                         self.context_files.append(file_path)
                         print(f"✅ Added {file_path} to context")
                     except Exception as e:
@@ -275,6 +349,7 @@ Always provide practical, actionable advice with code examples when relevant."""
                 file_path = parts[1]
                 if file_path in self.context_files:
                     self.context_files.remove(file_path)
+                    self.context_cache.discard(file_path)
                     print(f"✅ Removed {file_path} from context")
                 else:
                     print(f"⚠️  {file_path} not in context")
@@ -282,6 +357,8 @@ Always provide practical, actionable advice with code examples when relevant."""
                 print("❌ Usage: context remove <file_path>")
         
         elif action == 'clear':
+            for file_path in self.context_files:
+                self.context_cache.discard(file_path)
             self.context_files.clear()
             print("✅ Cleared all context files")
         
@@ -292,6 +369,11 @@ Always provide practical, actionable advice with code examples when relevant."""
         else:
             print("❌ Usage: context [add|remove|clear|auto] [file_path]")
     
+    def _check_file(self, file_path: str):
+        """Raise unless file_path is a regular file inside the workspace (one stat, no read)"""
+        if not resolve_path_safe(self.workspace_dir, file_path).is_file():
+            raise FileNotFoundError(f"No such file: {file_path}")
+    
     async def _auto_add_context(self):
         """Automatically add important files to context"""
         important_files = [
@@ -302,7 +384,7 @@ Always provide practical, actionable advice with code examples when relevant."""
         added = 0
         for file_name in important_files:
             try:
-                await self.files.read_file({'path': file_name})
+                self._check_file(file_name)
                 if file_name not in self.context_files:
                     self.context_files.append(file_name)
                     added += 1
@@ -380,6 +462,8 @@ Always provide practical, actionable advice with code examples when relevant."""
             
             if result.get('ok'):
                 print(f"\n✅ Command completed (exit code: {result.get('code', 0)})")
+            elif result.get('killed'):
+                print(f"\n⏱️  Command stopped: {result['killed']} limit reached")
             else:
                 print(f"\n❌ Command failed (exit code: {result.get('code', 1)})")
                 
@@ -415,6 +499,8 @@ ANALYSIS:
 SHELL COMMANDS:
   run <command>        - Execute shell command
 
+Press Ctrl+C while a command or AI response is running to cancel it.
+
 AI INTERACTION:
   Just type your question or request naturally!
   Examples:
@@ -471,10 +557,10 @@ The AI has access to your workspace context and can help with:
                     await self.handle_files_command(args)
                 
                 elif command == 'run':
-                    await self.handle_run_command(args)
+                    await run_cancellable(self.handle_run_command(args))
                 
                 elif command == 'analyze':
-                    await self.analyze_codebase()
+                    await run_cancellable(self.analyze_codebase())
                 
                 elif command == 'workspace':
                     context = await self.scan_workspace()
@@ -486,7 +572,7 @@ The AI has access to your workspace context and can help with:
                 
                 else:
                     # Treat as AI query
-                    await self._ask_ai(user_input)
+                    await run_cancellable(self._ask_ai(user_input))
                 
             except KeyboardInterrupt:
                 print("\n👋 Goodbye!")
@@ -503,6 +589,11 @@ The AI has access to your workspace context and can help with:
             readline.write_history_file(history_file)
         except:
             pass
+        
+        await self.ollama.aclose()
+        await self.shell.aclose()
+        self.files.close()
+        self.logger.close()
 
 def main():
     """Entry point for the CLI"""
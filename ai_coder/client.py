@@ -0,0 +1,149 @@
+# Client side of the codeas_mcp JSON-over-stdio protocol (see server.py).
+# One long-lived server process is shared by every call; requests are
+# multiplexed over its stdin/stdout and frames are routed back by "id".
+# Cancelling a call() task sends a cancel frame for its request.
+
+import sys, os, json, uuid, asyncio
+from collections import deque
+
+# Frames can carry whole files, so allow lines well beyond asyncio's 64KB default.
+STREAM_LIMIT = 64 * 1024 * 1024
+# Lines of server stderr kept to explain an unexpected exit.
+STDERR_TAIL_LINES = 40
+
+class MCPClient:
+    def __init__(self, server_path, cwd=None, env=None):
+        self.server_path = str(server_path)
+        self.cwd = cwd
+        self.env = env
+        self.proc = None
+        self._pending = {}
+        self._reader_task = None
+        self._stderr_task = None
+        self._stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        self._ready = None
+        self._start_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        async with self._start_lock:
+            if self.running:
+                return
+            env = dict(os.environ)
+            if self.env:
+                env.update(self.env)
+            self.proc = await asyncio.create_subprocess_exec(
+                sys.executable, self.server_path,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=self.cwd, env=env, limit=STREAM_LIMIT)
+            self._ready = asyncio.get_running_loop().create_future()
+            self._stderr_tail.clear()
+            self._stderr_task = asyncio.create_task(self._read_stderr(self.proc))
+            self._reader_task = asyncio.create_task(self._read_loop(self.proc))
+            await self._ready
+
+    async def _read_loop(self, proc):
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                kind = msg.get('type')
+                if kind == 'ready':
+                    if not self._ready.done():
+                        self._ready.set_result(True)
+                    continue
+                entry = self._pending.get(msg.get('id'))
+                if entry is None:
+                    continue
+                fut, progress_cb = entry
+                if kind == 'progress':
+                    if progress_cb:
+                        try:
+                            progress_cb(msg.get('payload', {}))
+                        except Exception:
+                            pass
+                elif kind == 'result':
+                    self._pending.pop(msg.get('id'), None)
+                    if not fut.done():
+                        fut.set_result(msg)
+        finally:
+            err = ConnectionError(await self._exit_message(proc))
+            if not self._ready.done():
+                self._ready.set_exception(err)
+            for fut, _ in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(err)
+            self._pending.clear()
+
+    async def _read_stderr(self, proc):
+        # Keep draining so a chatty server never blocks on a full pipe.
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                break
+            self._stderr_tail.append(line.decode('utf8', 'replace').rstrip())
+
+    async def _exit_message(self, proc):
+        try:
+            await asyncio.wait_for(asyncio.shield(self._stderr_task), 1)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        if not self._stderr_tail:
+            return 'codeas_mcp server exited'
+        return 'codeas_mcp server exited:\n' + '\n'.join(self._stderr_tail)
+
+    async def call(self, tool, input_obj, progress_cb=None):
+        """Send one request and wait for its result frame"""
+        if not self.running:
+            await self.start()
+        id_ = str(uuid.uuid4())
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[id_] = (fut, progress_cb)
+        request = json.dumps({'id': id_, 'tool': tool, 'input': input_obj}) + '\n'
+        try:
+            async with self._write_lock:
+                self.proc.stdin.write(request.encode('utf8'))
+                await self.proc.stdin.drain()
+            return await fut
+        except asyncio.CancelledError:
+            # Stop the work server-side too, not just our wait for it.
+            self._send_cancel(id_)
+            raise
+        finally:
+            self._pending.pop(id_, None)
+
+    def _send_cancel(self, id_):
+        if self.running and not self.proc.stdin.is_closing():
+            try:
+                self.proc.stdin.write((json.dumps({'type': 'cancel', 'id': id_}) + '\n').encode('utf8'))
+            except (ConnectionError, OSError):
+                pass
+
+    async def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        if proc.returncode is None:
+            try:
+                proc.stdin.close()
+                await asyncio.wait_for(proc.wait(), timeout=5)
+            except (asyncio.TimeoutError, ConnectionError, OSError):
+                proc.terminate()
+                await proc.wait()
+        if self._reader_task:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+        if self._stderr_task:
+            await asyncio.gather(self._stderr_task, return_exceptions=True)
+            self._stderr_task = None
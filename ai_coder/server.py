@@ -6,85 +6,175 @@
 #   { "id":"<id>", "type":"progress", "payload": {...} }
 # Server -> client result:
 #   { "id":"<id>", "type":"result", "payload": {...} }
+# Client -> server cancel: { "type": "cancel", "id": "<id>" } stops that call,
+# which then ends with { "id":"<id>", "type":"result", "cancelled": true }.
+# A request may opt in to token coalescing with "coalesce": true or
+# "coalesce": {"window_ms": 30, "max_bytes": 4096} in its input; consecutive
+# {"message": ...} progress payloads are then merged into one frame per window.
 
 import sys, os, json, asyncio
+from utils.config import load_config
 from utils.logger import HistoryLogger
+from utils.scheduler import ModelScheduler
+from utils.output import FrameWriter, Coalescer, Progress
 from tools.ollama import OllamaClient
 from tools.files import FileTools
 from tools.shell import ShellTool
 
-OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://127.0.0.1:11434')
-CODEAS_ROOT = os.environ.get('CODEAS_ROOT', os.getcwd())
-HISTORY_DIR = os.path.join(CODEAS_ROOT, '.codeas-history')
+# fs.search worker processes import this script again as __mp_main__; only the
+# server process itself loads the config and opens logs, clients and stdout.
+if __name__ == '__main__':
+    CODEAS_ROOT = os.environ.get('CODEAS_ROOT', os.getcwd())
+    CONFIG = load_config(CODEAS_ROOT)
+    HISTORY_DIR = os.path.join(CODEAS_ROOT, CONFIG['workspace']['history_dir'])
+    OLLAMA_URL = os.environ.get('OLLAMA_URL', CONFIG['ai']['api_url'])
+
+    logger = HistoryLogger.from_config(HISTORY_DIR, CONFIG)
+    scheduler = ModelScheduler.from_config(CONFIG)
+    ollama = OllamaClient.from_config(CONFIG, base_url=OLLAMA_URL, logger=logger,
+                                      cache_dir=os.path.join(HISTORY_DIR, 'llm-cache'),
+                                      scheduler=scheduler)
+    files = FileTools.from_config(CODEAS_ROOT, CONFIG, logger=logger)
+    shell = ShellTool.from_config(CODEAS_ROOT, CONFIG, logger=logger)
+
+    TOOLS = {
+        'ollama.chat': ollama.chat,
+        'fs.list': files.list_dir,
+        'fs.index': files.index_files,
+        'fs.search': files.search,
+        'fs.read': files.read_file,
+        'fs.head': files.head,
+        'fs.read_many': files.read_many,
+        'fs.write': files.write_file,
+        'fs.edit': files.edit_file,
+        'fs.patch': files.patch,
+        'fs.delete': files.delete_path,
+        'fs.history': files.history,
+        'fs.undo': files.undo,
+        'shell.run': shell.run_cmd,
+        'shell.start': shell.start_job,
+        'shell.status': shell.job_status,
+        'shell.tail': shell.job_tail,
+        'shell.wait': shell.job_wait,
+        'shell.session': shell.session_cmd,
+    }
+
+    # Every frame goes through this writer; see FrameWriter for the overflow policies.
+    writer = FrameWriter(max_frames=CONFIG['server']['output_queue_frames'],
+                         overflow=CONFIG['server']['output_overflow'])
 
-logger = HistoryLogger(HISTORY_DIR)
-ollama = OllamaClient(base_url=OLLAMA_URL, logger=logger)
-files = FileTools(root=CODEAS_ROOT, backup_dir='.codeas_backups', logger=logger)
-shell = ShellTool(logger=logger)
+    COALESCE_WINDOW_MS = CONFIG['server']['coalesce_window_ms']
+    COALESCE_MAX_BYTES = CONFIG['server']['coalesce_max_bytes']
 
-TOOLS = {
-    'ollama.chat': ollama.chat,
-    'fs.list': files.list_dir,
-    'fs.read': files.read_file,
-    'fs.write': files.write_file,
-    'fs.edit': files.edit_file,
-    'fs.delete': files.delete_path,
-    'shell.run': shell.run_cmd
-}
+def _coalescer(id_, opts):
+    if not opts:
+        return None
+    if not isinstance(opts, dict):
+        opts = {}
+    return Coalescer(lambda p: progress(id_, p),
+                     window_ms=opts.get('window_ms', COALESCE_WINDOW_MS),
+                     max_bytes=opts.get('max_bytes', COALESCE_MAX_BYTES))
 
 async def handle_call(msg):
     id_ = msg.get('id')
     tool = msg.get('tool')
-    inp = msg.get('input', {})
     if tool not in TOOLS:
         out = {'id': id_, 'type': 'result', 'error': f'Unknown tool: {tool}'}
-        print(json.dumps(out), flush=True)
+        await writer.send(out)
         return
+    coalescer = None
     try:
+        inp = msg.get('input', {})
+        if not isinstance(inp, dict):
+            raise ValueError('input must be a JSON object')
+        inp = dict(inp)
+        coalescer = _coalescer(id_, inp.pop('coalesce', None))
+        # Streaming tools await backpressure(progress_cb) so they pause while the client lags.
+        progress_cb = Progress(coalescer.push if coalescer else (lambda p: progress(id_, p)), writer.wait_progress)
         func = TOOLS[tool]
         # All tool functions return an awaitable (coroutine) which may call progress_cb as they run.
-        result_coro = func(inp, progress_cb=lambda p: progress(id_, p))
+        result_coro = func(inp, progress_cb=progress_cb)
         if asyncio.iscoroutine(result_coro):
             res = await result_coro
         else:
             res = result_coro
         out = {'id': id_, 'type': 'result', 'payload': res}
-        print(json.dumps(out), flush=True)
+    except asyncio.CancelledError:
+        out = {'id': id_, 'type': 'result', 'cancelled': True}
     except Exception as e:
         out = {'id': id_, 'type': 'result', 'error': str(e)}
-        print(json.dumps(out), flush=True)
+    if coalescer:
+        # The last partial buffer always goes out before the result frame.
+        coalescer.flush()
+    try:
+        await writer.send(out)
+    except (TypeError, ValueError) as e:
+        await writer.send({'id': id_, 'type': 'result', 'error': f'Unserialisable result: {e}'})
 
 def progress(id_, payload):
     msg = {'id': id_, 'type': 'progress', 'payload': payload}
-    print(json.dumps(msg), flush=True)
+    writer.offer(msg)
     try:
         logger.append('progress', {'id': id_, 'payload': payload})
     except Exception:
         pass
 
+def _call_done(tasks, id_, task):
+    tasks.pop(id_, None)
+    if task.cancelled():
+        # Cancelled before handle_call got to run, so it could not answer itself.
+        writer.offer({'id': id_, 'type': 'result', 'cancelled': True})
+
+# Requests may carry whole files (fs.write), so lines can exceed asyncio's 64KB default.
+STREAM_LIMIT = 64 * 1024 * 1024
+
 async def repl():
     loop = asyncio.get_event_loop()
-    reader = asyncio.StreamReader()
+    reader = asyncio.StreamReader(limit=STREAM_LIMIT)
     protocol = asyncio.StreamReaderProtocol(reader)
     await loop.connect_read_pipe(lambda: protocol, sys.stdin)
-    while True:
-        line = await reader.readline()
-        if not line:
-            await asyncio.sleep(0.1)
-            continue
-        try:
-            text = line.decode().strip()
-        except:
-            text = line.strip()
-        if not text:
-            continue
-        try:
-            msg = json.loads(text)
-        except Exception:
-            err = {'type': 'error', 'error': 'invalid json', 'raw': text}
-            print(json.dumps(err), flush=True)
-            continue
-        asyncio.create_task(handle_call(msg))
+    await writer.start()
+    tasks = {}
+    try:
+        while True:
+            # Stop taking new requests while the client is not reading our output.
+            await writer.wait_for_space()
+            line = await reader.readline()
+            if not line:
+                # Client closed stdin: let in-flight calls finish, then exit.
+                if tasks:
+                    await asyncio.gather(*tasks.values(), return_exceptions=True)
+                break
+            try:
+                text = line.decode().strip()
+            except:
+                text = line.strip()
+            if not text:
+                continue
+            try:
+                msg = json.loads(text)
+            except Exception:
+                err = {'type': 'error', 'error': 'invalid json', 'raw': text}
+                await writer.send(err)
+                continue
+            if not isinstance(msg, dict):
+                err = {'type': 'error', 'error': 'request must be a JSON object', 'raw': text}
+                await writer.send(err)
+                continue
+            if msg.get('type') == 'cancel':
+                task = tasks.get(msg.get('id'))
+                if task is not None:
+                    task.cancel()
+                continue
+            id_ = msg.get('id')
+            task = asyncio.create_task(handle_call(msg))
+            tasks[id_] = task
+            task.add_done_callback(lambda t, id_=id_: _call_done(tasks, id_, t))
+    finally:
+        await ollama.aclose()
+        await shell.aclose()
+        files.close()
+        await writer.close()
 
 def main():
     print(json.dumps({'type':'ready', 'message':'codeas_mcp ready'}), flush=True)
@@ -92,6 +182,8 @@ def main():
         asyncio.run(repl())
     except KeyboardInterrupt:
         print(json.dumps({'type':'exit', 'message':'shutting down'}), flush=True)
+    finally:
+        logger.close()
 
 if __name__ == '__main__':
     main()
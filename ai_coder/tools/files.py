@@ -1,64 +1,467 @@
-import os, pathlib, re
-from utils.fsx import ensure_dir, resolve_path_safe, backup_file
+import os, shutil, pathlib, fnmatch, asyncio, multiprocessing
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils.fsx import ensure_dir, resolve_path_safe, open_buffer, utf8_align, line_span, read_head, atomic_write
+from utils.index import WorkspaceIndex, content_hash
+from utils.backups import BackupStore
+from utils.config import section
+from utils.output import backpressure
+from utils.patch import PatchConflict, diff_target, apply_unified_diff, apply_line_edits, apply_replacements
+from utils.search import compile_pattern, search_files
+
+# fs.search work units; small searches stay in a thread instead of the process pool.
+SEARCH_CHUNK_BYTES = 4 * 1024 * 1024
+SEARCH_CHUNK_FILES = 256
+SEARCH_INLINE_BYTES = 1024 * 1024
 
 class FileTools:
-    def __init__(self, root='.', backup_dir='.codeas_backups', logger=None):
+    def __init__(self, root='.', backup_dir='.codeas_backups', logger=None, ignore_patterns=None, index_path=None,
+                 max_file_size=10 * 1024 * 1024, io_threads=8, backup_on_edit=True, backups=None,
+                 fsync_writes=False):
         self.root = root
         self.backup_dir = os.path.join(root, backup_dir)
-        ensure_dir(self.backup_dir)
+        self.backup_on_edit = backup_on_edit
+        self.backups = backups or BackupStore(self.backup_dir)
+        self.fsync_writes = fsync_writes
         self.logger = logger
+        self.max_file_size = max_file_size
+        self.index = WorkspaceIndex(root, ignore_patterns=ignore_patterns or (), index_path=index_path,
+                                    hash_max_bytes=max_file_size)
+        self._search_pool = None
+        self.io_threads = io_threads
+        self._io_pool = None
+        self._path_locks = {}
+
+    @classmethod
+    def from_config(cls, root, cfg, logger=None):
+        ws = section(cfg, 'workspace')
+        safety = section(cfg, 'safety')
+        backup_dir = ws['backup_directory']
+        # Our own state directories stay out of the index (and so out of fs.list and fs.search)
+        # under whatever names they are configured with.
+        ignore = list(ws['ignore_patterns'] or ()) + [pathlib.PurePath(d).as_posix()
+                                                      for d in (ws['history_dir'], backup_dir)]
+        return cls(root=root,
+                   backup_dir=backup_dir,
+                   backup_on_edit=ws['backup_on_edit'],
+                   backups=BackupStore.from_config(os.path.join(root, backup_dir), cfg),
+                   logger=logger,
+                   ignore_patterns=ignore,
+                   index_path=os.path.join(root, ws['history_dir'], 'index.json'),
+                   max_file_size=safety['max_file_size'],
+                   fsync_writes=safety['fsync_writes'],
+                   io_threads=ws['io_threads'])
+
+    def close(self):
+        if self._search_pool is not None:
+            self._search_pool.shutdown(wait=False, cancel_futures=True)
+            self._search_pool = None
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=False, cancel_futures=True)
+            self._io_pool = None
+
+    # Every blocking filesystem call runs on this pool so the event loop, and
+    # with it token streaming for other requests, never waits on disk.
+    def _io_executor(self):
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='fs-io')
+        return self._io_pool
+
+    async def _io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor(), fn, *args)
+
+    async def _io_locked(self, path, fn, *args):
+        # Calls that read, change and write back one file (write, edit, patch, undo, delete)
+        # take turns on it; other files still run in parallel on the I/O pool. The wait
+        # happens on the loop, so queued calls do not hold pool threads.
+        async with self._locked(path):
+            fut = asyncio.ensure_future(self._io(fn, *args))
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # A worker thread cannot be stopped; keep the file locked until it is done.
+                await asyncio.wait([fut])
+                raise
+
+    @asynccontextmanager
+    async def _locked(self, path):
+        if not path:
+            yield
+            return
+        key = str(resolve_path_safe(self.root, path))
+        lock, users = self._path_locks.get(key, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._path_locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._path_locks[key]
+            if users == 1:
+                del self._path_locks[key]
+            else:
+                self._path_locks[key] = (lock, users - 1)
+
+    def _loop_callback(self, progress_cb):
+        # Progress reported from a worker thread is handed to the loop thread, and the
+        # worker waits there while the output queue applies backpressure.
+        loop = asyncio.get_running_loop()
+        def report(payload):
+            loop.call_soon_threadsafe(progress_cb, payload)
+            asyncio.run_coroutine_threadsafe(backpressure(progress_cb), loop).result()
+        return report
+
+    def _search_executor(self, nbytes):
+        # Regex matching holds the GIL, so big searches fan out to processes. Workers come
+        # from a forkserver (spawn where there is none) rather than a fork of this threaded
+        # process; they re-import the entry script as __mp_main__, which must not start
+        # anything at import (see server.py), and only need utils.search preloaded.
+        if nbytes <= SEARCH_INLINE_BYTES:
+            return self._io_executor()
+        if self._search_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if ctx.get_start_method() == 'forkserver':
+                ctx.set_forkserver_preload(['utils.search'])
+            self._search_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=ctx)
+        return self._search_pool
+
+    async def index_files(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'dir': str, 'recursive': bool, 'type': 'file'|'dir', 'full': bool }
+        return await self._io(self._index_files, input_obj)
+
+    def _index_files(self, input_obj):
+        dir_ = input_obj.get('dir', '.')
+        under = self.index.rel(resolve_path_safe(self.root, dir_))
+        self.index.refresh(under, input_obj.get('full', False))
+        entries = self.index.list(under, recursive=input_obj.get('recursive', True), type_=input_obj.get('type'))
+        return {'dir': dir_, 'entries': entries, 'count': len(entries)}
+
+    async def search(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'pattern': str, 'literal': bool, 'ignore_case': bool, 'dir': str, 'glob': str,
+        #              'max_results': int }
+        pattern = input_obj.get('pattern')
+        if not pattern:
+            raise ValueError('pattern is required')
+        literal = input_obj.get('literal', False)
+        ignore_case = input_obj.get('ignore_case', False)
+        max_results = input_obj.get('max_results', 500)
+        glob = input_obj.get('glob')
+        compile_pattern(pattern, literal, ignore_case)  # fail fast on a bad regex
+        under = self.index.rel(resolve_path_safe(self.root, input_obj.get('dir', '.')))
+        candidates = await self._io(self._search_candidates, under, glob)
+        chunks, chunk, size = [], [], 0
+        for e in candidates:
+            chunk.append(e['path'])
+            size += e['size']
+            if size >= SEARCH_CHUNK_BYTES or len(chunk) >= SEARCH_CHUNK_FILES:
+                chunks.append(chunk)
+                chunk, size = [], 0
+        if chunk:
+            chunks.append(chunk)
+        loop = asyncio.get_running_loop()
+        executor = self._search_executor(sum(e['size'] for e in candidates))
+        futures = [loop.run_in_executor(executor, search_files, str(self.index.root), c, pattern, literal,
+                                        ignore_case, max_results) for c in chunks]
+        found, total, truncated = [], 0, False
+        try:
+            for fut in asyncio.as_completed(futures):
+                for hit in await fut:
+                    remaining = max_results - total
+                    if len(hit['matches']) >= remaining:
+                        hit['matches'] = hit['matches'][:remaining]
+                        truncated = True
+                    total += len(hit['matches'])
+                    found.append(hit)
+                    progress_cb(hit)
+                    await backpressure(progress_cb)
+                    if truncated:
+                        break
+                if truncated:
+                    break
+        finally:
+            # Early exit or cancellation: drop chunks that have not started yet.
+            for fut in futures:
+                fut.cancel()
+        found.sort(key=lambda h: h['path'])
+        return {'pattern': pattern, 'matches': total, 'files': len(found), 'searched': len(candidates),
+                'truncated': truncated, 'results': found}
+
+    def _search_candidates(self, under, glob):
+        self.index.refresh(under)
+        return [e for e in self.index.list(under, type_='file')
+                if e['size'] <= self.max_file_size
+                and (not glob or fnmatch.fnmatch(e['path'], glob) or fnmatch.fnmatch(e['path'].rsplit('/', 1)[-1], glob))]
 
     async def list_dir(self, input_obj, progress_cb=lambda p: None):
+        return await self._io(self._list_dir, input_obj)
+
+    def _list_dir(self, input_obj):
         dir_ = input_obj.get('dir', '.')
         absdir = resolve_path_safe(self.root, dir_)
+        under = self.index.rel(absdir)
+        if under and self.index.ignored(under):
+            # Explicitly asked for an ignored directory: list it directly.
+            return [{'name': p.name, 'type': 'dir' if p.is_dir() else 'file'} for p in pathlib.Path(absdir).iterdir()]
+        self.index.refresh(under)
+        recursive = input_obj.get('recursive', False)
         entries = []
-        for p in pathlib.Path(absdir).iterdir():
-            entries.append({'name': p.name, 'type': 'dir' if p.is_dir() else 'file'})
+        for e in self.index.list(under, recursive=recursive):
+            name = e['path'][len(under) + 1:] if under else e['path']
+            entries.append({'name': name, 'type': e['type'], 'size': e['size']})
         return entries
 
     async def read_file(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'offset': int, 'length': int, 'start_line': int, 'end_line': int,
+        #              'stream': bool, 'chunk_size': int }
+        # Byte ranges are aligned to UTF-8 boundaries; line ranges are 1-based and inclusive.
+        # No single call returns more than max_file_size bytes.
         path = input_obj.get('path')
         absf = resolve_path_safe(self.root, path)
-        data = pathlib.Path(absf).read_text(encoding='utf8')
-        return {'path': path, 'data': data}
+        stream = input_obj.get('stream', False)
+        begin, end, size, data = await self._io(self._read_range, path, absf, input_obj, not stream)
+        if stream:
+            return await self._stream_range(path, absf, begin, end, size,
+                                            int(input_obj.get('chunk_size') or 64 * 1024), progress_cb)
+        result = {'path': path, 'data': data}
+        if any(k in input_obj for k in ('offset', 'length', 'start_line', 'end_line')):
+            result.update({'offset': begin, 'length': end - begin, 'size': size, 'eof': end >= size})
+        return result
+
+    def _read_range(self, path, absf, input_obj, decode):
+        size = os.path.getsize(absf)
+        with open_buffer(absf, size) as buf:
+            if 'start_line' in input_obj or 'end_line' in input_obj:
+                begin, end = line_span(buf, max(1, int(input_obj.get('start_line') or 1)), input_obj.get('end_line'))
+            else:
+                begin = min(max(0, int(input_obj.get('offset') or 0)), size)
+                length = input_obj.get('length')
+                end = size if length is None else min(size, begin + max(0, int(length)))
+                begin, end = utf8_align(buf, begin, end)
+            if end - begin > self.max_file_size:
+                raise ValueError(f'{path}: {end - begin} bytes exceeds max_file_size ({self.max_file_size}); '
+                                 'read a smaller range with offset/length or start_line/end_line')
+            return begin, end, size, bytes(buf[begin:end]).decode('utf8') if decode else None
+
+    async def head(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'max_chars': int, 'max_bytes': int }
+        # Reads only the prefix needed for the budget (64KB if none is given).
+        max_chars = input_obj.get('max_chars')
+        max_bytes = input_obj.get('max_bytes')
+        if max_chars is None and max_bytes is None:
+            max_bytes = 64 * 1024
+        return await self._io(self._read_one, input_obj.get('path'), max_chars, max_bytes)
+
+    def _read_one(self, path, max_chars=None, max_bytes=None):
+        # Whole file when no budget is given, otherwise just the head that fits it.
+        absf = resolve_path_safe(self.root, path)
+        if max_chars is None and max_bytes is None:
+            size = os.path.getsize(absf)
+            if size > self.max_file_size:
+                raise ValueError(f'{path}: {size} bytes exceeds max_file_size ({self.max_file_size})')
+            return {'path': path, 'data': pathlib.Path(absf).read_text(encoding='utf8')}
+        max_bytes = self.max_file_size if max_bytes is None else min(int(max_bytes), self.max_file_size)
+        data, truncated = read_head(absf, None if max_chars is None else int(max_chars), max_bytes)
+        return {'path': path, 'data': data, 'truncated': truncated}
+
+    def _read_one_safe(self, index, spec):
+        if 'error' in spec:
+            return index, spec
+        try:
+            return index, self._read_one(spec['path'], spec.get('max_chars'), spec.get('max_bytes'))
+        except Exception as e:
+            return index, {'path': spec['path'], 'error': str(e)}
+
+    async def read_many(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'paths': [str | {'path': str, 'max_chars': int, 'max_bytes': int}],
+        #              'max_chars': int, 'max_bytes': int, 'stream': bool }
+        # Top-level budgets apply to paths without their own. A file that fails gets an 'error'
+        # entry instead of failing the batch. With stream, each file's result is sent as a progress
+        # frame as soon as it is read and the final result only carries the counts.
+        specs = []
+        for item in input_obj.get('paths') or []:
+            if isinstance(item, str):
+                spec = {'path': item}
+            elif isinstance(item, dict) and isinstance(item.get('path'), str):
+                spec = dict(item)
+            else:
+                path = item.get('path') if isinstance(item, dict) else item
+                specs.append({'path': path, 'error': 'Each entry needs a path string'})
+                continue
+            spec.setdefault('max_chars', input_obj.get('max_chars'))
+            spec.setdefault('max_bytes', input_obj.get('max_bytes'))
+            specs.append(spec)
+        stream = input_obj.get('stream', False)
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self._io_executor(), self._read_one_safe, i, spec)
+                   for i, spec in enumerate(specs)]
+        results = [None] * len(specs)
+        errors = 0
+        try:
+            for done, fut in enumerate(asyncio.as_completed(futures), 1):
+                i, res = await fut
+                results[i] = res
+                errors += 'error' in res
+                progress_cb(res if stream else {'read': res['path'], 'done': done, 'total': len(specs)})
+                await backpressure(progress_cb)
+        finally:
+            for fut in futures:
+                fut.cancel()
+        out = {'count': len(specs), 'errors': errors}
+        if not stream:
+            out['files'] = results
+        return out
+
+    async def _stream_range(self, path, absf, begin, end, size, chunk_size, progress_cb):
+        seq = 0
+        pos = begin
+        while pos < end:
+            chunk, stop = await self._io(self._read_chunk, absf, pos, min(end, pos + max(chunk_size, 4)))
+            progress_cb({'path': path, 'seq': seq, 'offset': pos, 'chunk': chunk})
+            await backpressure(progress_cb)
+            seq += 1
+            pos = stop
+        return {'path': path, 'stream': True, 'chunks': seq, 'offset': begin, 'length': end - begin,
+                'size': size, 'eof': end >= size}
+
+    def _read_chunk(self, absf, begin, end):
+        # One byte past end shows whether end splits a character.
+        with open(absf, 'rb') as fh:
+            fh.seek(begin)
+            buf = fh.read(end - begin + 1)
+        stop = utf8_align(buf, 0, min(len(buf), end - begin))[1]
+        return buf[:stop].decode('utf8'), begin + stop
 
     async def write_file(self, input_obj, progress_cb=lambda p: None):
+        return await self._io_locked(input_obj.get('path'), self._write_file, input_obj)
+
+    def _write_file(self, input_obj):
         path = input_obj.get('path')
         data = input_obj.get('data', '')
         absf = resolve_path_safe(self.root, path)
         ensure_dir(pathlib.Path(absf).parent)
-        ensure_dir(self.backup_dir)
-        backup_file(self.backup_dir, absf)
-        pathlib.Path(absf).write_text(data, encoding='utf8')
+        self._backup(absf, 'write')
+        self._write(absf, data)
+        self.index.touch(absf)
         return {'ok': True, 'path': path, 'bytes': len(data)}
 
     async def delete_path(self, input_obj, progress_cb=lambda p: None):
+        return await self._io_locked(input_obj.get('path'), self._delete_path, input_obj,
+                                     self._loop_callback(progress_cb))
+
+    def _delete_path(self, input_obj, progress_cb):
         path = input_obj.get('path')
         absf = resolve_path_safe(self.root, path)
         if pathlib.Path(absf).is_dir():
-            import shutil
-            shutil.rmtree(absf)
+            children = sorted(pathlib.Path(absf).iterdir())
+            for done, child in enumerate(children, 1):
+                if child.is_dir() and not child.is_symlink():
+                    shutil.rmtree(child)
+                else:
+                    child.unlink()
+                progress_cb({'deleted': child.relative_to(self.index.root).as_posix(), 'done': done, 'total': len(children)})
+            os.rmdir(absf)
         else:
+            self._backup(absf, 'delete')
             pathlib.Path(absf).unlink(missing_ok=True)
+        self.index.touch(absf)
         return {'ok': True}
 
     async def edit_file(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'search': str, 'replace': str, 'limit': int } or
+        #            { 'path': str, 'edits': [{'search': str, 'replace': str, 'regex': bool,
+        #                                      'ignore_case': bool, 'limit': int}] }
+        # Edits apply in order (see apply_replacements); the file gets one backup and one write.
+        return await self._io_locked(input_obj.get('path'), self._edit_file, input_obj)
+
+    def _edit_file(self, input_obj):
         path = input_obj.get('path')
-        search = input_obj.get('search', '')
-        replace = input_obj.get('replace', '')
-        limit = input_obj.get('limit', None)
+        edits = input_obj.get('edits')
+        if edits is None:
+            edits = [{'search': input_obj.get('search', ''), 'replace': input_obj.get('replace', ''),
+                      'limit': input_obj.get('limit', None)}]
         absf = resolve_path_safe(self.root, path)
         text = pathlib.Path(absf).read_text(encoding='utf8')
-        pattern = re.escape(search)
-        count = 0
-        def _repl(m):
-            nonlocal count, limit
-            if limit and count >= limit:
-                return m.group(0)
-            count += 1
-            return replace
-        result = re.sub(pattern, _repl, text)
-        ensure_dir(self.backup_dir)
-        backup_file(self.backup_dir, absf)
-        pathlib.Path(absf).write_text(result, encoding='utf8')
-        return {'ok': True, 'replaced': count}
+        result, counts = apply_replacements(text, edits)
+        if result != text:
+            self._backup(absf, 'edit')
+            self._write(absf, result)
+            self.index.touch(absf)
+        out = {'ok': True, 'replaced': sum(counts)}
+        if 'edits' in input_obj:
+            out['counts'] = counts
+        return out
+
+    async def patch(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'diff': str } or
+        #            { 'path': str, 'edits': [{'start_line': int, 'end_line': int, 'text': str, 'expect': str}] }
+        #            plus optional 'base_hash' (the fs.index/fs.history hash the change was made against).
+        # The path may be omitted for a diff with a '+++' header. Nothing is written on a conflict.
+        diff = input_obj.get('diff')
+        path = input_obj.get('path') or (diff_target(diff) if diff else None)
+        return await self._io_locked(path, self._patch, input_obj)
+
+    def _patch(self, input_obj):
+        diff = input_obj.get('diff')
+        path = input_obj.get('path') or (diff_target(diff) if diff else None)
+        if not path:
+            raise ValueError('path is required')
+        absf = resolve_path_safe(self.root, path)
+        base_hash = input_obj.get('base_hash')
+        if base_hash and content_hash(absf) != base_hash:
+            raise PatchConflict(f'{path} changed since {base_hash}')
+        text = pathlib.Path(absf).read_text(encoding='utf8')
+        if diff:
+            result = apply_unified_diff(text, diff)
+        else:
+            result = apply_line_edits(text, input_obj.get('edits') or [])
+        if result == text:
+            return {'ok': True, 'path': path, 'changed': False}
+        self._backup(absf, 'patch')
+        self._write(absf, result)
+        self.index.touch(absf)
+        return {'ok': True, 'path': path, 'changed': True, 'bytes': len(result), 'hash': content_hash(absf)}
+
+    def _write(self, absf, data):
+        atomic_write(absf, data, fsync=self.fsync_writes)
+
+    def _backup(self, absf, op):
+        if self.backup_on_edit:
+            self.backups.save(self.index.rel(absf), absf, op)
+
+    async def history(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'limit': int }
+        return await self._io(self._history, input_obj)
+
+    def _history(self, input_obj):
+        path = input_obj.get('path')
+        absf = resolve_path_safe(self.root, path)
+        versions = self.backups.history(self.index.rel(absf))[:input_obj.get('limit', 20)]
+        current = content_hash(absf) if os.path.isfile(absf) else None
+        return {'path': path, 'versions': [dict(v, current=v['hash'] == current) for v in versions]}
+
+    async def undo(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'path': str, 'seq': int }
+        # Restores version seq (see fs.history), by default the newest backup that differs from
+        # the file as it is now. The current content is backed up first, so undo can be undone.
+        return await self._io_locked(input_obj.get('path'), self._undo, input_obj)
+
+    def _undo(self, input_obj):
+        path = input_obj.get('path')
+        absf = resolve_path_safe(self.root, path)
+        rel = self.index.rel(absf)
+        versions = self.backups.history(rel)
+        seq = input_obj.get('seq')
+        if seq is not None:
+            target = next((v for v in versions if v['seq'] == seq), None)
+        else:
+            current = content_hash(absf) if os.path.isfile(absf) else None
+            target = next((v for v in versions if v['hash'] != current), None)
+        if target is None:
+            raise ValueError(f'No backup of {path} to restore' + (f' with seq {seq}' if seq is not None else ''))
+        data = self.backups.load(target['hash'])
+        self.backups.save(rel, absf, 'undo')
+        ensure_dir(pathlib.Path(absf).parent)
+        self._write(absf, data)
+        self.index.touch(absf)
+        return {'ok': True, 'path': path, 'restored': target['seq'], 'hash': target['hash'], 'bytes': len(data)}
@@ -1,57 +1,264 @@
 import httpx, asyncio, json
 from typing import Callable
+from collections import OrderedDict
+from utils.cache import ResponseCache
+from utils.config import section
+from utils.context import evict_turns, message_tokens
+from utils.output import Progress, backpressure
+
+# Timing fields of Ollama's final chat object that are passed back to callers.
+STAT_FIELDS = ('eval_count', 'eval_duration', 'prompt_eval_count', 'prompt_eval_duration',
+               'load_duration', 'total_duration')
+
+class NDJSONDecoder:
+    """Incremental decoder for newline-delimited JSON over raw bytes.
+
+    Objects may be split across network chunks; only bytes that arrived since
+    the previous feed() are scanned for newlines. Lines that are not valid
+    JSON come back as str.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._scan = 0
+
+    def feed(self, data):
+        self._buf += data
+        out = []
+        start = 0
+        while True:
+            nl = self._buf.find(b'\n', self._scan)
+            if nl < 0:
+                break
+            self._decode(self._buf[start:nl], out)
+            start = self._scan = nl + 1
+        if start:
+            del self._buf[:start]
+        self._scan = len(self._buf)
+        return out
+
+    def close(self):
+        out = []
+        self._decode(self._buf, out)
+        self._buf = bytearray()
+        self._scan = 0
+        return out
+
+    @staticmethod
+    def _decode(line, out):
+        line = bytes(line).strip()
+        if not line:
+            return
+        try:
+            out.append(json.loads(line))
+        except ValueError:
+            out.append(line.decode('utf8', 'replace'))
 
 class OllamaClient:
-    def __init__(self, base_url='http://127.0.0.1:11434', logger=None):
+    def __init__(self, base_url='http://127.0.0.1:11434', logger=None, timeout=120, connect_timeout=15,
+                 max_connections=10, max_keepalive_connections=5, keepalive_expiry=30,
+                 cache=None, cache_default=False, scheduler=None, max_sessions=32, session_budget=4000):
         self.base_url = base_url.rstrip('/')
         self.logger = logger
+        self.scheduler = scheduler
+        self.cache = cache
+        self.cache_default = cache_default
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.max_sessions = max_sessions
+        self.session_budget = session_budget
+        self.sessions = OrderedDict()
+        self._client = None
+
+    @classmethod
+    def from_config(cls, cfg, base_url=None, logger=None, cache_dir=None, scheduler=None):
+        ai = section(cfg, 'ai')
+        cache_cfg = ai['cache']
+        cache = None
+        if cache_dir:
+            cache = ResponseCache(cache_dir,
+                                  memory_entries=cache_cfg['memory_entries'],
+                                  max_bytes=cache_cfg['max_bytes'],
+                                  ttl=cache_cfg['ttl'])
+        return cls(
+            base_url=base_url or ai['api_url'],
+            logger=logger,
+            timeout=ai['timeout'],
+            connect_timeout=ai['connection_timeout'],
+            max_connections=ai['max_connections'],
+            max_keepalive_connections=ai['max_keepalive_connections'],
+            keepalive_expiry=ai['keepalive_expiry'],
+            cache=cache,
+            cache_default=cache_cfg['enabled'],
+            scheduler=scheduler,
+            max_sessions=ai['chat_sessions'],
+            session_budget=max(0, ai['max_context_length'] - ai['max_tokens']),
+        )
+
+    def _get_client(self):
+        # One pooled client per OllamaClient so chats reuse keep-alive connections.
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive_connections,
+                                    keepalive_expiry=self.keepalive_expiry))
+        return self._client
+
+    async def aclose(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
 
     async def _stream_chat(self, body, progress_cb: Callable[[dict], None]):
         url = f"{self.base_url}/api/chat"
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream('POST', url, json=body) as resp:
-                async for chunk in resp.aiter_text():
-                    if not chunk:
-                        continue
-                    # Ollama often streams JSON lines; try to parse per-line
-                    for line in chunk.splitlines():
-                        line = line.strip()
-                        if not line:
-                            continue
-                        try:
-                            j = json.loads(line)
-                            # extract token-like content
-                            token = None
-                            if isinstance(j, dict):
-                                token = j.get('message', {}).get('content') or j.get('response') or j.get('text')
-                            if token:
-                                progress_cb({'message': token})
-                        except Exception:
-                            # send raw chunk
-                            progress_cb({'message': line})
-        return
+        client = self._get_client()
+        decoder = NDJSONDecoder()
+        parts = []
+        final = {}
+
+        def handle(objs):
+            for j in objs:
+                if not isinstance(j, dict):
+                    # not JSON: forward the raw line
+                    parts.append(j)
+                    progress_cb({'message': j})
+                    continue
+                if j.get('error'):
+                    raise RuntimeError(f"Ollama error: {j['error']}")
+                # extract token-like content
+                token = (j.get('message') or {}).get('content') or j.get('response') or j.get('text')
+                if token:
+                    parts.append(token)
+                    progress_cb({'message': token})
+                if j.get('done'):
+                    final.update(j)
+
+        async with client.stream('POST', url, json=body) as resp:
+            if resp.status_code >= 400:
+                detail = (await resp.aread()).decode('utf8', 'replace').strip()
+                raise RuntimeError(f"Ollama returned HTTP {resp.status_code}: {detail}")
+            async for chunk in resp.aiter_bytes():
+                if chunk:
+                    handle(decoder.feed(chunk))
+                    await backpressure(progress_cb)
+            handle(decoder.close())
+
+        result = {'ok': True, 'model': final.get('model', body.get('model')), 'content': ''.join(parts)}
+        if final.get('done_reason'):
+            result['done_reason'] = final['done_reason']
+        for key in STAT_FIELDS:
+            if key in final:
+                result[key] = final[key]
+        if final.get('eval_count') and final.get('eval_duration'):
+            result['tokens_per_sec'] = round(final['eval_count'] / (final['eval_duration'] / 1e9), 2)
+        return result
+
+    async def _generate(self, body, progress_cb, priority='interactive'):
+        if self.scheduler is None:
+            return await self._stream_chat(body, progress_cb)
+        await self.scheduler.acquire(body['model'], priority, progress_cb)
+        try:
+            return await self._stream_chat(body, progress_cb)
+        finally:
+            self.scheduler.release(body['model'])
+
+    async def _cached_chat(self, body, progress_cb, priority='interactive'):
+        key = ResponseCache.key(body)
+        entry = await asyncio.to_thread(self.cache.get, key)
+        if entry is not None:
+            # Replay the stored stream so streaming clients see the same frames.
+            for token in entry['tokens']:
+                progress_cb({'message': token})
+                await backpressure(progress_cb)
+            return dict(entry['result'], cached=True)
+        tokens = []
+        def record(payload):
+            if 'message' in payload:
+                tokens.append(payload['message'])
+            progress_cb(payload)
+        result = await self._generate(body, Progress(record, getattr(progress_cb, 'wait_for_space', None)),
+                                      priority)
+        try:
+            await asyncio.to_thread(self.cache.put, key, tokens, result)
+        except OSError:
+            pass
+        return result
 
     def chat(self, input_obj, progress_cb=lambda p: None):
-        # input_obj: { 'prompt': str, 'system': Optional[str], 'model': Optional[str], 'stream': bool }
+        # input_obj: { 'prompt': str, 'system': Optional[str], 'model': Optional[str], 'stream': bool,
+        #              'messages': Optional[list], 'session': Optional[str], 'reset': bool,
+        #              'options': Optional[dict], 'cache': Optional[bool], 'priority': 'interactive'|'batch' }
+        # 'messages' ([{role, content}]) is sent as given, followed by 'prompt' if that is set too.
+        # With a 'session' id the server keeps the conversation: earlier turns are sent ahead
+        # of the new messages (after the session's system prompt) and the reply is appended
+        # once it completes. Old turns are dropped in batches when they outgrow the context
+        # budget, so the prompt prefix stays the same between turns.
         prompt = input_obj.get('prompt', '')
         system = input_obj.get('system')
         model = input_obj.get('model', 'deepseek-r1:8b')
         stream = input_obj.get('stream', True)
+        use_cache = self.cache is not None and input_obj.get('cache', self.cache_default)
+        priority = input_obj.get('priority', 'interactive')
         body = {
             'model': model,
             'stream': True,
             'messages': []
         }
-        if system:
+        if input_obj.get('options'):
+            body['options'] = input_obj['options']
+        new = [{'role': m['role'], 'content': m['content']} for m in input_obj.get('messages') or []]
+        if prompt or not new:
+            new.append({'role':'user','content':prompt})
+        session_id = input_obj.get('session')
+        session = None
+        if session_id:
+            session = self._session(session_id, system, input_obj.get('reset', False))
+            system = session['system']
+        if system and new[0]['role'] != 'system':
             body['messages'].append({'role':'system','content':system})
-        body['messages'].append({'role':'user','content':prompt})
+        if session:
+            body['messages'].extend(session['turns'])
+        body['messages'].extend(new)
         # Log prompt
         if self.logger:
             try:
-                self.logger.append('prompt', {'model': model, 'prompt': prompt, 'system': system})
+                self.logger.append('prompt', {'model': model, 'prompt': prompt, 'system': system,
+                                              'session': session_id, 'messages': len(body['messages'])})
             except Exception:
                 pass
         async def _run():
-            await self._stream_chat(body, progress_cb)
-            return {'ok': True}
+            if use_cache:
+                result = await self._cached_chat(body, progress_cb, priority)
+            else:
+                result = await self._generate(body, progress_cb, priority)
+            if session:
+                self._remember(session, new, result)
+                result = dict(result, session=session_id, turns=len(session['turns']))
+            if self.logger:
+                try:
+                    self.logger.append('response', {k: v for k, v in result.items() if k != 'content'})
+                except Exception:
+                    pass
+            return result
         return _run()
+
+    def _session(self, session_id, system, reset=False):
+        session = self.sessions.get(session_id)
+        if session is None or reset:
+            session = self.sessions[session_id] = {'system': None, 'turns': []}
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        if system:
+            session['system'] = system
+        return session
+
+    def _remember(self, session, new, result):
+        # Only completed turns are kept, so a failed or cancelled chat can simply be retried.
+        turns = session['turns'] + new + [{'role': 'assistant', 'content': result.get('content', '')}]
+        budget = self.session_budget - (message_tokens({'content': session['system']}) if session['system'] else 0)
+        session['turns'], _ = evict_turns(turns, budget)
@@ -1,25 +1,528 @@
-import asyncio
+import os, time, uuid, shlex, codecs, signal, asyncio
+from collections import deque, OrderedDict
 from asyncio.subprocess import PIPE
+from utils.fsx import utf8_align
+from utils.scheduler import QueueFull
+from utils.config import section
+from utils.output import backpressure
+
+READ_CHUNK = 64 * 1024
+
+async def kill_process_tree(proc, grace=2.0):
+    """Terminate proc and everything in its process group, escalating to SIGKILL"""
+    if proc.returncode is not None:
+        return
+    if os.name == 'posix':
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            await asyncio.wait_for(proc.wait(), grace)
+            return
+        except asyncio.TimeoutError:
+            pass
+        except ProcessLookupError:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+    await proc.wait()
+
+class OutputLimitExceeded(Exception):
+    pass
+
+class OutputCapture:
+    """Turns a process's raw output into coalesced progress frames and a bounded tail.
+
+    Output is buffered until interval seconds have passed since the first
+    unsent byte or frame_bytes are waiting, then sent as one
+    {'stream', 'output'} frame per run of same-stream text, so stdout/stderr
+    interleaving is kept. The last tail_bytes bytes are kept for the result.
+    """
+
+    def __init__(self, progress_cb, interval=0.05, frame_bytes=16384, tail_bytes=65536):
+        self.progress_cb = progress_cb
+        self.interval = interval
+        self.frame_bytes = frame_bytes
+        self.tail_bytes = tail_bytes
+        self.total = 0
+        self._decoders = {}
+        self._pending = []
+        self._pending_bytes = 0
+        self._timer = None
+        self._tail = deque()
+        self._tail_len = 0
+
+    def feed(self, kind, data):
+        self.total += len(data)
+        self._tail.append(data)
+        self._tail_len += len(data)
+        while self._tail_len - len(self._tail[0]) >= self.tail_bytes:
+            self._tail_len -= len(self._tail.popleft())
+        decoder = self._decoders.get(kind)
+        if decoder is None:
+            decoder = self._decoders[kind] = codecs.getincrementaldecoder('utf8')('replace')
+        text = decoder.decode(data)
+        if not text:
+            return
+        if self._pending and self._pending[-1][0] == kind:
+            self._pending[-1][1].append(text)
+        else:
+            self._pending.append((kind, [text]))
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.frame_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        for kind, parts in pending:
+            self.progress_cb({'stream': kind, 'output': ''.join(parts)})
+
+    def tail(self):
+        data = b''.join(self._tail)[-self.tail_bytes:]
+        return data.decode('utf8', 'replace')
+
+class Job:
+    """One background command started with shell.start.
+
+    Output from both streams goes into a single ring of buffer_bytes bytes
+    addressed by absolute offset, so shell.tail can resume from where it left
+    off and report how much was dropped in between.
+    """
+
+    def __init__(self, cmd, cwd, timeout=None, max_output_bytes=None, buffer_bytes=1024 * 1024):
+        self.id = uuid.uuid4().hex[:12]
+        self.cmd = cmd
+        self.cwd = cwd
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.buffer_bytes = buffer_bytes
+        self.state = 'queued'
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+        self.listeners = set()
+        self._buf = bytearray()
+        self._base = 0
+
+    @property
+    def done(self):
+        return self.state not in ('queued', 'running')
+
+    @property
+    def end(self):
+        return self._base + len(self._buf)
+
+    def append(self, payload):
+        self._buf += payload['output'].encode('utf8')
+        if len(self._buf) > self.buffer_bytes:
+            excess = len(self._buf) - self.buffer_bytes
+            del self._buf[:excess]
+            self._base += excess
+        for cb in list(self.listeners):
+            try:
+                cb(payload)
+            except Exception:
+                pass
+
+    def read(self, since=None, max_bytes=64 * 1024):
+        """Output from offset since (default: the last max_bytes) -> (text, start, next offset)"""
+        start = max(self.end - max_bytes, self._base) if since is None else max(since, self._base)
+        begin, end = utf8_align(self._buf, start - self._base, min(len(self._buf), start - self._base + max_bytes))
+        return self._buf[begin:end].decode('utf8', 'replace'), self._base + begin, self._base + end
+
+    def info(self):
+        out = {'id': self.id, 'cmd': self.cmd, 'state': self.state, 'output_bytes': self.end,
+               'created': self.created, 'started': self.started, 'finished': self.finished}
+        if self.result:
+            out.update({'ok': self.result['ok'], 'code': self.result['code']})
+            if 'killed' in self.result:
+                out['killed'] = self.result['killed']
+        return out
+
+class ShellSession:
+    """A long-lived /bin/sh kept warm for shell.session.
+
+    Commands are eval'd by the shell itself, so cd, export and shell variables
+    carry over to the next one. After each command the shell prints a marker
+    line with the exit code on stdout and a bare marker line on stderr;
+    everything before the markers is the command's output. The marker holds a
+    random id chosen per session so ordinary output cannot end a frame early.
+    """
+
+    def __init__(self, id, cwd=None):
+        self.id = id
+        self.cwd = cwd
+        self.proc = None
+        self.closed = False
+        self.lock = asyncio.Lock()
+        self.created = self.last_used = time.monotonic()
+        self.commands = 0
+        self._marker = f'__codeas_{uuid.uuid4().hex}__'.encode()
+        self._rest = {'stdout': b'', 'stderr': b''}
+
+    async def start(self):
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(
+            '/bin/sh', stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=self.cwd, start_new_session=True))
+        try:
+            self.proc = await asyncio.shield(spawn)
+        except asyncio.CancelledError:
+            self.proc = await spawn
+            raise
+
+    async def run(self, cmd, capture, max_output_bytes=None):
+        """Run cmd, feeding its output to capture, and return its exit code.
+        Raises ConnectionError if the shell exits instead (e.g. on `exit`)."""
+        marker = self._marker.decode()
+        # The command's stdin is /dev/null so it cannot swallow the lines queued after it.
+        script = (f'command eval {shlex.quote(cmd)} </dev/null\n'
+                  f'__codeas_rc=$?\n'
+                  f"printf '\\n{marker} %d\\n' \"$__codeas_rc\"\n"
+                  f"printf '\\n{marker}\\n' >&2\n")
+        try:
+            self.proc.stdin.write(script.encode())
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            raise ConnectionError('Shell session has exited')
+        self.commands += 1
+        tasks = [asyncio.ensure_future(self._read_frame(self.proc.stdout, 'stdout', capture, max_output_bytes)),
+                 asyncio.ensure_future(self._read_frame(self.proc.stderr, 'stderr', capture, max_output_bytes))]
+        try:
+            code, _ = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return code
+
+    async def _read_frame(self, stream, kind, capture, max_output_bytes):
+        needle = b'\n' + self._marker
+        buf = self._rest[kind]
+        def emit(data):
+            if data:
+                capture.feed(kind, data)
+                if max_output_bytes and capture.total >= max_output_bytes:
+                    raise OutputLimitExceeded()
+        while True:
+            at = buf.find(needle)
+            eol = buf.find(b'\n', at + len(needle)) if at >= 0 else -1
+            if eol >= 0:
+                self._rest[kind] = buf[eol + 1:]
+                emit(buf[:at])
+                return int(buf[at + len(needle):eol] or 0)
+            # Hold back anything that could be the start of a marker split across reads.
+            cut = at if at >= 0 else max(0, len(buf) - len(needle) + 1)
+            emit(buf[:cut])
+            buf = buf[cut:]
+            await backpressure(capture.progress_cb)
+            data = await stream.read(READ_CHUNK)
+            if not data:
+                self._rest[kind] = b''
+                emit(buf)
+                raise ConnectionError('Shell session has exited')
+            buf += data
 
 class ShellTool:
-    def __init__(self, logger=None):
+    def __init__(self, root=None, logger=None, frame_interval=0.05, frame_bytes=16384, tail_bytes=65536,
+                 timeout=None, max_output_bytes=None, max_jobs=None, max_queued_jobs=64,
+                 job_buffer_bytes=1024 * 1024, keep_finished_jobs=50, max_sessions=8,
+                 session_idle_timeout=600):
+        self.root = root
         self.logger = logger
+        self.frame_interval = frame_interval
+        self.frame_bytes = frame_bytes
+        self.tail_bytes = tail_bytes
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.max_queued_jobs = max_queued_jobs
+        self.job_buffer_bytes = job_buffer_bytes
+        self.keep_finished_jobs = keep_finished_jobs
+        self.jobs = OrderedDict()
+        self._job_slots = None
+        self.max_sessions = max_sessions
+        self.session_idle_timeout = session_idle_timeout
+        self.sessions = OrderedDict()
+        self._reaper = None
 
-    async def _stream_proc(self, cmd, cwd, progress_cb):
-        proc = await asyncio.create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE, cwd=cwd)
+    @classmethod
+    def from_config(cls, root, cfg, logger=None):
+        sh = section(cfg, 'shell')
+        return cls(root=root,
+                   logger=logger,
+                   frame_interval=sh['frame_interval_ms'] / 1000,
+                   frame_bytes=sh['frame_max_bytes'],
+                   tail_bytes=sh['tail_bytes'],
+                   timeout=sh['timeout'] or None,
+                   max_output_bytes=sh['max_output_bytes'] or None,
+                   max_jobs=sh['max_jobs'] or None,
+                   max_queued_jobs=sh['max_queued_jobs'],
+                   job_buffer_bytes=sh['job_buffer_bytes'],
+                   keep_finished_jobs=sh['keep_finished_jobs'],
+                   max_sessions=sh['max_sessions'],
+                   session_idle_timeout=sh['session_idle_timeout'] or None)
+
+    async def _stream_proc(self, cmd, cwd, progress_cb, timeout=None, max_output_bytes=None):
+        # A new session makes the shell a process group leader so cancellation reaches its children.
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_shell(cmd, stdout=PIPE, stderr=PIPE, cwd=cwd,
+                                                                      start_new_session=(os.name == 'posix')))
+        try:
+            proc = await asyncio.shield(spawn)
+        except asyncio.CancelledError:
+            # Cancelling the spawn itself would wait for the command to exit on its own.
+            await kill_process_tree(await spawn)
+            raise
+        capture = OutputCapture(progress_cb, self.frame_interval, self.frame_bytes, self.tail_bytes)
         async def reader(stream, kind):
             while True:
-                line = await stream.readline()
-                if not line:
+                data = await stream.read(READ_CHUNK)
+                if not data:
                     break
-                progress_cb({'stream': kind, 'output': line.decode('utf8', 'replace')})
-        await asyncio.gather(reader(proc.stdout, 'stdout'), reader(proc.stderr, 'stderr'))
+                capture.feed(kind, data)
+                if max_output_bytes and capture.total >= max_output_bytes:
+                    raise OutputLimitExceeded()
+                await backpressure(progress_cb)
+        tasks = [asyncio.ensure_future(reader(proc.stdout, 'stdout')),
+                 asyncio.ensure_future(reader(proc.stderr, 'stderr')),
+                 asyncio.ensure_future(proc.wait())]
+        stopped = None
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except asyncio.TimeoutError:
+            stopped = 'timeout'
+        except OutputLimitExceeded:
+            stopped = 'max_output_bytes'
+        except asyncio.CancelledError:
+            await kill_process_tree(proc)
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            capture.flush()
+        if stopped:
+            await kill_process_tree(proc)
+            await self._discard_output(proc)
         rc = await proc.wait()
-        return {'ok': rc == 0, 'code': rc}
+        result = {'ok': rc == 0 and not stopped, 'code': rc, 'output_bytes': capture.total,
+                  'tail': capture.tail(), 'tail_truncated': capture.total > self.tail_bytes}
+        if stopped:
+            result['killed'] = stopped
+        return result
+
+    async def _discard_output(self, proc, timeout=1.0):
+        # Read the killed process's pipes to EOF so their transports close cleanly.
+        async def drain(stream):
+            while await stream.read(READ_CHUNK):
+                pass
+        try:
+            await asyncio.wait_for(asyncio.gather(drain(proc.stdout), drain(proc.stderr)), timeout)
+        except asyncio.TimeoutError:
+            pass  # a detached grandchild still holds the pipe
+
+    def _cwd(self, cwd):
+        # Commands run in the workspace root unless they ask otherwise; a relative cwd is taken from there.
+        if self.root is None:
+            return cwd
+        return os.path.join(self.root, cwd) if cwd else self.root
 
     def run_cmd(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'cmd': str, 'cwd': str, 'timeout': float, 'max_output_bytes': int }
+        # On timeout or too much output the whole process group is killed and the
+        # result says which limit ('killed': 'timeout' | 'max_output_bytes').
         cmd = input_obj.get('cmd', '')
-        cwd = input_obj.get('cwd', None)
+        cwd = self._cwd(input_obj.get('cwd'))
+        timeout = input_obj.get('timeout', self.timeout)
+        max_output_bytes = input_obj.get('max_output_bytes', self.max_output_bytes)
         async def _run():
-            return await self._stream_proc(cmd, cwd, progress_cb)
+            return await self._stream_proc(cmd, cwd, progress_cb, timeout, max_output_bytes)
         return _run()
+
+    # Background jobs: shell.start queues a command and returns at once; at most
+    # max_jobs run concurrently and the rest wait in order (up to max_queued_jobs).
+
+    def _job(self, input_obj):
+        job = self.jobs.get(input_obj.get('id'))
+        if job is None:
+            raise ValueError(f"Unknown job: {input_obj.get('id')}")
+        return job
+
+    async def start_job(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'cmd': str, 'cwd': str, 'timeout': float, 'max_output_bytes': int }
+        if not input_obj.get('cmd'):
+            raise ValueError('cmd is required')
+        queued = sum(1 for j in self.jobs.values() if j.state == 'queued')
+        if queued >= self.max_queued_jobs:
+            raise QueueFull(f'Job queue is full ({queued} waiting)')
+        if self._job_slots is None:
+            self._job_slots = asyncio.Semaphore(self.max_jobs)
+        job = Job(input_obj['cmd'], self._cwd(input_obj.get('cwd')), input_obj.get('timeout', self.timeout),
+                  input_obj.get('max_output_bytes', self.max_output_bytes), self.job_buffer_bytes)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run_job(job))
+        self._prune_jobs()
+        return job.info()
+
+    async def _run_job(self, job):
+        try:
+            async with self._job_slots:
+                job.state = 'running'
+                job.started = time.time()
+                job.result = await self._stream_proc(job.cmd, job.cwd, job.append, job.timeout, job.max_output_bytes)
+                job.state = 'done' if job.result['ok'] else 'failed'
+        except asyncio.CancelledError:
+            job.state = 'cancelled'
+        except Exception as e:
+            job.result = {'ok': False, 'code': None, 'error': str(e)}
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def _prune_jobs(self):
+        finished = [j for j in self.jobs.values() if j.done]
+        for job in finished[:max(0, len(finished) - self.keep_finished_jobs)]:
+            del self.jobs[job.id]
+
+    async def job_status(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'id': str } -- without an id, every known job
+        if input_obj.get('id'):
+            return self._job(input_obj).info()
+        return {'jobs': [j.info() for j in self.jobs.values()]}
+
+    async def job_tail(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'id': str, 'since': int, 'max_bytes': int }
+        # Pass the returned 'offset' as 'since' to continue; 'dropped' counts bytes that
+        # left the job's buffer before they could be read.
+        job = self._job(input_obj)
+        since = input_obj.get('since')
+        data, start, end = job.read(since, input_obj.get('max_bytes', 64 * 1024))
+        return {'id': job.id, 'state': job.state, 'data': data, 'offset': end,
+                'dropped': max(0, start - since) if since is not None else 0}
+
+    async def job_wait(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'id': str, 'timeout': float, 'follow': bool }
+        # Waits for the job to finish (or timeout seconds); with follow, output produced
+        # meanwhile is streamed as progress frames. Returns the job's status either way.
+        job = self._job(input_obj)
+        if input_obj.get('follow'):
+            job.listeners.add(progress_cb)
+        try:
+            await asyncio.wait_for(asyncio.shield(job.task), input_obj.get('timeout'))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            job.listeners.discard(progress_cb)
+        info = job.info()
+        if job.done and job.result:
+            info['tail'] = job.result.get('tail', '')
+        return info
+
+    # Sessions: shell.session keeps one warm /bin/sh per session id, so short commands
+    # skip the spawn and cd/export state carries over between calls. At most
+    # max_sessions live at once (the least recently used idle one makes room) and
+    # any left idle for session_idle_timeout seconds is closed.
+
+    async def session_cmd(self, input_obj, progress_cb=lambda p: None):
+        # input_obj: { 'session': str, 'cmd': str, 'cwd': str, 'timeout': float,
+        #              'max_output_bytes': int, 'close': bool }
+        # cwd only applies when the session is created. On timeout, too much output or
+        # cancellation the session's process group is killed and the session closed.
+        sid = input_obj.get('session')
+        if not sid:
+            raise ValueError('session is required')
+        if input_obj.get('close'):
+            return {'session': sid, 'closed': await self._close_session(sid)}
+        cmd = input_obj.get('cmd')
+        if not cmd:
+            raise ValueError('cmd is required')
+        session = self.sessions.get(sid)
+        if session is None:
+            session = await self._new_session(sid, self._cwd(input_obj.get('cwd')))
+        self.sessions.move_to_end(sid)
+        timeout = input_obj.get('timeout', self.timeout)
+        max_output_bytes = input_obj.get('max_output_bytes', self.max_output_bytes)
+        capture = OutputCapture(progress_cb, self.frame_interval, self.frame_bytes, self.tail_bytes)
+        code = stopped = None
+        async with session.lock:
+            if session.closed:
+                raise ValueError(f'Session {sid} was closed')
+            try:
+                if session.proc is None:
+                    await session.start()
+                code = await asyncio.wait_for(session.run(cmd, capture, max_output_bytes), timeout)
+            except asyncio.TimeoutError:
+                stopped = 'timeout'
+            except OutputLimitExceeded:
+                stopped = 'max_output_bytes'
+            except ConnectionError:
+                code = await session.proc.wait()
+            except asyncio.CancelledError:
+                await self._close_session(sid, session)
+                raise
+            finally:
+                capture.flush()
+                session.last_used = time.monotonic()
+            if stopped or session.proc.returncode is not None:
+                await self._close_session(sid, session)
+        result = {'ok': code == 0 and not stopped, 'code': code, 'session': sid, 'output_bytes': capture.total,
+                  'tail': capture.tail(), 'tail_truncated': capture.total > self.tail_bytes}
+        if stopped:
+            result['killed'] = stopped
+        if session.closed:
+            result['closed'] = True
+        return result
+
+    async def _new_session(self, sid, cwd):
+        if os.name != 'posix':
+            raise ValueError('Shell sessions need a POSIX /bin/sh')
+        while len(self.sessions) >= self.max_sessions:
+            idle = next((s for s in self.sessions.values() if not s.lock.locked()), None)
+            if idle is None:
+                raise QueueFull(f'All {self.max_sessions} shell sessions are busy')
+            await self._close_session(idle.id, idle)
+        session = self.sessions.get(sid)
+        if session is None:
+            session = self.sessions[sid] = ShellSession(sid, cwd)
+        if self.session_idle_timeout and (self._reaper is None or self._reaper.done()):
+            self._reaper = asyncio.create_task(self._reap_sessions())
+        return session
+
+    async def _close_session(self, sid, session=None):
+        session = session or self.sessions.get(sid)
+        if session is None:
+            return False
+        if self.sessions.get(sid) is session:
+            del self.sessions[sid]
+        session.closed = True
+        if session.proc is not None:
+            session.proc.stdin.close()
+            await kill_process_tree(session.proc)
+            await self._discard_output(session.proc)
+        return True
+
+    async def _reap_sessions(self):
+        while self.sessions:
+            await asyncio.sleep(min(max(self.session_idle_timeout / 4, 1), 60))
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if not session.lock.locked() and now - session.last_used > self.session_idle_timeout:
+                    await self._close_session(session.id, session)
+
+    async def aclose(self):
+        """Stop every background job and shell session, killing their process groups"""
+        tasks = [j.task for j in self.jobs.values() if j.task and not j.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+        for session in list(self.sessions.values()):
+            await self._close_session(session.id, session)
@@ -0,0 +1,154 @@
+import os, gzip, json, hashlib, pathlib, threading
+from collections import Counter
+from datetime import datetime
+from utils.config import section
+
+class BackupStore:
+    """Content-addressed backups of workspace files.
+
+    Each distinct content is stored once as objects/<h[:2]>/<h>.gz, where h is
+    its blake2b hash. Every path has its own journal (journal/<hash of path>.jsonl)
+    with one line per saved version, so history and undo for a file never look
+    at any other file. Only the newest max_versions versions of a path are
+    kept, and once the objects exceed max_bytes the oldest versions across all
+    paths are dropped until they fit. Objects are deleted once no journal
+    entry refers to them; the reference counts are built from the journals on
+    first use and then kept up to date, so trimming a journal only rescans
+    the journals when an object is about to go: another process sharing the
+    store may have started using it since the counts were built.
+    """
+
+    def __init__(self, store_dir, max_versions=50, max_bytes=256 * 1024 * 1024, compress_level=6):
+        self.store_dir = pathlib.Path(store_dir)
+        self.objects_dir = self.store_dir / 'objects'
+        self.journal_dir = self.store_dir / 'journal'
+        self.max_versions = max_versions
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self._bytes = None
+        self._refs = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, store_dir, cfg):
+        ws = section(cfg, 'workspace')
+        return cls(store_dir, max_versions=ws['backup_max_versions'], max_bytes=ws['backup_max_bytes'])
+
+    def _object_path(self, digest):
+        return self.objects_dir / digest[:2] / f'{digest}.gz'
+
+    def _journal_path(self, rel):
+        return self.journal_dir / (hashlib.blake2b(rel.encode('utf8'), digest_size=16).hexdigest() + '.jsonl')
+
+    def _read_journal(self, path):
+        try:
+            lines = path.read_text(encoding='utf8').splitlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # torn last line after a crash
+        return entries
+
+    def _write_journal(self, path, entries):
+        if not entries:
+            path.unlink(missing_ok=True)
+            return
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(''.join(json.dumps(e) + '\n' for e in entries), encoding='utf8')
+        os.replace(tmp, path)
+
+    def _store_bytes(self):
+        if self._bytes is None:
+            self._bytes = sum(p.stat().st_size for p in self.objects_dir.glob('*/*.gz')) if self.objects_dir.exists() else 0
+        return self._bytes
+
+    def save(self, rel, abspath, op='write'):
+        """Record the current content of abspath as a version of rel; None if there is no file"""
+        try:
+            data = pathlib.Path(abspath).read_bytes()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        with self._lock:
+            obj = self._object_path(digest)
+            if not obj.exists():
+                self._store_bytes()  # count existing objects before adding this one
+                obj.parent.mkdir(parents=True, exist_ok=True)
+                tmp = obj.with_name(obj.name + '.tmp')
+                tmp.write_bytes(gzip.compress(data, self.compress_level))
+                os.replace(tmp, obj)
+                self._bytes += obj.stat().st_size
+            journal = self._journal_path(rel)
+            entries = self._read_journal(journal)
+            if entries and entries[-1]['hash'] == digest:
+                return entries[-1]  # unchanged since the last backup
+            refs = self._refcounts()  # counted before the new entry is written
+            entry = {'seq': entries[-1]['seq'] + 1 if entries else 1, 'path': rel, 'hash': digest,
+                     'size': len(data), 'op': op, 'ts': datetime.now().isoformat()}
+            entries.append(entry)
+            self.journal_dir.mkdir(parents=True, exist_ok=True)
+            if len(entries) > self.max_versions:
+                self._write_journal(journal, entries[-self.max_versions:])
+                refs[digest] += 1
+                for old in entries[:-self.max_versions]:
+                    self._release(old['hash'])
+            else:
+                with open(journal, 'a', encoding='utf8') as fh:
+                    fh.write(json.dumps(entry) + '\n')
+                refs[digest] += 1
+            if self._store_bytes() > self.max_bytes:
+                self._shrink()
+            return entry
+
+    def history(self, rel):
+        """Saved versions of rel, newest first"""
+        return list(reversed(self._read_journal(self._journal_path(rel))))
+
+    def load(self, digest):
+        with gzip.open(self._object_path(digest), 'rb') as fh:
+            return fh.read()
+
+    def _journals(self):
+        if not self.journal_dir.exists():
+            return {}
+        return {p: self._read_journal(p) for p in self.journal_dir.glob('*.jsonl')}
+
+    def _refcounts(self, reload=False):
+        # hash -> number of journal entries that use it
+        if self._refs is None or reload:
+            self._refs = Counter(e['hash'] for entries in self._journals().values() for e in entries)
+        return self._refs
+
+    def _release(self, digest):
+        # One journal entry for digest is gone; delete the object with the last one.
+        refs = self._refcounts()
+        refs[digest] -= 1
+        if refs[digest] <= 0:
+            # Our counts only know our own writes: recount from the journals before deleting.
+            if self._refcounts(reload=True)[digest] > 0:
+                return
+            del self._refs[digest]
+            self._drop_object(digest)
+
+    def _drop_object(self, digest):
+        obj = self._object_path(digest)
+        try:
+            self._bytes = self._store_bytes() - obj.stat().st_size
+            obj.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _shrink(self):
+        # Drop the oldest versions store-wide, but keep each path's newest one.
+        journals = self._journals()
+        oldest = sorted((e['ts'], p) for p, entries in journals.items() for e in entries[:-1])
+        for _, path in oldest:
+            if self._store_bytes() <= self.max_bytes:
+                break
+            dropped, journals[path] = journals[path][0], journals[path][1:]
+            self._write_journal(path, journals[path])
+            self._release(dropped['hash'])
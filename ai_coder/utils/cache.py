@@ -0,0 +1,112 @@
+import os, gzip, json, time, hashlib, pathlib, threading
+from collections import OrderedDict
+
+class ResponseCache:
+    """Two-tier cache of chat responses: an in-memory LRU in front of gzip files on disk.
+
+    Entries are {'tokens': [...], 'result': {...}, 'created': <epoch>}. Disk
+    entries older than ttl seconds are ignored and removed; once the disk tier
+    grows past max_bytes the least recently used files are evicted.
+    """
+
+    def __init__(self, cache_dir, memory_entries=64, max_bytes=256 * 1024 * 1024, ttl=24 * 3600):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(body):
+        ident = {k: body.get(k) for k in ('model', 'messages', 'options', 'format')}
+        return hashlib.sha256(json.dumps(ident, sort_keys=True).encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json.gz"
+
+    def _expired(self, entry):
+        return self.ttl and time.time() - entry.get('created', 0) > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry):
+                    self._memory.move_to_end(key)
+                    return entry
+                del self._memory[key]
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rt', encoding='utf8') as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry):
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # mtime doubles as last-use time for eviction
+        except OSError:
+            pass
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, tokens, result):
+        entry = {'tokens': tokens, 'result': result, 'created': time.time()}
+        self._remember(key, entry)
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp, 'wt', encoding='utf8') as fh:
+            json.dump(entry, fh)
+        old = path.stat().st_size if path.exists() else 0
+        os.replace(tmp, path)
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(p.stat().st_size for p in self.cache_dir.glob('*/*.json.gz'))
+            else:
+                self._disk_bytes += path.stat().st_size - old
+            over = self._disk_bytes > self.max_bytes
+        if over:
+            self._evict()
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+
+    def _evict(self):
+        files = []
+        for p in self.cache_dir.glob('*/*.json.gz'):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        now = time.time()
+        for mtime, size, p in files:
+            if total <= self.max_bytes * 0.9 and not (self.ttl and now - mtime > self.ttl):
+                continue
+            try:
+                p.unlink()
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
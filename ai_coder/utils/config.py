@@ -0,0 +1,143 @@
+import os, sys, copy, pathlib
+
+try:
+    import yaml
+except ImportError:  # pyyaml is optional at runtime; fall back to built-in defaults
+    yaml = None
+
+# Built-in values for every setting the tools read; config files override them.
+# config/default.yaml is the annotated copy of these (tests keep the two in step).
+DEFAULTS = {
+    'ai': {
+        'api_url': 'http://127.0.0.1:11434',
+        'timeout': 120,
+        'connection_timeout': 15,
+        'max_connections': 10,
+        'max_keepalive_connections': 5,
+        'keepalive_expiry': 30,
+        'cache': {
+            'enabled': False,
+            'memory_entries': 64,
+            'max_bytes': 256 * 1024 * 1024,
+            'ttl': 86400,
+        },
+        'scheduler': {
+            'max_in_flight_per_model': 1,
+            'max_queue_depth': 32,
+            'per_model': {},
+        },
+        'max_tokens': 4000,
+        'max_context_length': 8000,
+        'context_cache_bytes': 16 * 1024 * 1024,
+        'chat_sessions': 32,
+    },
+    'workspace': {
+        'history_dir': '.codeas-history',
+        'max_history_files': 100,
+        'history_durability': 'flush',
+        'history_flush_interval': 0.2,
+        'history_flush_bytes': 65536,
+        'history_max_bytes': 8388608,
+        'history_compression': 'gzip',
+        'backup_on_edit': True,
+        'backup_directory': '.codeas_backups',
+        'backup_max_versions': 50,
+        'backup_max_bytes': 256 * 1024 * 1024,
+        'io_threads': 8,
+        'ignore_patterns': ['*.pyc', '__pycache__', '.git', 'node_modules', '.DS_Store', '*.log'],
+    },
+    'safety': {
+        'max_file_size': 10485760,
+        'fsync_writes': False,
+        'enable_shell': True,
+    },
+    'shell': {
+        'frame_interval_ms': 50,
+        'frame_max_bytes': 16384,
+        'tail_bytes': 65536,
+        'timeout': 0,
+        'max_output_bytes': 0,
+        'max_jobs': 0,
+        'max_queued_jobs': 64,
+        'job_buffer_bytes': 1048576,
+        'keep_finished_jobs': 50,
+        'max_sessions': 8,
+        'session_idle_timeout': 600,
+    },
+    'server': {
+        'coalesce_window_ms': 30,
+        'coalesce_max_bytes': 4096,
+        'output_queue_frames': 1024,
+        'output_overflow': 'merge',
+    },
+}
+
+def user_config_path():
+    if os.name == 'nt' and os.environ.get('APPDATA'):
+        base = pathlib.Path(os.environ['APPDATA'])
+    else:
+        base = pathlib.Path(os.environ.get('XDG_CONFIG_HOME') or pathlib.Path.home() / '.config')
+    return base / 'ai-coder' / 'config.yaml'
+
+def _candidates(root):
+    # CODEAS_CONFIG replaces both; otherwise the workspace file overrides the user's.
+    env = os.environ.get('CODEAS_CONFIG')
+    if env:
+        return [pathlib.Path(env)]
+    paths = [user_config_path()]
+    if root:
+        paths.append(pathlib.Path(root) / '.codeas' / 'config.yaml')
+    return paths
+
+def _warn(path, message):
+    print(f'codeas: ignoring {message} in {path}', file=sys.stderr)
+
+def _merge(base, override, path, prefix=''):
+    # Only keys shaped like the defaults are taken: a section must stay a mapping.
+    for key, value in override.items():
+        if isinstance(base.get(key), dict):
+            if isinstance(value, dict):
+                _merge(base[key], value, path, f'{prefix}{key}.')
+            else:
+                _warn(path, f"'{prefix}{key}' (expected a mapping, got {type(value).__name__})")
+        else:
+            base[key] = value
+    return base
+
+def load_config(root=None):
+    """Return DEFAULTS overlaid with the user's and then the workspace's config file"""
+    cfg = copy.deepcopy(DEFAULTS)
+    if yaml is None:
+        return cfg
+    for path in _candidates(root):
+        if not path.is_file():
+            continue
+        try:
+            with open(path, encoding='utf8') as fh:
+                data = yaml.safe_load(fh)
+        except (OSError, yaml.YAMLError) as e:
+            _warn(path, f'unreadable config ({e})')
+            continue
+        if data is None:
+            continue
+        if not isinstance(data, dict):
+            _warn(path, f'config that is not a mapping ({type(data).__name__})')
+            continue
+        _merge(cfg, data, path)
+    return cfg
+
+def section(cfg, dotted):
+    """Settings under dotted (e.g. 'ai.cache') with DEFAULTS filling in whatever cfg lacks"""
+    out = copy.deepcopy(cfg_get(DEFAULTS, dotted, {}))
+    node = cfg_get(cfg, dotted)
+    if isinstance(node, dict):
+        _merge(out, node, '<config>')
+    return out
+
+def cfg_get(cfg, dotted, default=None):
+    node = cfg
+    for part in dotted.split('.'):
+        if not isinstance(node, dict) or part not in node:
+            return default
+        node = node[part]
+    return node
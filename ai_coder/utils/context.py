@@ -0,0 +1,235 @@
+import os, re, threading
+from collections import OrderedDict
+from functools import lru_cache
+from utils.fsx import resolve_path_safe, read_head
+from utils.config import section
+
+# Word pieces longer than this count as several tokens, roughly like a BPE vocabulary.
+CHARS_PER_TOKEN = 4
+# A section is dropped rather than cut down to fewer tokens than this.
+MIN_SECTION_TOKENS = 32
+TRUNCATED_NOTE = '... [truncated]\n'
+# Role markers and separators a chat template adds around each message.
+MESSAGE_OVERHEAD = 4
+
+_PIECE_RE = re.compile(r'\w+|[^\w\s]')
+_CLOSERS = ')]}'
+
+@lru_cache(maxsize=16384)
+def _line_tokens(line):
+    return sum((len(p) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN for p in _PIECE_RE.findall(line)) + 1
+
+def estimate_tokens(text):
+    """Approximate token count of text.
+
+    Each line is costed once and cached, so re-estimating files that only
+    changed in a few places (or share boilerplate) is mostly cache hits.
+    """
+    return sum(_line_tokens(line) for line in text.splitlines(True))
+
+def message_tokens(message):
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD
+
+def evict_turns(turns, budget, keep=0.5):
+    """Drop the oldest chat turns once they pass budget tokens -> (kept, dropped).
+
+    Turns go in one batch until what is left fits keep * budget, so the
+    surviving messages remain an unchanged prefix for the next several turns
+    (which lets the model server reuse its prompt cache) instead of shifting
+    by one turn every time. The kept list never starts with an assistant reply.
+    """
+    costs = [message_tokens(m) for m in turns]
+    total = sum(costs)
+    if total <= budget:
+        return turns, []
+    i = 0
+    while i < len(turns) and (total > budget * keep or turns[i]['role'] == 'assistant'):
+        total -= costs[i]
+        i += 1
+    return turns[i:], turns[:i]
+
+def trim_partial_line(text):
+    """text up to its last newline, for content that was cut mid-line"""
+    return text[:text.rfind('\n') + 1]
+
+def _boundary(line):
+    # Cutting just before an unindented line keeps whole top-level functions/classes.
+    return bool(line.strip()) and not line[0].isspace() and line[0] not in _CLOSERS
+
+def cut_to_tokens(text, max_tokens):
+    """Longest prefix of text within max_tokens, ending on a line boundary -> (text, tokens).
+
+    When a top-level definition boundary (or failing that, a blank line) lies
+    in the second half of what fits, the cut is moved back to it so the kept
+    text does not end mid-function.
+    """
+    lines = text.splitlines(True)
+    used = n = 0
+    for line in lines:
+        cost = _line_tokens(line)
+        if used + cost > max_tokens:
+            break
+        used += cost
+        n += 1
+    if n < len(lines):
+        for fits in (lambda i: _boundary(lines[i]), lambda i: not lines[i].strip()):
+            cut = next((i for i in range(n, n // 2, -1) if fits(i)), None)
+            if cut is not None:
+                used -= sum(_line_tokens(line) for line in lines[cut:n])
+                n = cut
+                break
+    return ''.join(lines[:n]), used
+
+class ContextBuilder:
+    """Packs prompt sections into the model's context window.
+
+    The budget is share of max_context_length minus max_tokens, the part kept
+    for the reply, and minus reserve, tokens the caller sends outside the built
+    text (such as the user's message). Required sections always go in. The
+    rest are placed by descending priority (ties in the order added): first
+    every section that fits whole, then the others are cut, each to an equal
+    share of what is left, or dropped once that share is below
+    MIN_SECTION_TOKENS. A section's max_tokens caps what it may take; when the
+    caps add up to no more than the budget, each section comes out the same
+    whatever the others hold. build() returns the text in the order sections
+    were added plus a per-section token report.
+    """
+
+    def __init__(self, max_context_length=8000, max_tokens=4000, share=1.0, reserve=0):
+        self.max_context_length = max_context_length
+        self.max_tokens = max_tokens
+        self.budget = int(max(0, max_context_length - max_tokens - reserve) * share)
+        self.sections = []
+
+    @classmethod
+    def from_config(cls, cfg, share=1.0, reserve=0):
+        ai = section(cfg, 'ai')
+        return cls(max_context_length=ai['max_context_length'], max_tokens=ai['max_tokens'], share=share,
+                   reserve=reserve)
+
+    @property
+    def options(self):
+        """Ollama options that make the server's window match this budget"""
+        return {'num_ctx': self.max_context_length, 'num_predict': self.max_tokens}
+
+    def add(self, name, text, header='', priority=0, required=False, truncated=False, tokens=None,
+            max_tokens=None):
+        """Add a section; truncated marks text already cut short by the caller and
+        tokens, if known, is estimate_tokens(text) for text as given"""
+        if truncated and not text.endswith('\n'):
+            text, tokens = trim_partial_line(text), None
+        self.sections.append({'name': name, 'text': text, 'header': header, 'priority': priority,
+                              'required': required, 'truncated': truncated, 'tokens': tokens,
+                              'max_tokens': max_tokens})
+
+    def build(self):
+        """-> (text, report); report is {budget, used, sections: [{name, required, tokens, truncated, omitted}]}"""
+        left = self.budget
+        packed = {}
+        order = sorted(range(len(self.sections)),
+                       key=lambda i: (not self.sections[i]['required'], -self.sections[i]['priority'], i))
+        heads = {}
+        deferred = []
+        for i in order:
+            s = self.sections[i]
+            heads[i] = head = estimate_tokens(s['header'])
+            body = s['tokens'] if s['tokens'] is not None else estimate_tokens(s['text'])
+            cap = left if s['max_tokens'] is None else min(left, s['max_tokens'])
+            if s['required'] or (head + body <= cap and not s['truncated']):
+                packed[i] = (s['text'], head + body, False)
+                left -= head + body
+            else:
+                deferred.append(i)
+        # Sections that fit whole are all in; now the rest share what is left.
+        note = _line_tokens(TRUNCATED_NOTE)
+        for n, i in enumerate(deferred):
+            room = left // (len(deferred) - n)
+            if self.sections[i]['max_tokens'] is not None:
+                room = min(room, self.sections[i]['max_tokens'])
+            room -= heads[i] + note
+            if room < MIN_SECTION_TOKENS:
+                continue
+            text, used = cut_to_tokens(self.sections[i]['text'], room)
+            if text and not text.endswith('\n'):
+                text += '\n'
+            packed[i] = (text + TRUNCATED_NOTE, heads[i] + used + note, True)
+            left -= packed[i][1]
+        parts, report = [], []
+        for i, s in enumerate(self.sections):
+            if i not in packed:
+                report.append({'name': s['name'], 'required': False, 'tokens': 0, 'truncated': False, 'omitted': True})
+                continue
+            text, tokens, truncated = packed[i]
+            parts.append(s['header'] + text)
+            report.append({'name': s['name'], 'required': s['required'], 'tokens': tokens,
+                           'truncated': truncated, 'omitted': False})
+        return ''.join(parts), {'budget': self.budget, 'used': self.budget - left, 'sections': report}
+
+class ContextFileCache:
+    """Decoded context files kept between turns, keyed by path and validated by (mtime_ns, size).
+
+    An unchanged file costs one stat per lookup: its text, already trimmed to
+    the read budget, and its token estimate are reused. Once the cached text
+    passes max_bytes the least recently used files are evicted.
+    """
+
+    def __init__(self, root, max_bytes=16 * 1024 * 1024, max_file_size=10 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, root, cfg):
+        return cls(root, max_bytes=section(cfg, 'ai')['context_cache_bytes'],
+                   max_file_size=section(cfg, 'safety')['max_file_size'])
+
+    def read(self, path, max_chars=None):
+        """-> {'path', 'data', 'truncated', 'tokens'}; raises OSError/ValueError like a read"""
+        try:
+            st = os.stat(resolve_path_safe(self.root, path))
+        except OSError:
+            self.discard(path)
+            raise
+        stamp = (st.st_mtime_ns, st.st_size, max_chars)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['stamp'] == stamp:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry['item']
+        self.misses += 1
+        text, truncated = read_head(resolve_path_safe(self.root, path), max_chars, self.max_file_size)
+        if truncated:
+            text = trim_partial_line(text)
+        item = {'path': path, 'data': text, 'truncated': truncated, 'tokens': estimate_tokens(text)}
+        size = len(text.encode('utf8'))
+        with self._lock:
+            self._pop(path)
+            self._entries[path] = {'stamp': stamp, 'item': item, 'size': size}
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._pop(next(iter(self._entries)))
+        return item
+
+    def read_many(self, paths, max_chars=None):
+        """Like FileTools.read_many: a failing file gets an 'error' item instead of raising"""
+        items = []
+        for path in paths:
+            try:
+                items.append(self.read(path, max_chars))
+            except (OSError, ValueError) as e:
+                items.append({'path': path, 'error': str(e)})
+        return items
+
+    def discard(self, path):
+        with self._lock:
+            self._pop(path)
+
+    def _pop(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._bytes -= entry['size']
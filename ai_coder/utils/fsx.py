@@ -1,5 +1,11 @@
-import os, pathlib, shutil
-from datetime import datetime
+import os, mmap, pathlib, tempfile, contextlib
+
+# Read once at import: os.umask() can only be queried by setting it, which is not thread-safe.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Files at least this big are read through mmap so a range never loads the whole file.
+MMAP_MIN_BYTES = 1024 * 1024
 
 def ensure_dir(path):
     pathlib.Path(path).mkdir(parents=True, exist_ok=True)
@@ -11,12 +17,88 @@ def resolve_path_safe(root, target):
         raise ValueError('Path escapes root')
     return p
 
-def backup_file(backup_dir, file_path):
+def atomic_write(path, data, fsync=False):
+    """Replace path with data (str is written as UTF-8) via a temp file and rename.
+
+    Readers see either the old or the new content, never a partial file. With
+    fsync the data and the directory entry are flushed to disk before returning.
+    """
+    path = pathlib.Path(path)
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
     try:
-        ensure_dir(backup_dir)
-        stamp = datetime.utcnow().isoformat().replace(':','-').replace('.','-')
-        rel = pathlib.Path(file_path).name
-        dst = pathlib.Path(backup_dir) / f"{stamp}__{rel}"
-        shutil.copy2(file_path, dst)
-    except FileNotFoundError:
-        pass
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+            if fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp, 0o666 & ~_UMASK)  # mkstemp creates 0600; give new files the usual mode
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+    if fsync and hasattr(os, 'O_DIRECTORY'):
+        dfd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+@contextlib.contextmanager
+def open_buffer(path, size=None):
+    """Yield the file's bytes: an mmap for big files, a bytes object otherwise"""
+    size = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as fh:
+        if size < MMAP_MIN_BYTES:
+            yield fh.read()
+            return
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+def utf8_align(buf, begin, end):
+    """Shrink [begin, end) so it neither starts nor ends inside a UTF-8 sequence"""
+    while begin < end and buf[begin] & 0xC0 == 0x80:
+        begin += 1
+    while begin < end < len(buf) and buf[end] & 0xC0 == 0x80:
+        end -= 1
+    return begin, end
+
+def line_span(buf, start_line, end_line=None):
+    """Byte span of lines start_line..end_line (1-based, inclusive; None = to EOF)"""
+    begin = 0
+    for _ in range(start_line - 1):
+        nl = buf.find(b'\n', begin)
+        if nl < 0:
+            return len(buf), len(buf)
+        begin = nl + 1
+    if end_line is None:
+        return begin, len(buf)
+    end = begin
+    for _ in range(max(0, end_line - start_line + 1)):
+        nl = buf.find(b'\n', end)
+        if nl < 0:
+            return begin, len(buf)
+        end = nl + 1
+    return begin, end
+
+def read_head(path, max_chars=None, max_bytes=None):
+    """Decode the start of a file within max_chars characters and/or max_bytes bytes.
+
+    Only the needed prefix is read and a UTF-8 sequence is never split.
+    Returns (text, truncated).
+    """
+    limit = max_chars * 4 if max_chars is not None else max_bytes  # UTF-8 is at most 4 bytes a char
+    if max_bytes is not None:
+        limit = min(limit, max_bytes)
+    with open(path, 'rb') as fh:
+        buf = fh.read(limit + 1)
+    truncated = len(buf) > limit
+    text = buf[:utf8_align(buf, 0, min(len(buf), limit))[1]].decode('utf8')
+    if max_chars is not None and len(text) > max_chars:
+        text, truncated = text[:max_chars], True
+    return text, truncated
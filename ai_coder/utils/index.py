@@ -0,0 +1,175 @@
+import os, json, fnmatch, hashlib, pathlib, threading
+
+# Our own state directories are never part of the workspace.
+ALWAYS_IGNORE = ('.codeas-history', '.codeas_backups')
+
+def content_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+class WorkspaceIndex:
+    """Recursive index of a workspace, persisted as JSON between runs.
+
+    Entries are keyed by '/'-separated path relative to root and hold type,
+    size, mtime_ns and a content hash (files up to hash_max_bytes). Each
+    directory remembers its mtime and children, so refresh() only lists and
+    re-stats directories whose mtime changed. Files rewritten in place do not
+    change their directory's mtime; writers should call touch() for them, or
+    refresh(full=True) re-stats everything.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root, ignore_patterns=(), index_path=None, hash_max_bytes=10 * 1024 * 1024):
+        self.root = pathlib.Path(root).resolve()
+        self.ignore_patterns = tuple(ignore_patterns or ()) + ALWAYS_IGNORE
+        self.index_path = pathlib.Path(index_path) if index_path else None
+        self.hash_max_bytes = hash_max_bytes
+        self.dirs = {}
+        self.entries = {}
+        self._loaded = False
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def ignored(self, rel):
+        name = rel.rsplit('/', 1)[-1]
+        return any(fnmatch.fnmatch(name, pat) or fnmatch.fnmatch(rel, pat) for pat in self.ignore_patterns)
+
+    def rel(self, abspath):
+        rel = pathlib.Path(abspath).resolve().relative_to(self.root).as_posix()
+        return '' if rel == '.' else rel
+
+    def _load(self):
+        self._loaded = True
+        if not self.index_path or not self.index_path.exists():
+            return
+        try:
+            data = json.loads(self.index_path.read_text(encoding='utf8'))
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION and data.get('root') == str(self.root):
+            self.dirs = data.get('dirs', {})
+            self.entries = data.get('entries', {})
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self.index_path:
+                return
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_path.with_name(self.index_path.name + '.tmp')
+            data = {'version': self.VERSION, 'root': str(self.root), 'dirs': self.dirs, 'entries': self.entries}
+            tmp.write_text(json.dumps(data), encoding='utf8')
+            os.replace(tmp, self.index_path)
+            self._dirty = False
+
+    def refresh(self, under='', full=False):
+        """Bring the index up to date for the subtree at under and persist it;
+        raises FileNotFoundError if under does not exist"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if under and self.ignored(under):
+                return
+            try:
+                self._scan(under, full, top=True)
+            finally:
+                self.save()
+
+    def _scan(self, rel, full, top=False):
+        absdir = self.root / rel if rel else self.root
+        try:
+            st = os.stat(absdir)
+        except FileNotFoundError:
+            self._forget(rel)
+            if top:
+                raise
+            return
+        cached = self.dirs.get(rel)
+        if cached and cached['mtime_ns'] == st.st_mtime_ns and not full:
+            for name in cached['children']:
+                child = f'{rel}/{name}' if rel else name
+                if self.entries.get(child, {}).get('type') == 'dir':
+                    self._scan(child, full)
+            return
+        children = []
+        with os.scandir(absdir) as it:
+            for de in it:
+                child = f'{rel}/{de.name}' if rel else de.name
+                if self.ignored(child):
+                    continue
+                try:
+                    if de.is_dir(follow_symlinks=False):
+                        children.append(de.name)
+                        self.entries[child] = {'path': child, 'type': 'dir', 'size': 0,
+                                               'mtime_ns': de.stat(follow_symlinks=False).st_mtime_ns, 'hash': None}
+                        self._scan(child, full)
+                    elif de.is_file():
+                        children.append(de.name)
+                        self._stat_file(child, de.stat())
+                except OSError:
+                    continue
+        for name in (cached or {}).get('children', []):
+            if name not in children:
+                self._forget(f'{rel}/{name}' if rel else name)
+        self.dirs[rel] = {'mtime_ns': st.st_mtime_ns, 'children': sorted(children)}
+        self._dirty = True
+
+    def _stat_file(self, rel, st):
+        old = self.entries.get(rel)
+        if old and old['type'] == 'file' and old['size'] == st.st_size and old['mtime_ns'] == st.st_mtime_ns:
+            return
+        digest = None
+        if st.st_size <= self.hash_max_bytes:
+            try:
+                digest = content_hash(self.root / rel)
+            except OSError:
+                pass
+        self.entries[rel] = {'path': rel, 'type': 'file', 'size': st.st_size,
+                             'mtime_ns': st.st_mtime_ns, 'hash': digest}
+        self._dirty = True
+
+    def _forget(self, rel):
+        prefix = rel + '/'
+        for key in [k for k in self.entries if k == rel or k.startswith(prefix)]:
+            del self.entries[key]
+        for key in [k for k in self.dirs if k == rel or k.startswith(prefix)]:
+            del self.dirs[key]
+        self._dirty = True
+
+    def touch(self, abspath):
+        """Record a file created, rewritten or removed through our own tools"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            rel = self.rel(abspath)
+            if not rel or self.ignored(rel):
+                return
+            try:
+                st = os.stat(self.root / rel)
+            except FileNotFoundError:
+                self._forget(rel)
+                return
+            if os.path.isfile(self.root / rel):
+                self._stat_file(rel, st)
+
+    def list(self, under='', recursive=True, type_=None):
+        """Return entries below under (one level unless recursive), sorted by path"""
+        with self._lock:
+            prefix = under + '/' if under else ''
+            out = []
+            for path, entry in self.entries.items():
+                if not path.startswith(prefix) or path == under:
+                    continue
+                if not recursive and '/' in path[len(prefix):]:
+                    continue
+                if type_ and entry['type'] != type_:
+                    continue
+                out.append(dict(entry))
+            out.sort(key=lambda e: e['path'])
+            return out
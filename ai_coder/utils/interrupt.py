@@ -0,0 +1,18 @@
+import signal, asyncio
+
+async def run_cancellable(coro):
+    """Run coro so that Ctrl+C cancels it (and any server calls it awaits) instead of exiting"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coro)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        return await task  # no loop signal handlers (e.g. Windows)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        print("\n⏹️  Cancelled")
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
@@ -1,17 +1,286 @@
-import os, json, pathlib
+import os, re, gzip, json, time, queue, atexit, pathlib, threading
 from datetime import datetime
+from utils.config import section
+
+try:
+    import zstandard
+except ImportError:  # optional; gzip is used when zstandard is not installed
+    zstandard = None
+
+# Active segment: DAY.log; closed segments: DAY.NNN.log, then DAY.NNN.log.gz/.zst
+SEGMENT_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})(?:\.(\d+))?\.log(?:\.(gz|zst))?$')
+
+def _segment_key(name):
+    m = SEGMENT_RE.match(name)
+    if not m:
+        return None
+    seq = int(m.group(2)) if m.group(2) else float('inf')
+    return (m.group(1), seq)
+
+def list_segments(history_dir):
+    """Return history segment paths oldest first, one path per segment"""
+    found = {}
+    for p in pathlib.Path(history_dir).iterdir():
+        key = _segment_key(p.name)
+        if key is None:
+            continue
+        # A compressed copy only appears once it is complete, so it wins.
+        if key not in found or p.suffix in ('.gz', '.zst'):
+            found[key] = p
+    return [found[k] for k in sorted(found)]
+
+def open_segment(path):
+    """Open a plain or compressed segment as a text stream"""
+    path = pathlib.Path(path)
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rt', encoding='utf8')
+    if path.suffix == '.zst':
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is required to read {path.name}')
+        import io
+        raw = open(path, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), encoding='utf8')
+    return open(path, 'r', encoding='utf8')
 
 class HistoryLogger:
-    def __init__(self, history_dir):
+    """Append-only event log with a background writer thread.
+
+    append() only serializes and queues the line; the writer thread batches
+    queued lines and flushes them once flush_interval seconds have passed
+    since the first queued line or flush_bytes are pending. durability picks
+    what happens after each batch: 'none' leaves data in the file buffer,
+    'flush' hands it to the OS, 'fsync' also forces it to disk.
+
+    The active segment is DAY.log. It is sealed as DAY.NNN.log when the day
+    changes or it would grow past max_bytes; a maintenance thread then
+    compresses sealed segments and prunes all but the newest max_files.
+    """
+
+    DURABILITY = ('none', 'flush', 'fsync')
+
+    def __init__(self, history_dir, durability='flush', flush_interval=0.2, flush_bytes=64 * 1024,
+                 max_bytes=8 * 1024 * 1024, max_files=100, compression='gzip'):
+        if durability not in self.DURABILITY:
+            raise ValueError(f'Unknown durability policy: {durability}')
+        if compression == 'zstd' and zstandard is None:
+            compression = 'gzip'
         self.history_dir = history_dir
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.compression = compression
         pathlib.Path(self.history_dir).mkdir(parents=True, exist_ok=True)
+        self._maint = queue.Queue()
+        self._maint_thread = threading.Thread(target=self._maintain, name='history-maint', daemon=True)
+        self._maint_thread.start()
+        self._seal_stale()
+        self._cond = threading.Condition()
+        self._lines = []
+        self._pending_bytes = 0
+        self._first_at = 0.0
+        self._queued = 0
+        self._written = 0
+        self._closed = False
+        self._file = None
+        self._file_day = None
+        self._file_bytes = 0
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, history_dir, cfg):
+        ws = section(cfg, 'workspace')
+        return cls(
+            history_dir,
+            durability=ws['history_durability'],
+            flush_interval=ws['history_flush_interval'],
+            flush_bytes=ws['history_flush_bytes'],
+            max_bytes=ws['history_max_bytes'],
+            max_files=ws['max_history_files'],
+            compression=ws['history_compression'],
+        )
 
     def append(self, event, payload):
-        day = datetime.utcnow().strftime('%Y-%m-%d')
-        file = pathlib.Path(self.history_dir) / f"{day}.log"
-        line = json.dumps({'ts': datetime.utcnow().isoformat(), 'event': event, 'payload': payload}) + '\n'
-        if file.exists():
-            prev = file.read_text(encoding='utf8')
-            file.write_text(prev + line, encoding='utf8')
-        else:
-            file.write_text(line, encoding='utf8')
+        now = datetime.utcnow()
+        line = json.dumps({'ts': now.isoformat(), 'event': event, 'payload': payload}) + '\n'
+        day = now.strftime('%Y-%m-%d')
+        with self._cond:
+            if self._closed:
+                self._write([(day, line)])
+                self._close_file()
+                return
+            if not self._lines:
+                self._first_at = time.monotonic()
+                self._cond.notify_all()
+            self._lines.append((day, line))
+            self._pending_bytes += len(line)
+            self._queued += 1
+            if self._pending_bytes >= self.flush_bytes:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until every line appended so far has been written"""
+        with self._cond:
+            target = self._queued
+            self._first_at = 0.0
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        """Drain queued lines and stop the writer thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            self._close_file()
+        self._maint.put(None)
+        self._maint_thread.join()
+
+    def iter_events(self):
+        """Yield logged events oldest first, streaming compressed segments"""
+        self.flush()
+        for path in list_segments(self.history_dir):
+            try:
+                fh = open_segment(path)
+            except FileNotFoundError:
+                continue  # pruned or compressed while we were listing
+            with fh:
+                for line in fh:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._pending_bytes >= self.flush_bytes:
+                        break
+                    if self._lines:
+                        remaining = self._first_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                batch, self._lines = self._lines, []
+                self._pending_bytes = 0
+                closing = self._closed
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError:
+                    pass
+            with self._cond:
+                self._written += len(batch)
+                self._cond.notify_all()
+            if closing and not batch:
+                return
+
+    def _write(self, batch):
+        start = 0
+        while start < len(batch):
+            day = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] == day:
+                end += 1
+            data = ''.join(line for _, line in batch[start:end])
+            fh = self._open(day)
+            if self._file_bytes and self._file_bytes + len(data) > self.max_bytes:
+                self._seal()
+                fh = self._open(day)
+            fh.write(data)
+            self._file_bytes += len(data)
+            start = end
+        if self.durability != 'none':
+            self._file.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._file.fileno())
+
+    def _open(self, day):
+        if self._file is None or self._file_day != day:
+            if self._file is not None:
+                self._seal()
+            path = pathlib.Path(self.history_dir) / f"{day}.log"
+            self._file = open(path, 'a', encoding='utf8')
+            self._file_day = day
+            self._file_bytes = self._file.tell()
+        return self._file
+
+    def _seal(self, path=None):
+        """Close the active segment and hand it to the maintenance thread"""
+        if path is None:
+            path = pathlib.Path(self._file.name)
+            self._close_file()
+        day = path.name.split('.', 1)[0]
+        seq = 1 + max([k[1] for k in map(_segment_key, os.listdir(self.history_dir))
+                       if k and k[0] == day and k[1] != float('inf')] or [0])
+        sealed = path.with_name(f"{day}.{seq:03d}.log")
+        os.replace(path, sealed)
+        self._maint.put(sealed)
+
+    def _seal_stale(self):
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        for p in list_segments(self.history_dir):
+            key = _segment_key(p.name)
+            if key[1] == float('inf') and key[0] != today:
+                self._seal(p)
+            elif p.suffix == '.log' and key[1] != float('inf'):
+                self._maint.put(p)  # sealed but never compressed
+        self._maint.put('prune')
+
+    def _maintain(self):
+        while True:
+            item = self._maint.get()
+            if item is None:
+                return
+            try:
+                if item != 'prune':
+                    self._compress(item)
+                self._prune()
+            except OSError:
+                pass
+
+    def _compress(self, path):
+        if self.compression not in ('gzip', 'zstd') or not path.exists():
+            return
+        ext = '.gz' if self.compression == 'gzip' else '.zst'
+        dst = path.with_name(path.name + ext)
+        tmp = path.with_name(path.name + ext + '.tmp')
+        with open(path, 'rb') as src, open(tmp, 'wb') as raw:
+            if ext == '.gz':
+                with gzip.GzipFile(fileobj=raw, mode='wb') as out:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+            else:
+                zstandard.ZstdCompressor().copy_stream(src, raw)
+        os.replace(tmp, dst)
+        path.unlink()
+
+    def _prune(self):
+        if not self.max_files:
+            return
+        # Only sealed segments are counted, against all but one slot: the active
+        # segment keeps that slot even in the moment between a seal and its reopening.
+        sealed = [p for p in list_segments(self.history_dir) if _segment_key(p.name)[1] != float('inf')]
+        for p in sealed[:max(0, len(sealed) - (self.max_files - 1))]:
+            for stale in pathlib.Path(self.history_dir).glob(p.name.split('.log')[0] + '.log*'):
+                stale.unlink(missing_ok=True)
+
+    def _close_file(self):
+        if self._file is not None:
+            if self.durability == 'fsync':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._file_day = None
+            self._file_bytes = 0
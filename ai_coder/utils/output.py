@@ -0,0 +1,219 @@
+import sys, json, asyncio
+from collections import deque
+
+class FrameWriter:
+    """Single owner of the server's stdout.
+
+    Frames are serialised when queued, so an unserialisable payload raises in
+    the caller, and a writer task sends them in batches, awaiting the pipe's
+    drain() so a slow reader never blocks the event loop. send() waits while
+    max_frames are queued; offer() never waits and, once the queue is full,
+    handles progress frames per overflow policy: 'merge' folds them into the
+    last queued progress frame of the same request when possible, 'drop'
+    discards them, 'block' queues them. Producers that await
+    wait_progress() between frames (see backpressure()) are held while the
+    queue is full under 'block', and under 'merge' once a frame that could
+    not be merged went past max_frames. Result frames are never dropped.
+    """
+
+    OVERFLOW = ('block', 'merge', 'drop')
+
+    def __init__(self, stream=None, max_frames=1024, overflow='merge', batch_frames=256):
+        if overflow not in self.OVERFLOW:
+            raise ValueError(f'Unknown overflow policy: {overflow}')
+        self.stream = stream or sys.stdout
+        self.max_frames = max_frames
+        self.overflow = overflow
+        self.batch_frames = batch_frames
+        self.dropped = 0
+        self.merged = 0
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._pipe = None
+        self._task = None
+        self._closing = False
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, self.stream)
+            self._pipe = asyncio.StreamWriter(transport, protocol, None, loop)
+        except (ValueError, OSError):
+            self._pipe = None  # regular file etc.: fall back to blocking writes in a thread
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def full(self):
+        return len(self._queue) >= self.max_frames
+
+    async def wait_for_space(self):
+        while self.full:
+            self._space.clear()
+            await self._space.wait()
+
+    def _holds_progress(self):
+        if self.overflow == 'drop':
+            return False
+        if self.overflow == 'merge':
+            return len(self._queue) > self.max_frames
+        return self.full
+
+    async def wait_progress(self):
+        """Wait until the overflow policy lets another progress frame in without loss or growth"""
+        while self._holds_progress():
+            self._space.clear()
+            await self._space.wait()
+
+    async def send(self, frame):
+        await self.wait_for_space()
+        self._push(frame)
+
+    def offer(self, frame):
+        if self.full and frame.get('type') == 'progress':
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return
+            if self.overflow == 'merge' and self._merge(frame):
+                self.merged += 1
+                return
+        self._push(frame)
+
+    def _push(self, frame):
+        # [frame, encoded line]; encoding here raises TypeError/ValueError in the caller.
+        self._queue.append([frame, self._encode(frame)])
+        self._wakeup.set()
+
+    @staticmethod
+    def _encode(frame):
+        return json.dumps(frame) + '\n'
+
+    def _merge(self, frame):
+        # Only the newest queued frame of the same request may absorb this one,
+        # otherwise frames of that request would be reordered.
+        for entry in reversed(self._queue):
+            queued = entry[0]
+            if queued.get('id') != frame.get('id'):
+                continue
+            if queued.get('type') != 'progress':
+                return False
+            old, new = queued.get('payload'), frame.get('payload')
+            if not (isinstance(old, dict) and isinstance(new, dict)):
+                return False
+            if set(old) == set(new) == {'message'}:
+                payload = {'message': old['message'] + new['message']}
+            elif set(old) == set(new) == {'stream', 'output'} and old['stream'] == new['stream']:
+                payload = {'stream': old['stream'], 'output': old['output'] + new['output']}
+            else:
+                return False
+            merged = dict(queued, payload=payload)
+            entry[1] = self._encode(merged)
+            entry[0] = merged
+            return True
+        return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = []
+            while self._queue and len(batch) < self.batch_frames:
+                batch.append(self._queue.popleft()[1])
+            data = ''.join(batch).encode('utf8')
+            try:
+                if self._pipe is not None:
+                    self._pipe.write(data)
+                    await self._pipe.drain()
+                else:
+                    await loop.run_in_executor(None, self._write_blocking, data)
+            except (ConnectionError, OSError):
+                # Reader went away: discard output so producers never wait on it.
+                self.max_frames = float('inf')
+                self._queue.clear()
+            if not self.full:
+                self._space.set()
+
+    def _write_blocking(self, data):
+        out = getattr(self.stream, 'buffer', self.stream)
+        out.write(data)
+        out.flush()
+
+    async def close(self):
+        """Write out everything still queued and stop the writer task"""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._pipe is not None:
+            # drain() only waits for the high-water mark; wait for an empty buffer.
+            self._pipe.transport.set_write_buffer_limits(0)
+            try:
+                await self._pipe.drain()
+            except (ConnectionError, OSError):
+                pass
+
+class Progress:
+    """A progress callback that also tells its producer when to pause.
+
+    Calling it emits a payload as before; wait_for_space, if set, is awaited
+    by backpressure() so streaming tools slow down to the client's pace.
+    """
+
+    def __init__(self, emit, wait_for_space=None):
+        self.emit = emit
+        self.wait_for_space = wait_for_space
+
+    def __call__(self, payload):
+        self.emit(payload)
+
+async def backpressure(progress_cb):
+    """Wait until progress_cb's output can take more frames; a no-op for plain callables"""
+    wait = getattr(progress_cb, 'wait_for_space', None)
+    if wait is not None:
+        await wait()
+
+class Coalescer:
+    """Merges consecutive message tokens of one request into fewer progress frames.
+
+    Tokens are held until window_ms has passed since the first of them or
+    max_bytes have built up, then emitted as one {'message'} payload. Any
+    other payload flushes the held tokens first, so order is kept.
+    """
+
+    def __init__(self, emit, window_ms=30, max_bytes=4096):
+        self.emit = emit
+        self.window = max(0, window_ms) / 1000.0
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self.timer = None
+
+    def push(self, payload):
+        if not (isinstance(payload, dict) and list(payload) == ['message'] and isinstance(payload['message'], str)):
+            # Anything other than a plain token keeps its place in the stream.
+            self.flush()
+            self.emit(payload)
+            return
+        self.parts.append(payload['message'])
+        self.size += len(payload['message'])
+        if self.size >= self.max_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts = []
+            self.size = 0
+            self.emit({'message': text})
@@ -0,0 +1,196 @@
+import re
+from utils.search import compile_pattern
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+class PatchConflict(ValueError):
+    """The file no longer matches what the patch was made against"""
+
+def diff_target(diff):
+    """Path named by the diff's '+++' header (without a/ b/ prefix), or None"""
+    for line in diff.splitlines():
+        if line.startswith('+++ '):
+            name = line[4:].split('\t')[0].strip()
+            if name == '/dev/null':
+                return None
+            return name[2:] if name.startswith(('a/', 'b/')) else name
+        if line.startswith('@@'):
+            break
+    return None
+
+def parse_unified_diff(diff):
+    """Split a single-file unified diff into hunks of {old_start, old, new} line lists.
+
+    Raises ValueError if a second file's header follows the first file's hunks.
+    """
+    hunks = []
+    cur = None
+    old_left = new_left = 0
+    last = None
+    for line in diff.splitlines(keepends=True):
+        if cur is None or (old_left <= 0 and new_left <= 0):
+            m = HUNK_RE.match(line)
+            if m:
+                cur = {'old_start': int(m[1]), 'old': [], 'new': []}
+                old_left = int(m[2]) if m[2] is not None else 1
+                new_left = int(m[4]) if m[4] is not None else 1
+                hunks.append(cur)
+            elif line.startswith('\\') and cur is not None:
+                _strip_newline(cur, last)
+            elif hunks and line.startswith(('--- ', '+++ ')):
+                # Another file's header: its hunks must not be applied to this file.
+                raise ValueError('Diff changes more than one file; send one diff per file')
+            continue
+        if line.startswith('\\'):
+            _strip_newline(cur, last)
+            continue
+        tag, body = line[:1], line[1:]
+        if tag in ('\n', '\r'):
+            tag, body = ' ', line  # context line whose leading space was trimmed
+        if tag == ' ':
+            cur['old'].append(body)
+            cur['new'].append(body)
+            old_left -= 1
+            new_left -= 1
+        elif tag == '-':
+            cur['old'].append(body)
+            old_left -= 1
+        elif tag == '+':
+            cur['new'].append(body)
+            new_left -= 1
+        else:
+            raise ValueError(f'Malformed diff line: {line!r}')
+        last = tag
+    if not hunks:
+        raise ValueError('Diff contains no hunks')
+    return hunks
+
+def _strip_newline(hunk, tag):
+    # "\ No newline at end of file" refers to the line just before it.
+    for key in {' ': ('old', 'new'), '-': ('old',), '+': ('new',)}.get(tag, ()):
+        if hunk[key]:
+            hunk[key][-1] = hunk[key][-1].rstrip('\r\n')
+
+def apply_unified_diff(text, diff):
+    """Apply diff to text. Hunks may have drifted; each is matched at its line number
+    or the nearest place its context and removed lines still appear. Raises
+    PatchConflict, without changing anything, if any hunk cannot be placed."""
+    lines = text.splitlines(keepends=True)
+    out, pos, conflicts = [], 0, []
+    for n, hunk in enumerate(parse_unified_diff(diff), 1):
+        old = hunk['old']
+        expected = hunk['old_start'] if not old else hunk['old_start'] - 1
+        at = _locate(lines, old, max(pos, min(expected, len(lines))), pos)
+        if at is None:
+            conflicts.append(f"hunk {n} (line {hunk['old_start']})")
+            continue
+        out.extend(lines[pos:at])
+        out.extend(hunk['new'])
+        pos = at + len(old)
+    if conflicts:
+        raise PatchConflict('Patch does not apply: ' + ', '.join(conflicts))
+    out.extend(lines[pos:])
+    return ''.join(out)
+
+def _locate(lines, old, expected, lowest):
+    # Search outwards from the expected line, never before the previous hunk's end.
+    if not old:
+        return expected
+    last = len(lines) - len(old)
+    for delta in range(0, max(expected - lowest, last - expected) + 1):
+        for at in (expected - delta, expected + delta) if delta else (expected,):
+            if lowest <= at <= last and lines[at:at + len(old)] == old:
+                return at
+    return None
+
+def apply_line_edits(text, edits):
+    """Apply [{start_line, end_line, text, expect}] replacements (1-based, inclusive).
+
+    end_line = start_line - 1 inserts before start_line. Line numbers refer to
+    the original text. An edit with 'expect' conflicts unless those lines still
+    read exactly that; overlapping edits are rejected.
+    """
+    lines = text.splitlines(keepends=True)
+    spans = []
+    for e in edits:
+        start = int(e['start_line'])
+        end = int(e.get('end_line', start))
+        if start < 1 or end < start - 1 or end > len(lines):
+            raise PatchConflict(f'Lines {start}-{end} are outside the file ({len(lines)} lines)')
+        if 'expect' in e and ''.join(lines[start - 1:end]) != e['expect']:
+            raise PatchConflict(f'Lines {start}-{end} do not match the expected text')
+        spans.append((start, end, e.get('text', '')))
+    spans.sort(key=lambda s: (s[0], s[1]))
+    for (s1, e1, _), (s2, e2, _) in zip(spans, spans[1:]):
+        if s2 <= e1:
+            raise PatchConflict(f'Edits at lines {s1}-{e1} and {s2}-{e2} overlap')
+    for start, end, new in reversed(spans):
+        if new and not new.endswith('\n') and (end < len(lines) or (end and lines[end - 1].endswith('\n'))):
+            new += '\n'
+        lines[start - 1:end] = [new] if new else []
+    return ''.join(lines)
+
+def apply_replacements(text, edits):
+    """Apply ordered [{search, replace, regex, ignore_case, limit}] edits to text.
+
+    Each run of consecutive plain literal edits is one pass with a single
+    alternation of all their patterns, longest first so a pattern never loses
+    to its own prefix, so edits within a run never see each other's output.
+    regex and ignore_case edits get a pass of their own. limit caps the replacements
+    made by that edit; once a search is used up, shorter searches may match where
+    it would have. Returns (text, counts).
+    """
+    counts = [0] * len(edits)
+    for k, e in enumerate(edits):
+        if not e.get('search'):
+            raise ValueError(f'Edit {k + 1}: search must not be empty')
+    i = 0
+    while i < len(edits):
+        if edits[i].get('regex') or edits[i].get('ignore_case'):
+            e = edits[i]
+            rx = compile_pattern(e['search'], not e.get('regex'), e.get('ignore_case', False))
+            replace = e.get('replace', '')
+            if not e.get('regex'):
+                replace = replace.replace('\\', '\\\\')  # literal replacement, no group references
+            text, counts[i] = rx.subn(replace, text, count=e.get('limit') or 0)
+            i += 1
+            continue
+        j = i
+        while j < len(edits) and not (edits[j].get('regex') or edits[j].get('ignore_case')):
+            j += 1
+        text = _literal_pass(text, edits, range(i, j), counts)
+        i = j
+    return text, counts
+
+def _literal_pass(text, edits, indexes, counts):
+    owners = {}
+    for k in indexes:
+        owners.setdefault(edits[k]['search'], []).append(k)
+
+    def _free(k):
+        limit = edits[k].get('limit')
+        return not limit or counts[k] < limit
+
+    def _alternation():
+        # Only searches with an edit left to make, longest first. Once a search is used
+        # up the pattern is rebuilt, so shorter searches get the text it used to claim.
+        live = [s for s, ks in owners.items() if any(_free(k) for k in ks)]
+        return re.compile('|'.join(re.escape(s) for s in sorted(live, key=len, reverse=True))) if live else None
+
+    out, pos = [], 0
+    rx = _alternation()
+    while rx is not None:
+        m = rx.search(text, pos)
+        if m is None:
+            break
+        # Edits with the same search take turns: the next one starts once the first hits its limit.
+        ks = owners[m.group(0)]
+        k = next(k for k in ks if _free(k))
+        counts[k] += 1
+        out.append(text[pos:m.start()])
+        out.append(edits[k].get('replace', ''))
+        pos = m.end()
+        if not any(_free(k) for k in ks):
+            rx = _alternation()
+    out.append(text[pos:])
+    return ''.join(out)
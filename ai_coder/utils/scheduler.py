@@ -0,0 +1,80 @@
+import asyncio, heapq, itertools
+from utils.config import section
+
+class QueueFull(Exception):
+    pass
+
+class ModelScheduler:
+    """Admission control for model requests.
+
+    At most max_in_flight requests per model run at once (per_model overrides
+    the limit for individual models). Others wait in a per-model queue ordered
+    by priority ('interactive' before 'batch') and then arrival, receive
+    {'queue': {...}} progress updates as their position changes, and are
+    rejected with QueueFull once max_queue requests are already waiting.
+    """
+
+    PRIORITIES = {'interactive': 0, 'batch': 1}
+
+    def __init__(self, max_in_flight=1, max_queue=32, per_model=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.per_model = per_model or {}
+        self._running = {}
+        self._waiting = {}
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_config(cls, cfg):
+        sched = section(cfg, 'ai.scheduler')
+        return cls(max_in_flight=sched['max_in_flight_per_model'],
+                   max_queue=sched['max_queue_depth'],
+                   per_model=sched['per_model'])
+
+    def _limit(self, model):
+        return self.per_model.get(model, self.max_in_flight)
+
+    async def acquire(self, model, priority='interactive', progress_cb=lambda p: None):
+        waiting = self._waiting.setdefault(model, [])
+        if self._running.get(model, 0) < self._limit(model) and not waiting:
+            self._running[model] = self._running.get(model, 0) + 1
+            return
+        if len(waiting) >= self.max_queue:
+            raise QueueFull(f'Queue for {model} is full ({self.max_queue} waiting)')
+        fut = asyncio.get_running_loop().create_future()
+        # [priority, arrival, future, progress_cb, last announced position]
+        entry = [self.PRIORITIES.get(priority, 0), next(self._seq), fut, progress_cb, None]
+        heapq.heappush(waiting, entry)
+        self._announce(model)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(model)  # slot was granted just as we were cancelled
+            elif entry in waiting:
+                waiting.remove(entry)
+                heapq.heapify(waiting)
+                self._announce(model)
+            raise
+
+    def release(self, model):
+        self._running[model] = self._running.get(model, 1) - 1
+        waiting = self._waiting.get(model, [])
+        while waiting and self._running[model] < self._limit(model):
+            fut = heapq.heappop(waiting)[2]
+            if fut.done():
+                continue
+            self._running[model] += 1
+            fut.set_result(True)
+        self._announce(model)
+
+    def _announce(self, model):
+        waiting = self._waiting.get(model, [])
+        for position, entry in enumerate(sorted(waiting), 1):
+            if entry[2].done() or entry[4] == position:
+                continue
+            entry[4] = position
+            try:
+                entry[3]({'queue': {'model': model, 'position': position}})
+            except Exception:
+                pass
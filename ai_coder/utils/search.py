@@ -0,0 +1,49 @@
+import re
+
+# Files whose first block contains a NUL byte are treated as binary and skipped.
+BINARY_SNIFF_BYTES = 8192
+
+def compile_pattern(pattern, literal=False, ignore_case=False):
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    return re.compile(re.escape(pattern) if literal else pattern, flags)
+
+def search_files(root, paths, pattern, literal=False, ignore_case=False, max_matches=1000, max_line_len=400):
+    """Search paths (relative to root) and return per-file match lists.
+
+    Top-level so it can run in a worker process. Stops after max_matches.
+    """
+    rx = compile_pattern(pattern, literal, ignore_case)
+    needle = pattern.lower() if ignore_case else pattern
+    results = []
+    total = 0
+    for rel in paths:
+        try:
+            with open(f'{root}/{rel}', 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            continue
+        if b'\0' in data[:BINARY_SNIFF_BYTES]:
+            continue
+        text = data.decode('utf8', 'replace')
+        if literal and needle not in (text.lower() if ignore_case else text):
+            continue
+        matches = []
+        line, pos = 1, 0
+        for m in rx.finditer(text):
+            start = m.start()
+            line += text.count('\n', pos, start)
+            pos = start
+            line_start = text.rfind('\n', 0, start) + 1
+            line_end = text.find('\n', start)
+            if line_end < 0:
+                line_end = len(text)
+            matches.append({'line': line, 'column': start - line_start + 1,
+                            'text': text[line_start:line_end][:max_line_len]})
+            total += 1
+            if total >= max_matches:
+                break
+        if matches:
+            results.append({'path': rel, 'matches': matches})
+        if total >= max_matches:
+            break
+    return results
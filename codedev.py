@@ -6,7 +6,6 @@ Simple, interactive coding assistant with AI
 
 import os
 import sys
-import json
 import asyncio
 import subprocess
 from pathlib import Path
@@ -14,10 +13,19 @@ from pathlib import Path
 # Add ai_coder to path
 sys.path.insert(0, str(Path(__file__).parent / "ai_coder"))
 
+from client import MCPClient
+from utils.interrupt import run_cancellable
+
 class CodeDev:
     def __init__(self):
         self.workspace = os.getcwd()
         self.running = False
+        # One long-lived server process shared by every tool call
+        self.server = MCPClient(
+            Path(__file__).parent / "ai_coder" / "server.py",
+            cwd=Path(__file__).parent,
+            env={'CODEAS_ROOT': self.workspace}
+        )
         
     def print_banner(self):
         """Print welcome banner"""
@@ -59,71 +67,29 @@ class CodeDev:
         
         return True, "Setup OK"
     
-    def call_mcp_server(self, tool, input_data):
-        """Call the MCP server and get response"""
-        import uuid
-        
-        request = {
-            "id": str(uuid.uuid4()),
-            "tool": tool,
-            "input": input_data
-        }
-        
+    def _print_progress(self, payload):
+        """Print streamed AI tokens, hiding <think> markers"""
+        message = payload.get('message')
+        if message and not message.startswith('<think>') and not message.startswith('</think>'):
+            print(message, end='', flush=True)
+    
+    async def call_mcp_server(self, tool, input_data, progress_cb=None):
+        """Call the MCP server over the shared session and get response"""
         try:
-            # Start MCP server process
-            proc = subprocess.Popen(
-                [sys.executable, "ai_coder/server.py"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                cwd=Path(__file__).parent
-            )
-            
-            # Send request
-            request_json = json.dumps(request)
-            proc.stdin.write(request_json + "\n")
-            proc.stdin.flush()
-            
-            # Collect response
-            response_parts = []
-            while True:
-                line = proc.stdout.readline()
-                if not line:
-                    break
-                    
-                try:
-                    response = json.loads(line.strip())
-                    if response.get('type') == 'progress':
-                        payload = response.get('payload', {})
-                        if 'message' in payload:
-                            message = payload['message']
-                            if not message.startswith('<think>') and not message.startswith('</think>'):
-                                print(message, end='', flush=True)
-                    elif response.get('type') == 'result':
-                        if response.get('id') == request['id']:
-                            proc.terminate()
-                            return response.get('payload', {})
-                except json.JSONDecodeError:
-                    continue
-                except:
-                    break
-            
-            proc.terminate()
-            return {}
-            
+            response = await self.server.call(tool, input_data, progress_cb=progress_cb or self._print_progress)
+            return response.get('payload', {})
         except Exception as e:
             print(f"❌ Error calling server: {e}")
             return {}
     
-    async def ask_ai(self, question, context_files=None):
-        """Ask AI a question with context"""
+    async def ask_ai(self, question, context_files=None, cache=False):
+        """Ask AI a question with context (cache=True reuses replies to identical prompts)"""
         # Build context
         context = ""
         workspace_info = ""
         
         # Get workspace context
-        files_result = self.call_mcp_server("fs.list", {"dir": "."})
+        files_result = await self.call_mcp_server("fs.list", {"dir": "."})
         if files_result:
             file_types = {}
             for item in files_result:
@@ -138,10 +104,11 @@ class CodeDev:
         # Add file context if specified
         if context_files:
             context += "\n=== RELEVANT FILES ===\n"
-            for file_path in context_files[:3]:  # Limit to 3 files
-                file_data = self.call_mcp_server("fs.read", {"path": file_path})
+            paths = context_files[:3]  # Limit to 3 files
+            batch = await self.call_mcp_server("fs.read_many", {"paths": paths, "max_chars": 2000})
+            for file_data in batch.get('files', []):
                 if file_data.get('data'):
-                    context += f"\n--- {file_path} ---\n{file_data['data'][:2000]}\n"
+                    context += f"\n--- {file_data['path']} ---\n{file_data['data']}\n"
         
         # Enhanced system prompt for better responses
         system_prompt = """You are CodeDev, an advanced AI coding assistant. You help developers with:
@@ -177,18 +144,19 @@ Always provide helpful, detailed responses that demonstrate deep understanding o
         request_data = {
             'prompt': full_prompt,
             'system': system_prompt,
-            'model': 'deepseek-r1:8b'
+            'model': 'deepseek-r1:8b',
+            'cache': cache
         }
         
         print("\n🤖 CodeDev AI: ", end="")
-        result = self.call_mcp_server("ollama.chat", request_data)
+        result = await self.call_mcp_server("ollama.chat", request_data)
         print("\n")
         
         return result
     
     async def list_files(self, directory="."):
         """List files in directory"""
-        result = self.call_mcp_server("fs.list", {"dir": directory})
+        result = await self.call_mcp_server("fs.list", {"dir": directory})
         
         if result:
             print(f"\n📁 Files in {directory}:")
@@ -200,7 +168,7 @@ Always provide helpful, detailed responses that demonstrate deep understanding o
     
     async def read_file(self, file_path):
         """Read and display file"""
-        result = self.call_mcp_server("fs.read", {"path": file_path})
+        result = await self.call_mcp_server("fs.read", {"path": file_path})
         
         if result.get('data'):
             print(f"\n📄 {file_path}:")
@@ -212,7 +180,7 @@ Always provide helpful, detailed responses that demonstrate deep understanding o
     
     async def create_file(self, file_path, content):
         """Create a new file"""
-        result = self.call_mcp_server("fs.write", {"path": file_path, "data": content})
+        result = await self.call_mcp_server("fs.write", {"path": file_path, "data": content})
         
         if result.get('ok'):
             print(f"✅ Created {file_path}")
@@ -224,7 +192,7 @@ Always provide helpful, detailed responses that demonstrate deep understanding o
         print("🔍 Analyzing codebase...")
         
         # Get file list
-        files_result = self.call_mcp_server("fs.list", {"dir": "."})
+        files_result = await self.call_mcp_server("fs.list", {"dir": "."})
         
         if not files_result:
             print("❌ Could not access files")
@@ -266,13 +234,14 @@ Always provide helpful, detailed responses that demonstrate deep understanding o
         key_files_content = ""
         key_files = (config_files + code_files)[:5]  # Analyze top 5 important files
         
-        for file_path in key_files:
-            file_data = self.call_mcp_server("fs.read", {"path": file_path})
+        batch = await self.call_mcp_server("fs.read_many", {"paths": key_files, "max_chars": 3000})
+        for file_data in batch.get('files', []):
+            file_path = file_data['path']
             if file_data.get('data'):
                 content = file_data['data']
-                # Truncate very long files
-                if len(content) > 3000:
-                    content = content[:3000] + "\n... (truncated)"
+                # Only the head of very long files was read
+                if file_data.get('truncated'):
+                    content += "\n... (truncated)"
                 key_files_content += f"\n=== {file_path} ===\n{content}\n"
         
         analysis_prompt = f"""Please analyze this codebase comprehensively:
@@ -305,16 +274,18 @@ Please provide a detailed analysis covering:
 Provide actionable insights that would help a developer understand and improve this codebase."""
         
         # Use enhanced AI response
-        await self.ask_ai(analysis_prompt)
+        await self.ask_ai(analysis_prompt, cache=True)
     
     async def run_command(self, command):
         """Run shell command"""
         print(f"🔧 Running: {command}")
         
-        result = self.call_mcp_server("shell.run", {"cmd": command, "cwd": self.workspace})
+        result = await self.call_mcp_server("shell.run", {"cmd": command, "cwd": self.workspace})
         
         if result.get('ok'):
             print(f"✅ Command completed (exit code: {result.get('code', 0)})")
+        elif result.get('killed'):
+            print(f"⏱️  Command stopped: {result['killed']} limit reached")
         else:
             print(f"❌ Command failed (exit code: {result.get('code', 1)})")
     
@@ -373,27 +344,27 @@ Provide actionable insights that would help a developer understand and improve t
     
     async def quick_review(self):
         """Quick code review"""
-        await self.ask_ai("Please perform a quick code review of this project. Focus on code quality, potential issues, and improvement suggestions.")
+        await self.ask_ai("Please perform a quick code review of this project. Focus on code quality, potential issues, and improvement suggestions.", cache=True)
     
     async def security_scan(self):
         """Security vulnerability scan"""
-        await self.ask_ai("Please scan this codebase for potential security vulnerabilities, including common issues like SQL injection, XSS, insecure dependencies, and poor authentication/authorization patterns.")
+        await self.ask_ai("Please scan this codebase for potential security vulnerabilities, including common issues like SQL injection, XSS, insecure dependencies, and poor authentication/authorization patterns.", cache=True)
     
     async def optimize_suggestions(self):
         """Performance optimization suggestions"""
-        await self.ask_ai("Please analyze this codebase for performance optimization opportunities. Look for inefficient algorithms, database queries, memory usage, and suggest improvements.")
+        await self.ask_ai("Please analyze this codebase for performance optimization opportunities. Look for inefficient algorithms, database queries, memory usage, and suggest improvements.", cache=True)
     
     async def test_suggestions(self):
         """Generate test suggestions"""
-        await self.ask_ai("Please analyze this codebase and suggest a comprehensive testing strategy. Include unit tests, integration tests, and specific test cases for the main functions.")
+        await self.ask_ai("Please analyze this codebase and suggest a comprehensive testing strategy. Include unit tests, integration tests, and specific test cases for the main functions.", cache=True)
     
     async def deploy_guidance(self):
         """Deployment guidance"""
-        await self.ask_ai("Please provide deployment guidance for this project. Include setup instructions, environment configuration, dependencies, and best practices for production deployment.")
+        await self.ask_ai("Please provide deployment guidance for this project. Include setup instructions, environment configuration, dependencies, and best practices for production deployment.", cache=True)
     
     async def docs_assistance(self):
         """Documentation assistance"""
-        await self.ask_ai("Please help improve the documentation for this project. Suggest what documentation is missing, how to improve existing docs, and provide templates for API documentation or README improvements.")
+        await self.ask_ai("Please help improve the documentation for this project. Suggest what documentation is missing, how to improve existing docs, and provide templates for API documentation or README improvements.", cache=True)
     
     async def handle_input(self, user_input):
         """Handle user input"""
@@ -497,8 +468,10 @@ Provide actionable insights that would help a developer understand and improve t
         while self.running:
             try:
                 user_input = input("\n🚀 codedev> ").strip()
-                if user_input:
-                    await self.handle_input(user_input)
+                if user_input.split(' ', 1)[0].lower() == 'create':
+                    await self.handle_input(user_input)  # reads file content from stdin
+                elif user_input:
+                    await run_cancellable(self.handle_input(user_input))
                     
             except KeyboardInterrupt:
                 print("\n👋 Happy coding!")
@@ -508,6 +481,8 @@ Provide actionable insights that would help a developer understand and improve t
                 break
             except Exception as e:
                 print(f"❌ Error: {e}")
+        
+        await self.server.close()
 
 def main():
     """Entry point"""
@@ -0,0 +1,104 @@
+"""
+Tests for the content-addressed backup store and fs.undo
+"""
+
+import sys
+import shutil
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.backups import BackupStore
+from tools.files import FileTools
+
+
+class TestBackupStore(unittest.TestCase):
+    """Test deduplication, retention and undo"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_identical_content_is_stored_once(self):
+        """Test the same content in two paths shares one object"""
+        store = BackupStore(self.root / 'store')
+        for name in ('a/x.txt', 'b/x.txt'):
+            (self.root / name).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / name).write_text('same content')
+            store.save(name, self.root / name)
+        self.assertEqual(len(list((self.root / 'store' / 'objects').glob('*/*.gz'))), 1)
+        self.assertEqual(len(store.history('a/x.txt')), 1)
+        self.assertEqual(len(store.history('b/x.txt')), 1)
+
+    def test_retention_drops_old_versions_and_objects(self):
+        """Test only max_versions versions and their objects are kept"""
+        store = BackupStore(self.root / 'store', max_versions=3)
+        f = self.root / 'f.txt'
+        for i in range(6):
+            f.write_text(f'version {i}')
+            store.save('f.txt', f)
+        versions = store.history('f.txt')
+        self.assertEqual([v['seq'] for v in versions], [6, 5, 4])
+        self.assertEqual(store.load(versions[0]['hash']), b'version 5')
+        self.assertEqual(len(list((self.root / 'store' / 'objects').glob('*/*.gz'))), 3)
+
+    def test_trimming_keeps_objects_still_in_use(self):
+        """Test an object dropped from one journal survives while another path or a reopened store uses it"""
+        store = BackupStore(self.root / 'store', max_versions=1)
+        f, g = self.root / 'f.txt', self.root / 'g.txt'
+        f.write_text('shared')
+        g.write_text('shared')
+        store.save('f.txt', f)
+        store.save('g.txt', g)
+        f.write_text('f only')
+        store.save('f.txt', f)
+        shared = store.history('g.txt')[0]['hash']
+        self.assertEqual(store.load(shared), b'shared')
+
+        store = BackupStore(self.root / 'store', max_versions=1)
+        g.write_text('g only')
+        store.save('g.txt', g)
+        self.assertFalse(store._object_path(shared).exists())
+        self.assertEqual(len(list((self.root / 'store' / 'objects').glob('*/*.gz'))), 2)
+
+    def test_object_shared_with_another_process_survives(self):
+        """Test a store does not delete an object that another store on the same directory started using"""
+        f, g = self.root / 'f.txt', self.root / 'g.txt'
+        first = BackupStore(self.root / 'store', max_versions=1)
+        f.write_text('shared')
+        first.save('f.txt', f)
+        first._refcounts()  # counts built before the other store writes
+
+        g.write_text('shared')
+        BackupStore(self.root / 'store', max_versions=1).save('g.txt', g)
+
+        f.write_text('f only')
+        first.save('f.txt', f)
+        shared = first.history('g.txt')[0]['hash']
+        self.assertEqual(first.load(shared), b'shared')
+
+    def test_undo_restores_previous_version(self):
+        """Test fs.undo restores the last backup and can itself be undone"""
+        files = FileTools(str(self.root))
+
+        async def run():
+            await files.write_file({'path': 'f.txt', 'data': 'one'})
+            await files.write_file({'path': 'f.txt', 'data': 'two'})
+            await files.undo({'path': 'f.txt'})
+            self.assertEqual((self.root / 'f.txt').read_text(), 'one')
+            await files.undo({'path': 'f.txt'})
+            self.assertEqual((self.root / 'f.txt').read_text(), 'two')
+            history = await files.history({'path': 'f.txt'})
+            # Backups: 'one' before the second write, 'two' and 'one' before each undo
+            self.assertEqual([v['current'] for v in history['versions']], [False, True, False])
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
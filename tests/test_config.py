@@ -0,0 +1,84 @@
+"""
+Tests for config loading
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils import config
+from utils.config import DEFAULTS, load_config, section
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+@unittest.skipIf(yaml is None, 'needs pyyaml')
+class TestLoadConfig(unittest.TestCase):
+    """Test config file discovery and validation"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.home = Path(tempfile.mkdtemp())
+        env = {'XDG_CONFIG_HOME': str(self.home)}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        os.environ.pop('CODEAS_CONFIG', None)
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def write(self, path, text):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    def test_workspace_file_overrides_user_file(self):
+        """Test the user and .codeas files layer over DEFAULTS; a project's config/config.yaml is not read"""
+        self.write(self.home / 'ai-coder' / 'config.yaml', 'ai:\n  timeout: 5\n  max_tokens: 100\n')
+        self.write(self.root / '.codeas' / 'config.yaml', 'ai:\n  timeout: 7\n')
+        self.write(self.root / 'config' / 'config.yaml', 'ai:\n  timeout: 99\n')
+        cfg = load_config(self.root)
+        self.assertEqual((cfg['ai']['timeout'], cfg['ai']['max_tokens']), (7, 100))
+        self.assertEqual(cfg['ai']['api_url'], DEFAULTS['ai']['api_url'])
+
+    def test_foreign_schemas_are_ignored(self):
+        """Test a non-mapping file or section is skipped instead of breaking startup"""
+        self.write(self.home / 'ai-coder' / 'config.yaml', '- one\n- two\n')
+        self.write(self.root / '.codeas' / 'config.yaml', 'ai: openai\nshell:\n  timeout: 3\n')
+        with mock.patch('sys.stderr'):
+            cfg = load_config(self.root)
+        self.assertEqual(cfg['ai'], DEFAULTS['ai'])
+        self.assertEqual(cfg['shell']['timeout'], 3)
+
+    def test_section_fills_defaults(self):
+        """Test section() returns every default even for a partial config"""
+        self.assertEqual(section({'ai': {'cache': {'ttl': 5}}}, 'ai.cache'), dict(DEFAULTS['ai']['cache'], ttl=5))
+        self.assertEqual(section({'ai': 'openai'}, 'ai.scheduler'), DEFAULTS['ai']['scheduler'])
+
+    def test_default_yaml_matches_defaults(self):
+        """Test config/default.yaml documents the same values as DEFAULTS"""
+        with open(Path(config.__file__).resolve().parent.parent.parent / 'config' / 'default.yaml') as fh:
+            documented = yaml.safe_load(fh)
+
+        def check(expected, actual, prefix):
+            for key, value in expected.items():
+                self.assertIn(key, actual, f'{prefix}{key} missing from default.yaml')
+                if isinstance(value, dict):
+                    check(value, actual[key], f'{prefix}{key}.')
+                else:
+                    self.assertEqual(actual[key], value, f'{prefix}{key}')
+        check(DEFAULTS, documented, '')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Tests for prompt context packing
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.context import ContextBuilder, ContextFileCache, cut_to_tokens, estimate_tokens
+
+
+def make_module(functions):
+    return ''.join(f"def f{i}(x):\n    y = x * {i}\n    return y + {i}\n\n" for i in range(functions))
+
+
+class TestContextBuilder(unittest.TestCase):
+    """Test token budgeting"""
+
+    def test_cut_keeps_whole_functions(self):
+        """Test text is cut before a top-level definition, not mid-function"""
+        text, used = cut_to_tokens(make_module(50), 100)
+        self.assertLessEqual(used, 100)
+        self.assertEqual(used, estimate_tokens(text))
+        self.assertTrue(text.endswith('\n\n'))
+        self.assertTrue(text.startswith('def f0'))
+
+    def test_packs_by_priority_within_budget(self):
+        """Test required sections always fit and higher priorities are packed first"""
+        builder = ContextBuilder(max_context_length=700, max_tokens=300)
+        builder.add('low', make_module(40), header='--- low ---\n')
+        builder.add('high', make_module(10), header='--- high ---\n', priority=1)
+        builder.add('query', 'explain f1\n', required=True)
+        text, report = builder.build()
+        sections = {s['name']: s for s in report['sections']}
+        self.assertLessEqual(report['used'], report['budget'])
+        self.assertEqual(report['used'], sum(s['tokens'] for s in report['sections']))
+        self.assertFalse(sections['high']['truncated'])
+        self.assertTrue(sections['low']['truncated'])
+        self.assertLess(text.index('--- low ---'), text.index('--- high ---'))
+        self.assertTrue(text.endswith('explain f1\n'))
+        self.assertEqual(builder.options, {'num_ctx': 700, 'num_predict': 300})
+
+    def test_whole_sections_are_placed_before_any_cut(self):
+        """Test a big section is cut only after smaller ones that fit whole, and cut ones share the rest"""
+        small = make_module(3)
+        builder = ContextBuilder(max_context_length=1000, max_tokens=200, reserve=100)
+        builder.add('big1', make_module(60), priority=2)
+        builder.add('big2', make_module(60), priority=1)
+        builder.add('small', small)
+        builder.add('system', 'be brief\n', required=True)
+        text, report = builder.build()
+        sections = {s['name']: s for s in report['sections']}
+        self.assertEqual(report['budget'], 700)
+        self.assertLessEqual(report['used'], report['budget'])
+        self.assertEqual(sections['small']['tokens'], estimate_tokens(small))
+        self.assertFalse(sections['small']['truncated'])
+        self.assertTrue(sections['big1']['truncated'] and sections['big2']['truncated'])
+        self.assertLess(abs(sections['big1']['tokens'] - sections['big2']['tokens']), 40)
+
+    def test_capped_sections_do_not_move_when_others_change(self):
+        """Test with fixed shares a section's text stays the same when another section grows or shrinks"""
+        def build(other):
+            builder = ContextBuilder(max_context_length=900, max_tokens=300)
+            builder.add('a', make_module(40), header='--- a ---\n', max_tokens=300)
+            builder.add('b', other, header='--- b ---\n', max_tokens=300)
+            text, report = builder.build()
+            return text[:text.index('--- b ---')], report
+
+        first, report = build(make_module(2))
+        self.assertTrue(report['sections'][0]['truncated'])
+        self.assertLessEqual(report['sections'][0]['tokens'], 300)
+        for other in ('', make_module(5), make_module(80)):
+            self.assertEqual(build(other)[0], first)
+
+
+class TestContextFileCache(unittest.TestCase):
+    """Test the stat-validated context file cache"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, name, text, mtime_ns):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as fh:
+            fh.write(text)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_reuses_unchanged_files_and_evicts_lru(self):
+        """Test hits while (mtime, size) match, rereads on change and drops the oldest over max_bytes"""
+        cache = ContextFileCache(self.root, max_bytes=20)
+        self.write('a.py', 'a = 1\n', 10**18)
+        self.write('b.py', 'b = 2\n', 10**18)
+        first = cache.read('a.py')
+        self.assertIs(cache.read('a.py'), first)
+        self.assertEqual(first['tokens'], estimate_tokens('a = 1\n'))
+        self.write('a.py', 'a = 2\n', 10**18 + 1)
+        self.assertEqual(cache.read('a.py')['data'], 'a = 2\n')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache.read('b.py')
+        self.write('c.py', 'c = 3\nc += 1\n', 10**18)
+        cache.read('c.py')
+        self.assertEqual(list(cache._entries), ['b.py', 'c.py'])
+        items = cache.read_many(['b.py', 'missing.py'], max_chars=3)
+        self.assertEqual((items[0]['data'], items[0]['truncated']), ('', True))
+        self.assertIn('error', items[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
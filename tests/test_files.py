@@ -0,0 +1,290 @@
+"""
+Tests for FileTools
+"""
+
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from tools.files import FileTools
+from utils import fsx
+from utils.fsx import read_head
+
+
+class TestFileToolsIO(unittest.TestCase):
+    """Test blocking file work stays off the event loop"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.files = FileTools(str(self.root), max_file_size=64 * 1024 * 1024, backup_on_edit=False)
+
+    def tearDown(self):
+        self.files.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_loop_latency_flat_during_heavy_io(self):
+        """Test a ticking task keeps its pace while large files are written, read and deleted"""
+        tree = self.root / 'tree'
+        for i in range(40):
+            (tree / f'd{i}').mkdir(parents=True)
+            for j in range(100):
+                (tree / f'd{i}' / f'f{j}.txt').write_text('x')
+        data = 'y' * (48 * 1024 * 1024)
+
+        async def ticker(stop, gaps):
+            last = time.perf_counter()
+            while not stop.is_set():
+                await asyncio.sleep(0.005)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        async def run():
+            stop, gaps = asyncio.Event(), []
+            tick = asyncio.create_task(ticker(stop, gaps))
+            await asyncio.sleep(0.05)
+            await self.files.write_file({'path': 'big.txt', 'data': data})
+            result = await self.files.read_file({'path': 'big.txt'})
+            await self.files.delete_path({'path': 'tree'})
+            stop.set()
+            await tick
+            return result, gaps
+
+        result, gaps = asyncio.run(run())
+        self.assertEqual(len(result['data']), len(data))
+        self.assertFalse(tree.exists())
+        self.assertLess(max(gaps), 0.1, f'event loop stalled for {max(gaps) * 1000:.0f}ms')
+
+    def test_parallel_edits_of_one_file_all_land(self):
+        """Test concurrent read-modify-write calls on the same file do not lose each other's changes"""
+        (self.root / 'f.txt').write_text(''.join(f'line {i}\n' for i in range(8)))
+
+        async def run():
+            await asyncio.gather(
+                *[self.files.edit_file({'path': 'f.txt', 'search': f'line {i}\n', 'replace': f'done {i}\n'})
+                  for i in range(4)],
+                *[self.files.patch({'path': 'f.txt', 'edits': [{'start_line': i + 1, 'end_line': i + 1,
+                                                                'text': f'done {i}\n'}]})
+                  for i in range(4, 8)])
+
+        asyncio.run(run())
+        self.assertEqual((self.root / 'f.txt').read_text(), ''.join(f'done {i}\n' for i in range(8)))
+
+
+class TestReadRange(unittest.TestCase):
+    """Test fs.read byte and line ranges"""
+
+    TEXT = 'a\u00e9\u20ac\U0001f600b\n'  # 1, 2, 3 and 4 byte characters
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.files = FileTools(str(self.root), backup_on_edit=False)
+
+    def tearDown(self):
+        self.files.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read(self, **input_obj):
+        return asyncio.run(self.files.read_file(dict(input_obj, path='f.txt')))
+
+    def test_offsets_snap_to_utf8_boundaries(self):
+        """Test a range starting or ending inside a character is shrunk to whole characters"""
+        for text in (self.TEXT, self.TEXT * 100000):  # the second one is read through mmap
+            (self.root / 'f.txt').write_text(text, encoding='utf8')
+            res = self.read(offset=2, length=7)  # starts inside the 2-byte char, ends inside the 4-byte one
+            self.assertEqual(res['data'], '\u20ac')
+            self.assertEqual((res['offset'], res['length']), (3, 3))
+            self.assertFalse(res['eof'])
+        (self.root / 'f.txt').write_text(self.TEXT, encoding='utf8')
+        self.assertEqual(self.read(offset=6, length=100)['data'], '\U0001f600b\n')
+        res = self.read(offset=7, length=2)
+        self.assertEqual((res['data'], res['length']), ('', 0))
+        res = self.read(offset=100)
+        self.assertEqual((res['data'], res['offset'], res['eof']), ('', 12, True))
+
+    def test_stream_chunks_never_split_characters(self):
+        """Test every streamed chunk decodes on its own and together they are the range"""
+        (self.root / 'f.txt').write_text(self.TEXT * 50, encoding='utf8')
+        chunks = []
+        async def run():
+            return await self.files.read_file({'path': 'f.txt', 'offset': 1, 'stream': True, 'chunk_size': 5},
+                                              progress_cb=chunks.append)
+        res = asyncio.run(run())
+        self.assertEqual(res['chunks'], len(chunks))
+        self.assertEqual(''.join(c['chunk'] for c in chunks), (self.TEXT * 50)[1:])
+        self.assertEqual([c['seq'] for c in chunks], list(range(len(chunks))))
+
+    def test_line_range_edges(self):
+        """Test line ranges are 1-based and inclusive and clamp at the file's ends"""
+        (self.root / 'f.txt').write_text('one\ntwo\nthree')
+        self.assertEqual(self.read(start_line=2, end_line=2)['data'], 'two\n')
+        self.assertEqual(self.read(start_line=0, end_line=1)['data'], 'one\n')
+        self.assertEqual(self.read(start_line=3)['data'], 'three')
+        self.assertEqual(self.read(end_line=10)['data'], 'one\ntwo\nthree')
+        self.assertEqual(self.read(start_line=2, end_line=1)['data'], '')
+        res = self.read(start_line=5)
+        self.assertEqual((res['data'], res['offset'], res['eof']), ('', 13, True))
+        res = self.read(start_line=2, end_line=2)
+        self.assertEqual((res['offset'], res['length'], res['eof']), (4, 4, False))
+
+
+class TestReadHead(unittest.TestCase):
+    """Test reading just the start of a file"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.path = self.root / 'f.txt'
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_budgets_never_split_a_character(self):
+        """Test byte and character budgets stop on whole characters and report truncation"""
+        self.path.write_text('\u20ac\u20ac\u00e9', encoding='utf8')  # 3 + 3 + 2 bytes
+        self.assertEqual(read_head(self.path, max_bytes=4), ('\u20ac', True))
+        self.assertEqual(read_head(self.path, max_bytes=6), ('\u20ac\u20ac', True))
+        self.assertEqual(read_head(self.path, max_bytes=8), ('\u20ac\u20ac\u00e9', False))
+        self.assertEqual(read_head(self.path, max_chars=2), ('\u20ac\u20ac', True))
+        self.assertEqual(read_head(self.path, max_chars=3), ('\u20ac\u20ac\u00e9', False))
+        self.assertEqual(read_head(self.path, max_chars=3, max_bytes=7), ('\u20ac\u20ac', True))
+
+    def test_only_the_prefix_is_read(self):
+        """Test the file is read up to the budget plus one byte, not in full"""
+        self.path.write_bytes(b'x' * (1024 * 1024))
+        sizes = []
+        real_open = open
+
+        class Spy:
+            def __init__(self, *args, **kwargs):
+                self.fh = real_open(*args, **kwargs)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self.fh.close()
+
+            def read(self, n=-1):
+                sizes.append(n)
+                return self.fh.read(n)
+
+        with mock.patch.object(fsx, 'open', Spy, create=True):
+            text, truncated = read_head(self.path, max_chars=10)
+        self.assertEqual((text, truncated), ('x' * 10, True))
+        self.assertEqual(sizes, [41])
+
+    def test_head_tool(self):
+        """Test fs.head applies its budgets and defaults to the first 64KB"""
+        self.path.write_text('\u00e9' * 40000, encoding='utf8')
+        files = FileTools(str(self.root), backup_on_edit=False)
+        try:
+            small = asyncio.run(files.head({'path': 'f.txt', 'max_bytes': 5}))
+            default = asyncio.run(files.head({'path': 'f.txt'}))
+        finally:
+            files.close()
+        self.assertEqual((small['data'], small['truncated']), ('\u00e9\u00e9', True))
+        self.assertEqual((len(default['data']), default['truncated']), (32 * 1024, True))
+
+
+class TestReadMany(unittest.TestCase):
+    """Test batched reads"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.files = FileTools(str(self.root), backup_on_edit=False)
+        (self.root / 'a.txt').write_text('a' * 100)
+        (self.root / 'b.txt').write_text('b' * 100)
+
+    def tearDown(self):
+        self.files.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def read_many(self, input_obj):
+        frames = []
+        async def run():
+            return await self.files.read_many(input_obj, progress_cb=frames.append)
+        return asyncio.run(run()), frames
+
+    def test_per_file_budgets_override_the_default(self):
+        """Test a path's own max_chars wins over the top-level one"""
+        res, _ = self.read_many({'paths': ['a.txt', {'path': 'b.txt', 'max_chars': 5}], 'max_chars': 10})
+        self.assertEqual([(f['data'], f['truncated']) for f in res['files']], [('a' * 10, True), ('bbbbb', True)])
+        res, _ = self.read_many({'paths': ['a.txt']})
+        self.assertEqual(res['files'][0]['data'], 'a' * 100)
+
+    def test_bad_entries_do_not_fail_the_batch(self):
+        """Test missing files and malformed entries get an error entry each"""
+        res, frames = self.read_many({'paths': ['a.txt', 'missing.txt', {'max_chars': 3}, 7, {'path': None},
+                                                '../escape.txt']})
+        self.assertEqual((res['count'], res['errors']), (6, 5))
+        self.assertEqual(res['files'][0]['data'], 'a' * 100)
+        self.assertTrue(all('error' in f for f in res['files'][1:]))
+        self.assertEqual([f['path'] for f in res['files']], ['a.txt', 'missing.txt', None, 7, None, '../escape.txt'])
+        self.assertEqual(sorted(f['done'] for f in frames), list(range(1, 7)))
+
+    def test_stream_sends_each_file_as_a_frame(self):
+        """Test with stream every file arrives as a progress frame and the result only counts them"""
+        res, frames = self.read_many({'paths': ['a.txt', 'b.txt', 'missing.txt'], 'max_chars': 2, 'stream': True})
+        self.assertEqual(res, {'count': 3, 'errors': 1})
+        by_path = {f['path']: f for f in frames}
+        self.assertEqual(sorted(by_path), ['a.txt', 'b.txt', 'missing.txt'])
+        self.assertEqual(by_path['a.txt']['data'], 'aa')
+        self.assertIn('error', by_path['missing.txt'])
+
+
+class TestSearch(unittest.TestCase):
+    """Test fs.search results and the files it looks at"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.files = FileTools(str(self.root), ignore_patterns=['build', '*.min.js'], backup_on_edit=False)
+
+    def tearDown(self):
+        self.files.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_matches_report_path_line_and_column(self):
+        """Test each hit carries its path, 1-based line and column, and the line text"""
+        (self.root / 'pkg').mkdir()
+        (self.root / 'pkg' / 'mod.py').write_text('import os\n\ndef alpha():\n    return beta()\n')
+        (self.root / 'main.py').write_text('x = 1\n  y = beta\n')
+        result = asyncio.run(self.files.search({'pattern': r'beta'}))
+        self.assertEqual(result['matches'], 2)
+        self.assertEqual(result['results'], [
+            {'path': 'main.py', 'matches': [{'line': 2, 'column': 7, 'text': '  y = beta'}]},
+            {'path': 'pkg/mod.py', 'matches': [{'line': 4, 'column': 12, 'text': '    return beta()'}]},
+        ])
+
+    def test_ignored_and_binary_files_are_skipped(self):
+        """Test ignore patterns, our own state directories and binary files are never searched"""
+        (self.root / 'build').mkdir()
+        (self.root / 'build' / 'out.py').write_text('needle\n')
+        (self.root / 'app.min.js').write_text('needle\n')
+        (self.root / '.codeas_backups').mkdir()
+        (self.root / '.codeas_backups' / 'blob').write_text('needle\n')
+        (self.root / 'data.bin').write_bytes(b'\0needle\n')
+        (self.root / 'src.py').write_text('a\nneedle\n')
+        result = asyncio.run(self.files.search({'pattern': 'needle', 'literal': True}))
+        self.assertEqual([h['path'] for h in result['results']], ['src.py'])
+        self.assertEqual(result['results'][0]['matches'][0]['line'], 2)
+
+    def test_large_search_uses_worker_processes(self):
+        """Test a search past the inline size runs in the process pool and finds every hit"""
+        for i in range(12):
+            (self.root / f'big{i:02d}.txt').write_text(('filler line\n' * 10000) + f'needle {i}\n')
+        result = asyncio.run(self.files.search({'pattern': r'needle \d+'}))
+        self.assertIsNotNone(self.files._search_pool)
+        self.assertEqual(result['matches'], 12)
+        self.assertEqual([h['path'] for h in result['results']], [f'big{i:02d}.txt' for i in range(12)])
+        self.assertEqual(result['results'][3]['matches'][0]['line'], 10001)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+Tests for the workspace index
+"""
+
+import os
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from tools.files import FileTools
+from utils.index import WorkspaceIndex, content_hash
+
+
+class TestWorkspaceIndex(unittest.TestCase):
+    """Test index building, persistence and invalidation"""
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.index_path = self.root / '.codeas-history' / 'index.json'
+        (self.root / 'src').mkdir()
+        (self.root / 'src' / 'app.py').write_text('print(1)\n')
+        (self.root / 'README.md').write_text('readme\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make_index(self, **kwargs):
+        return WorkspaceIndex(self.root, index_path=self.index_path, **kwargs)
+
+    def test_index_files_writes_index_json(self):
+        """Test fs.index lists the tree and persists it for the next run"""
+        files = FileTools(str(self.root), index_path=str(self.index_path), backup_on_edit=False)
+        try:
+            result = asyncio.run(files.index_files({}))
+        finally:
+            files.close()
+        self.assertEqual([e['path'] for e in result['entries']], ['README.md', 'src', 'src/app.py'])
+        app = next(e for e in result['entries'] if e['path'] == 'src/app.py')
+        self.assertEqual(app['hash'], content_hash(self.root / 'src' / 'app.py'))
+
+        data = json.loads(self.index_path.read_text())
+        self.assertEqual(data['root'], str(self.root.resolve()))
+        self.assertEqual(sorted(data['entries']), ['README.md', 'src', 'src/app.py'])
+        self.assertEqual(data['dirs']['src']['children'], ['app.py'])
+
+    def test_entries_are_validated_by_mtime_and_size(self):
+        """Test a reloaded index reuses entries whose (mtime, size) match and rehashes the rest"""
+        self.make_index().refresh()
+        app = self.root / 'src' / 'app.py'
+        st = app.stat()
+        old_hash = content_hash(app)
+
+        # Same size and mtime: the stored entry (and its hash) are trusted.
+        app.write_text('print(2)\n')
+        os.utime(app, ns=(st.st_atime_ns, st.st_mtime_ns))
+        index = self.make_index()
+        index.refresh(full=True)
+        self.assertEqual(index.entries['src/app.py']['hash'], old_hash)
+
+        # A new size invalidates the entry, even without a directory mtime change.
+        app.write_text('print(22)\n')
+        os.utime(app, ns=(st.st_atime_ns, st.st_mtime_ns))
+        index = self.make_index()
+        index.refresh(full=True)
+        self.assertEqual(index.entries['src/app.py']['size'], 10)
+        self.assertEqual(index.entries['src/app.py']['hash'], content_hash(app))
+
+        # touch() picks up an in-place rewrite that refresh() without full would miss.
+        app.write_text('print(33)\n')
+        os.utime(app, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        index.touch(app)
+        self.assertEqual(index.entries['src/app.py']['hash'], content_hash(app))
+
+    def test_removed_and_added_files_follow_directory_mtime(self):
+        """Test a changed directory is rescanned and deleted children are forgotten"""
+        index = self.make_index()
+        index.refresh()
+        (self.root / 'src' / 'app.py').unlink()
+        (self.root / 'src' / 'new.py').write_text('x\n')
+        os.utime(self.root / 'src', ns=(0, index.dirs['src']['mtime_ns'] + 10 ** 9))
+        index.refresh()
+        self.assertEqual([e['path'] for e in index.list('src')], ['src/new.py'])
+
+    def test_ignore_patterns(self):
+        """Test names, relative paths and our own state directories are left out"""
+        (self.root / 'node_modules' / 'pkg').mkdir(parents=True)
+        (self.root / 'node_modules' / 'pkg' / 'index.js').write_text('x')
+        (self.root / 'src' / 'app.pyc').write_text('x')
+        (self.root / 'src' / 'gen').mkdir()
+        (self.root / 'src' / 'gen' / 'out.py').write_text('x')
+        (self.root / '.codeas_backups').mkdir()
+        (self.root / '.codeas_backups' / 'blob').write_text('x')
+
+        index = self.make_index(ignore_patterns=['node_modules', '*.pyc', 'src/gen'])
+        index.refresh()
+        self.assertEqual([e['path'] for e in index.list()], ['README.md', 'src', 'src/app.py'])
+        self.assertNotIn('.codeas-history', index.entries)
+        index.touch(self.root / 'src' / 'app.pyc')
+        self.assertNotIn('src/app.pyc', index.entries)
+
+    def test_missing_directory_raises(self):
+        """Test listing or indexing a directory that does not exist raises like the filesystem does"""
+        files = FileTools(str(self.root), index_path=str(self.index_path), backup_on_edit=False)
+        try:
+            with self.assertRaises(FileNotFoundError):
+                asyncio.run(files.list_dir({'dir': 'nope'}))
+            with self.assertRaises(FileNotFoundError):
+                asyncio.run(files.index_files({'dir': 'src/nope'}))
+            # A directory that disappears is forgotten once it is asked for again.
+            self.assertEqual(len(asyncio.run(files.list_dir({'dir': 'src'}))), 1)
+            shutil.rmtree(self.root / 'src')
+            with self.assertRaises(FileNotFoundError):
+                asyncio.run(files.list_dir({'dir': 'src'}))
+            self.assertNotIn('src/app.py', files.index.entries)
+        finally:
+            files.close()
+
+    def test_configured_state_directories_are_ignored(self):
+        """Test history and backup directories are left out under their configured names"""
+        cfg = {'workspace': {'history_dir': 'state/history', 'backup_directory': '.bak'}}
+        (self.root / 'state' / 'history').mkdir(parents=True)
+        (self.root / 'state' / 'history' / 'x.log').write_text('x')
+        (self.root / '.bak').mkdir()
+        (self.root / '.bak' / 'blob').write_text('x')
+        files = FileTools.from_config(str(self.root), cfg)
+        try:
+            result = asyncio.run(files.index_files({}))
+        finally:
+            files.close()
+        self.assertEqual([e['path'] for e in result['entries']], ['README.md', 'src', 'src/app.py', 'state'])
+
+
+if __name__ == "__main__":
+    unittest.main()
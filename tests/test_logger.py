@@ -0,0 +1,56 @@
+"""
+Tests for the history logger
+"""
+
+import sys
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.logger import HistoryLogger, list_segments
+
+
+class TestHistoryLogger(unittest.TestCase):
+    """Test buffered writing, rotation and retention"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_flush_writes_all_lines(self):
+        """Test queued lines reach the active segment"""
+        logger = HistoryLogger(self.temp_dir, flush_interval=10)
+        for i in range(100):
+            logger.append('progress', {'n': i})
+        self.assertTrue(logger.flush(timeout=5))
+        events = list(logger.iter_events())
+        logger.close()
+        self.assertEqual([e['payload']['n'] for e in events], list(range(100)))
+
+    def test_rotation_compression_and_pruning(self):
+        """Test sealed segments are compressed, pruned and still readable"""
+        Path(self.temp_dir, '2020-01-01.log').write_text('{"event": "old"}\n')
+        logger = HistoryLogger(self.temp_dir, flush_bytes=1, max_bytes=200, max_files=3)
+        for i in range(50):
+            logger.append('progress', {'n': i})
+            logger.flush()
+        logger.close()
+
+        names = [p.name for p in list_segments(self.temp_dir)]
+        self.assertEqual(len(names), 3)
+        self.assertFalse(any(n.startswith('2020-01-01') for n in names))
+        self.assertTrue(all(n.endswith('.gz') for n in names[:-1]))
+
+        reader = HistoryLogger(self.temp_dir, max_files=3)
+        events = list(reader.iter_events())
+        reader.close()
+        self.assertEqual(events[-1]['payload']['n'], 49)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for the Ollama client helpers
+"""
+
+import sys
+import json
+import asyncio
+import time
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from tools.ollama import NDJSONDecoder, OllamaClient
+from utils.cache import ResponseCache
+
+
+class TestNDJSONDecoder(unittest.TestCase):
+    """Test incremental stream decoding"""
+
+    def test_objects_split_across_chunks(self):
+        """Test objects split at arbitrary byte offsets decode intact"""
+        objs = [{'message': {'content': 'héllo'}}, {'message': {'content': ' wörld'}}, {'done': True}]
+        data = b''.join(json.dumps(o, ensure_ascii=False).encode('utf8') + b'\n' for o in objs)
+        decoder = NDJSONDecoder()
+        out = []
+        for i in range(0, len(data), 3):
+            out.extend(decoder.feed(data[i:i + 3]))
+        out.extend(decoder.close())
+        self.assertEqual(out, objs)
+
+    def test_trailing_line_and_invalid_json(self):
+        """Test a final unterminated line is flushed and junk comes back as text"""
+        decoder = NDJSONDecoder()
+        self.assertEqual(decoder.feed(b'not json\n{"a": 1}'), ['not json'])
+        self.assertEqual(decoder.close(), [{'a': 1}])
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test the two-tier response cache"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_disk_tier_survives_new_instance(self):
+        """Test entries written by one cache are read back from disk by another"""
+        body = {'model': 'm', 'messages': [{'role': 'user', 'content': 'hi'}]}
+        key = ResponseCache.key(body)
+        ResponseCache(self.temp_dir).put(key, ['a', 'b'], {'content': 'ab'})
+        entry = ResponseCache(self.temp_dir).get(key)
+        self.assertEqual(entry['tokens'], ['a', 'b'])
+        self.assertNotEqual(key, ResponseCache.key(dict(body, options={'temperature': 0.5})))
+
+    def test_ttl_and_size_eviction(self):
+        """Test expired entries miss and the disk tier stays under max_bytes"""
+        cache = ResponseCache(self.temp_dir, memory_entries=1, max_bytes=2000, ttl=60)
+        for i in range(20):
+            cache.put(f'{i:064x}', ['x' * 500 + str(i)], {})
+        total = sum(p.stat().st_size for p in Path(self.temp_dir).glob('*/*.json.gz'))
+        self.assertLessEqual(total, 2000)
+        self.assertIsNotNone(cache.get(f'{19:064x}'))
+        cache.ttl = 0.001
+        time.sleep(0.01)
+        self.assertIsNone(cache.get(f'{19:064x}'))
+
+
+class TestChatSessions(unittest.TestCase):
+    """Test server-side conversation sessions"""
+
+    def test_session_replays_turns_after_system_prompt(self):
+        """Test each turn is sent after the earlier ones and old turns are evicted in a batch"""
+        client = OllamaClient(session_budget=60)
+        sent = []
+
+        async def generate(body, progress_cb, priority='interactive'):
+            sent.append(body['messages'])
+            return {'ok': True, 'content': f"answer {len(sent)}"}
+        client._generate = generate
+
+        async def run():
+            results = []
+            for i in range(6):
+                results.append(await client.chat({'prompt': f'question {i} ' + 'word ' * 5,
+                                                  'system': 'be brief', 'session': 's'}))
+            return results
+
+        results = asyncio.run(run())
+        self.assertEqual([m['role'] for m in sent[1]], ['system', 'user', 'assistant', 'user'])
+        self.assertEqual(sent[1][:3], sent[2][:3])
+        self.assertEqual(sent[1][2]['content'], 'answer 1')
+        self.assertEqual(results[0]['turns'], 2)
+        self.assertLess(results[-1]['turns'], 12)
+        self.assertEqual(sent[-1][0], {'role': 'system', 'content': 'be brief'})
+        self.assertEqual(sent[-1][1]['role'], 'user')
+
+
+if __name__ == '__main__':
+    unittest.main()
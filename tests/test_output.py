@@ -0,0 +1,125 @@
+"""
+Tests for server output framing
+"""
+
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.output import Coalescer, FrameWriter
+
+
+class TestCoalescer(unittest.TestCase):
+    """Test token coalescing"""
+
+    def run_pushes(self, coalescer, payloads, wait=0.0):
+        async def run():
+            for payload in payloads:
+                coalescer.push(payload)
+            await asyncio.sleep(wait)
+        asyncio.run(run())
+
+    def test_tokens_merge_within_window(self):
+        """Test tokens inside one window go out as one frame once it ends"""
+        out = []
+        self.run_pushes(Coalescer(out.append, window_ms=20), [{'message': t} for t in 'abc'], wait=0.1)
+        self.assertEqual(out, [{'message': 'abc'}])
+
+    def test_flush_at_max_bytes(self):
+        """Test a frame is sent as soon as max_bytes of tokens are held"""
+        out = []
+        self.run_pushes(Coalescer(out.append, window_ms=10000, max_bytes=4), [{'message': t} for t in 'abcdef'])
+        self.assertEqual(out, [{'message': 'abcd'}])
+
+    def test_other_payloads_keep_their_place(self):
+        """Test a non-token payload flushes held tokens first and passes through unchanged"""
+        out = []
+        coalescer = Coalescer(out.append, window_ms=10000)
+        self.run_pushes(coalescer, [{'message': 'a'}, {'message': 'b'}, {'queued': 1},
+                                    {'message': 'c'}, {'message': 1}])
+        coalescer.flush()
+        self.assertEqual(out, [{'message': 'ab'}, {'queued': 1}, {'message': 'c'}, {'message': 1}])
+
+
+def progress(payload, id_='1'):
+    return {'id': id_, 'type': 'progress', 'payload': payload}
+
+
+class TestFrameWriter(unittest.TestCase):
+    """Test the output queue's overflow policies"""
+
+    def run_writer(self, overflow, frames):
+        """Offer frames to a stopped writer with room for one, then drain it.
+
+        Returns whether a progress producer was held before draining, the
+        writer, and the frames that reached the stream.
+        """
+        async def run(out):
+            writer = FrameWriter(stream=out, max_frames=1, overflow=overflow)
+            for frame in frames:
+                writer.offer(frame)
+            held = not await self.settles(writer.wait_progress())
+            await writer.start()
+            self.assertTrue(await self.settles(writer.wait_progress()))
+            await writer.close()
+            return held, writer
+        with tempfile.TemporaryFile('w+') as out:
+            held, writer = asyncio.run(run(out))
+            out.seek(0)
+            return held, writer, [json.loads(line) for line in out]
+
+    async def settles(self, aw):
+        try:
+            await asyncio.wait_for(aw, 0.2)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def test_merge_folds_tokens_and_holds_unmergeable_overflow(self):
+        """Test merge folds tokens into the queued frame and holds producers only past max_frames"""
+        held, writer, sent = self.run_writer('merge', [progress({'message': 'a'}), progress({'message': 'b'})])
+        self.assertFalse(held)
+        self.assertEqual(writer.merged, 1)
+        self.assertEqual(sent, [progress({'message': 'ab'})])
+
+        held, writer, sent = self.run_writer('merge', [progress({'message': 'a'}), progress({'done': 1})])
+        self.assertTrue(held)
+        self.assertEqual(sent, [progress({'message': 'a'}), progress({'done': 1})])
+
+    def test_drop_never_holds(self):
+        """Test drop discards overflowing progress frames but keeps results"""
+        result = {'id': '1', 'type': 'result', 'payload': {}}
+        held, writer, sent = self.run_writer('drop', [progress({'done': 1}), progress({'done': 2}), result])
+        self.assertFalse(held)
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(sent, [progress({'done': 1}), result])
+
+    def test_block_holds_while_full(self):
+        """Test block keeps every frame and holds producers until the queue drains"""
+        frames = [progress({'message': 'a'}), progress({'message': 'b'})]
+        held, writer, sent = self.run_writer('block', frames)
+        self.assertTrue(held)
+        self.assertEqual(sent, frames)
+
+        held, _, _ = self.run_writer('block', frames[:1])
+        self.assertTrue(held)
+
+    def test_unserialisable_frame_raises_in_caller(self):
+        """Test a frame that cannot be encoded raises on offer/send and is not queued"""
+        async def run():
+            writer = FrameWriter(stream=sys.stdout)
+            with self.assertRaises(TypeError):
+                writer.offer(progress({'value': object()}))
+            with self.assertRaises(TypeError):
+                await writer.send({'id': '1', 'type': 'result', 'payload': {1, 2}})
+            return writer
+        self.assertFalse(asyncio.run(run())._queue)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Tests for server-side patch application
+"""
+
+import sys
+import difflib
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.patch import PatchConflict, apply_unified_diff, apply_line_edits, apply_replacements
+
+
+def make_diff(old, new):
+    return ''.join(difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True),
+                                        'a/f.py', 'b/f.py'))
+
+
+class TestUnifiedDiff(unittest.TestCase):
+    """Test applying unified diffs"""
+
+    def setUp(self):
+        self.old = ''.join(f'line {i}\n' for i in range(1, 41))
+        self.new = self.old.replace('line 5\n', 'line five\n').replace('line 30\n', 'line 30\nextra\n')
+
+    def test_applies_clean_diff(self):
+        """Test a diff made against the same text reproduces the new text"""
+        self.assertEqual(apply_unified_diff(self.old, make_diff(self.old, self.new)), self.new)
+
+    def test_hunks_follow_drifted_lines(self):
+        """Test hunks still apply after lines were inserted above them"""
+        drifted = 'header\nheader\n' + self.old
+        self.assertEqual(apply_unified_diff(drifted, make_diff(self.old, self.new)), 'header\nheader\n' + self.new)
+
+    def test_conflict_changes_nothing(self):
+        """Test a hunk whose context is gone raises PatchConflict"""
+        changed = self.old.replace('line 30\n', 'line thirty\n')
+        with self.assertRaises(PatchConflict):
+            apply_unified_diff(changed, make_diff(self.old, self.new))
+
+    def test_missing_trailing_newline(self):
+        """Test '\\ No newline at end of file' markers"""
+        old, new = 'a\nb', 'a\nc'
+        diff = ('--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n-b\n\\ No newline at end of file\n'
+                '+c\n\\ No newline at end of file\n')
+        self.assertEqual(apply_unified_diff(old, diff), new)
+
+    def test_multi_file_diff_is_rejected(self):
+        """Test hunks of a second file are never applied to the first"""
+        diff = ('--- a/x.py\n+++ b/x.py\n@@ -2 +2 @@\n-b\n+B\n'
+                '--- a/y.py\n+++ b/y.py\n@@ -4 +4 @@\n-d\n+D\n')
+        with self.assertRaisesRegex(ValueError, 'more than one file'):
+            apply_unified_diff('a\nb\nc\nd\n', diff)
+
+
+class TestLineEdits(unittest.TestCase):
+    """Test line-range replacements"""
+
+    def test_replace_insert_and_delete(self):
+        """Test edits use original line numbers regardless of order"""
+        text = 'a\nb\nc\nd\n'
+        edits = [{'start_line': 4, 'end_line': 4, 'text': ''},
+                 {'start_line': 1, 'end_line': 1, 'text': 'A'},
+                 {'start_line': 3, 'end_line': 2, 'text': 'x\ny\n'}]
+        self.assertEqual(apply_line_edits(text, edits), 'A\nb\nx\ny\nc\n')
+
+    def test_expect_and_overlap_conflicts(self):
+        """Test stale expectations and overlapping ranges are rejected"""
+        with self.assertRaises(PatchConflict):
+            apply_line_edits('a\nb\n', [{'start_line': 2, 'text': 'B', 'expect': 'x\n'}])
+        with self.assertRaises(PatchConflict):
+            apply_line_edits('a\nb\nc\n', [{'start_line': 1, 'end_line': 2, 'text': ''},
+                                           {'start_line': 2, 'end_line': 3, 'text': ''}])
+
+
+class TestReplacements(unittest.TestCase):
+    """Test batched search/replace edits"""
+
+    def test_literals_share_one_pass(self):
+        """Test literal edits match together, longest first, without seeing each other's output"""
+        text, counts = apply_replacements('foo foobar bar', [
+            {'search': 'foo', 'replace': 'bar'},
+            {'search': 'foobar', 'replace': 'X'},
+            {'search': 'bar', 'replace': 'foo'}])
+        self.assertEqual(text, 'bar X foo')
+        self.assertEqual(counts, [1, 1, 1])
+
+    def test_regex_and_limits(self):
+        """Test regex edits run in order after earlier literals and respect limits"""
+        text, counts = apply_replacements('a1 a2 a3 b', [
+            {'search': 'b', 'replace': 'a4'},
+            {'search': r'a(\d)', 'replace': r'n\1', 'regex': True, 'limit': 3},
+            {'search': 'a', 'replace': 'z', 'limit': 1}])
+        self.assertEqual(text, 'n1 n2 n3 z4')
+        self.assertEqual(counts, [1, 3, 1])
+
+    def test_shorter_literal_takes_over_after_limit(self):
+        """Test a shorter search matches where a longer one would have once that one hit its limit"""
+        text, counts = apply_replacements('foobar foobar foo', [
+            {'search': 'foobar', 'replace': 'X', 'limit': 1},
+            {'search': 'foo', 'replace': 'Y'}])
+        self.assertEqual(text, 'X Ybar Y')
+        self.assertEqual(counts, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
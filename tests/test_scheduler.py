@@ -0,0 +1,134 @@
+"""
+Tests for the model request scheduler
+"""
+
+import sys
+import asyncio
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from utils.scheduler import ModelScheduler, QueueFull
+
+
+class TestModelScheduler(unittest.TestCase):
+    """Test admission, ordering and cancellation"""
+
+    def test_per_model_limits(self):
+        """Test each model admits up to its own limit and queues the rest"""
+        sched = ModelScheduler(max_in_flight=1, per_model={'big': 2})
+
+        async def run():
+            await sched.acquire('big')
+            await sched.acquire('big')
+            await sched.acquire('small')
+            third = asyncio.ensure_future(sched.acquire('big'))
+            other = asyncio.ensure_future(sched.acquire('small'))
+            await asyncio.sleep(0)
+            waiting = (third.done(), other.done())
+            sched.release('big')
+            await asyncio.sleep(0)
+            return waiting, third.done(), other.done()
+
+        self.assertEqual(asyncio.run(run()), ((False, False), True, False))
+
+    def test_interactive_before_batch(self):
+        """Test a later interactive request is admitted before an earlier batch one"""
+        sched = ModelScheduler()
+        order = []
+
+        async def job(name, priority):
+            await sched.acquire('m', priority)
+            order.append(name)
+            sched.release('m')
+
+        async def run():
+            await sched.acquire('m')
+            jobs = [asyncio.ensure_future(job('batch', 'batch')),
+                    asyncio.ensure_future(job('interactive', 'interactive'))]
+            await asyncio.sleep(0)
+            sched.release('m')
+            await asyncio.gather(*jobs)
+
+        asyncio.run(run())
+        self.assertEqual(order, ['interactive', 'batch'])
+
+    def test_queue_full(self):
+        """Test requests beyond max_queue waiting are rejected"""
+        sched = ModelScheduler(max_queue=1)
+
+        async def run():
+            await sched.acquire('m')
+            waiter = asyncio.ensure_future(sched.acquire('m'))
+            await asyncio.sleep(0)
+            try:
+                with self.assertRaises(QueueFull):
+                    await sched.acquire('m')
+            finally:
+                waiter.cancel()
+
+        asyncio.run(run())
+
+    def test_queue_position_updates(self):
+        """Test waiters hear their position and hear again when it changes"""
+        sched = ModelScheduler()
+        first, second = [], []
+
+        async def run():
+            await sched.acquire('m')
+            a = asyncio.ensure_future(sched.acquire('m', progress_cb=first.append))
+            await asyncio.sleep(0)
+            b = asyncio.ensure_future(sched.acquire('m', progress_cb=second.append))
+            await asyncio.sleep(0)
+            sched.release('m')
+            await a
+            sched.release('m')
+            await b
+
+        asyncio.run(run())
+        self.assertEqual(first, [{'queue': {'model': 'm', 'position': 1}}])
+        self.assertEqual(second, [{'queue': {'model': 'm', 'position': 2}},
+                                  {'queue': {'model': 'm', 'position': 1}}])
+
+    def test_cancel_while_queued_removes_waiter(self):
+        """Test a cancelled waiter leaves the queue and the next one moves up"""
+        sched = ModelScheduler()
+        second = []
+
+        async def run():
+            await sched.acquire('m')
+            a = asyncio.ensure_future(sched.acquire('m'))
+            await asyncio.sleep(0)
+            b = asyncio.ensure_future(sched.acquire('m', progress_cb=second.append))
+            await asyncio.sleep(0)
+            a.cancel()
+            await asyncio.gather(a, return_exceptions=True)
+            queued = len(sched._waiting['m'])
+            sched.release('m')
+            await b
+            return queued, sched._running['m']
+
+        self.assertEqual(asyncio.run(run()), (1, 1))
+        self.assertEqual(second[-1], {'queue': {'model': 'm', 'position': 1}})
+
+    def test_cancel_after_grant_releases_slot(self):
+        """Test a waiter cancelled just after being granted the slot gives it back"""
+        sched = ModelScheduler()
+
+        async def run():
+            await sched.acquire('m')
+            waiter = asyncio.ensure_future(sched.acquire('m'))
+            await asyncio.sleep(0)
+            sched.release('m')  # grants the slot to waiter...
+            waiter.cancel()     # ...which is cancelled before it resumes
+            await asyncio.gather(waiter, return_exceptions=True)
+            running = sched._running['m']
+            await asyncio.wait_for(sched.acquire('m'), 1)
+            return waiter.cancelled(), running
+
+        self.assertEqual(asyncio.run(run()), (True, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
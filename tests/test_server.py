@@ -0,0 +1,178 @@
+"""
+Tests for the stdio server protocol
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AI_CODER = Path(__file__).resolve().parent.parent / "ai_coder"
+sys.path.insert(0, str(AI_CODER))
+
+from client import MCPClient
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    """Streams a few chat tokens, a little apart, like /api/chat"""
+
+    tokens = ['Hel', 'lo', ' there']
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for token in self.tokens:
+            self.wfile.write(json.dumps({'message': {'content': token}}).encode() + b'\n')
+            self.wfile.flush()
+            time.sleep(0.01)
+        self.wfile.write(json.dumps({'done': True, 'eval_count': 3}).encode() + b'\n')
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs server.py against a temporary workspace and a fake Ollama"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), FakeOllama)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.env = dict(os.environ, CODEAS_ROOT=self.root, XDG_CONFIG_HOME=self.root,
+                        OLLAMA_URL=f'http://127.0.0.1:{self.http.server_port}')
+        self.env.pop('CODEAS_CONFIG', None)
+
+    def tearDown(self):
+        self.http.shutdown()
+        self.http.server_close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def exchange(self, lines, until):
+        """Send request lines and collect frames until every id in until has its result.
+        A number among lines pauses that many seconds before sending the rest."""
+        async def run():
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, str(AI_CODER / 'server.py'), cwd=str(AI_CODER), env=self.env,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            await proc.stdout.readline()  # ready
+            frames, pending = [], set(until)
+            try:
+                for item in lines:
+                    if isinstance(item, (int, float)):
+                        await asyncio.sleep(item)
+                    else:
+                        proc.stdin.write(json.dumps(item).encode() + b'\n')
+                while pending:
+                    frame = json.loads(await asyncio.wait_for(proc.stdout.readline(), 20))
+                    frames.append(frame)
+                    if frame.get('type') == 'result':
+                        pending.discard(frame.get('id'))
+            finally:
+                proc.stdin.close()
+                await proc.wait()
+            return frames
+        return asyncio.run(run())
+
+
+class TestCoalescing(ServerTestCase):
+    """Test opt-in token coalescing end to end"""
+
+    def test_held_tokens_flush_before_result(self):
+        """Test tokens still inside the window are sent before the result frame"""
+        frames = self.exchange([{'id': '1', 'tool': 'ollama.chat',
+                                 'input': {'prompt': 'hi', 'coalesce': {'window_ms': 10000}}}], ['1'])
+        self.assertEqual([f['type'] for f in frames], ['progress', 'result'])
+        self.assertEqual(frames[0]['payload'], {'message': 'Hello there'})
+        self.assertEqual(frames[1]['payload']['content'], 'Hello there')
+
+
+class TestBadRequests(ServerTestCase):
+    """Test malformed requests are answered instead of being lost"""
+
+    def test_non_object_input_gets_error_result(self):
+        """Test a request whose input is not an object still gets a result frame"""
+        frames = self.exchange([{'id': '1', 'tool': 'fs.list', 'input': None},
+                                {'id': '2', 'tool': 'fs.list', 'input': [1]}], ['1', '2'])
+        errors = {f['id']: f['error'] for f in frames}
+        self.assertEqual(errors, {'1': 'input must be a JSON object', '2': 'input must be a JSON object'})
+
+    def test_non_object_line_keeps_server_running(self):
+        """Test a JSON line that is not an object gets an error frame and later requests still run"""
+        frames = self.exchange([[1, 2], 'cancel', {'id': '1', 'tool': 'fs.list', 'input': {'dir': '.'}}], ['1'])
+        self.assertEqual([f['type'] for f in frames], ['error', 'error', 'result'])
+        self.assertEqual(frames[0], {'type': 'error', 'error': 'request must be a JSON object', 'raw': '[1, 2]'})
+        self.assertEqual(frames[2]['payload'], [])
+
+    def test_large_search_in_worker_processes(self):
+        """Test a search big enough for the process pool answers normally and workers write nothing"""
+        for i in range(12):
+            Path(self.root, f'big{i:02d}.txt').write_text(('filler line\n' * 10000) + f'needle {i}\n')
+        frames = self.exchange([{'id': '1', 'tool': 'fs.search', 'input': {'pattern': 'needle'}}], ['1'])
+        self.assertEqual(frames[-1]['payload']['matches'], 12)
+        self.assertTrue(all(f.get('id') == '1' for f in frames))
+
+
+@unittest.skipIf(sys.platform == 'win32', 'uses POSIX shell commands')
+class TestCancel(ServerTestCase):
+    """Test the cancel frame"""
+
+    def test_cancel_in_flight(self):
+        """Test cancelling a running call ends it with a cancelled result and kills its command"""
+        marker = os.path.join(self.root, 'finished')
+        start = time.monotonic()
+        frames = self.exchange([{'id': '1', 'tool': 'shell.run', 'input': {'cmd': f'sleep 1; touch {marker}'}},
+                                0.3, {'type': 'cancel', 'id': '1'}], ['1'])
+        self.assertEqual(frames[-1], {'id': '1', 'type': 'result', 'cancelled': True})
+        self.assertLess(time.monotonic() - start, 5)
+        time.sleep(1.2)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_cancel_before_start(self):
+        """Test a call cancelled before it ran still gets exactly one cancelled result"""
+        frames = self.exchange([{'id': '1', 'tool': 'shell.run', 'input': {'cmd': 'sleep 5'}},
+                                {'type': 'cancel', 'id': '1'},
+                                {'id': '2', 'tool': 'fs.list', 'input': {'dir': '.'}}], ['1', '2'])
+        results = [f for f in frames if f['type'] == 'result']
+        self.assertIn({'id': '1', 'type': 'result', 'cancelled': True}, results)
+        self.assertEqual(sorted(f['id'] for f in results), ['1', '2'])
+
+    def test_client_cancel_stops_server_call(self):
+        """Test cancelling MCPClient.call sends a cancel frame and the session stays usable"""
+        marker = os.path.join(self.root, 'finished')
+        client = MCPClient(AI_CODER / 'server.py', cwd=AI_CODER, env=self.env)
+
+        async def run():
+            call = asyncio.ensure_future(client.call('shell.run', {'cmd': f'sleep 1; touch {marker}'}))
+            await asyncio.sleep(0.5)
+            call.cancel()
+            await asyncio.gather(call, return_exceptions=True)
+            listing = await asyncio.wait_for(client.call('fs.list', {'dir': '.'}), 10)
+            await asyncio.sleep(1)
+            await client.close()
+            return call.cancelled(), listing
+
+        cancelled, listing = asyncio.run(run())
+        self.assertTrue(cancelled)
+        self.assertEqual(listing['type'], 'result')
+        self.assertFalse(os.path.exists(marker))
+
+    def test_cancel_unknown_id_is_ignored(self):
+        """Test cancelling an id that is not running changes nothing"""
+        frames = self.exchange([{'type': 'cancel', 'id': 'nope'},
+                                {'id': '1', 'tool': 'fs.list', 'input': {'dir': '.'}}], ['1'])
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]['payload'], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
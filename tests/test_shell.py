@@ -0,0 +1,120 @@
+"""
+Tests for the shell tool
+"""
+
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ai_coder"))
+
+from tools.shell import ShellTool
+
+
+@unittest.skipIf(sys.platform == 'win32', 'uses POSIX shell commands')
+class TestShellTool(unittest.TestCase):
+    """Test output capture and limits"""
+
+    def test_output_is_coalesced_with_bounded_tail(self):
+        """Test many lines arrive in few frames and the result keeps only the tail"""
+        frames = []
+        shell = ShellTool(tail_bytes=64)
+        result = asyncio.run(shell.run_cmd({'cmd': 'seq 1 100000'}, frames.append))
+        self.assertTrue(result['ok'])
+        self.assertLess(len(frames), 1000)
+        self.assertEqual(''.join(f['output'] for f in frames).split(), [str(i) for i in range(1, 100001)])
+        self.assertTrue(result['tail'].endswith('99999\n100000\n'))
+        self.assertLessEqual(len(result['tail']), 64)
+        self.assertTrue(result['tail_truncated'])
+
+    def test_timeout_kills_process_group(self):
+        """Test a timeout stops the command and its background children"""
+        shell = ShellTool()
+        start = time.monotonic()
+        result = asyncio.run(shell.run_cmd({'cmd': 'sleep 30 & sleep 30', 'timeout': 0.3}))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['killed'], 'timeout')
+
+    def test_max_output_bytes(self):
+        """Test a command printing without end is stopped at the output cap"""
+        result = asyncio.run(ShellTool().run_cmd({'cmd': 'yes', 'max_output_bytes': 100000}))
+        self.assertEqual(result['killed'], 'max_output_bytes')
+
+
+    def test_jobs_respect_concurrency_limit(self):
+        """Test background jobs queue beyond max_jobs and can be tailed and waited on"""
+        shell = ShellTool(max_jobs=1)
+
+        async def run():
+            first = await shell.start_job({'cmd': 'sleep 0.2; seq 1 5'})
+            second = await shell.start_job({'cmd': 'echo second'})
+            await asyncio.sleep(0.1)
+            states = [(await shell.job_status({'id': j['id']}))['state'] for j in (first, second)]
+            done = await shell.job_wait({'id': second['id'], 'timeout': 5})
+            tail = await shell.job_tail({'id': first['id'], 'since': 4})
+            return states, done, tail
+
+        states, done, tail = asyncio.run(run())
+        self.assertEqual(states, ['running', 'queued'])
+        self.assertEqual(done['state'], 'done')
+        self.assertEqual(done['tail'], 'second\n')
+        self.assertEqual(tail['data'], '3\n4\n5\n')
+        self.assertEqual(tail['offset'], 10)
+
+    def test_jobs_start_in_workspace_root(self):
+        """Test jobs run in the root by default and take a relative cwd from there"""
+        root = Path(tempfile.mkdtemp()).resolve()
+        self.addCleanup(shutil.rmtree, root, True)
+        (root / 'sub').mkdir()
+        shell = ShellTool(root=str(root))
+
+        async def run():
+            jobs = [await shell.start_job({'cmd': 'pwd'}), await shell.start_job({'cmd': 'pwd', 'cwd': 'sub'})]
+            return [(await shell.job_wait({'id': j['id'], 'timeout': 5}))['tail'] for j in jobs]
+
+        self.assertEqual(asyncio.run(run()), [f'{root}\n', f'{root / "sub"}\n'])
+
+    def test_session_keeps_shell_state(self):
+        """Test a session keeps cd/export between commands and separates streams and exit codes"""
+        shell = ShellTool(max_sessions=1)
+        frames = []
+
+        async def run():
+            first = await shell.session_cmd({'session': 's', 'cmd': 'cd / && export GREETING=hi'})
+            second = await shell.session_cmd({'session': 's', 'cmd': 'pwd; echo "$GREETING"; echo oops >&2; false'},
+                                             frames.append)
+            third = await shell.session_cmd({'session': 's', 'cmd': 'printf partial; exit 4'})
+            await shell.aclose()
+            return first, second, third
+
+        first, second, third = asyncio.run(run())
+        self.assertTrue(first['ok'])
+        self.assertEqual(second['code'], 1)
+        self.assertEqual(''.join(f['output'] for f in frames if f['stream'] == 'stdout'), '/\nhi\n')
+        self.assertEqual(''.join(f['output'] for f in frames if f['stream'] == 'stderr'), 'oops\n')
+        self.assertEqual((third['code'], third['tail'], third.get('closed')), (4, 'partial', True))
+        self.assertEqual(shell.sessions, {})
+
+    def test_session_starts_in_workspace_root(self):
+        """Test a new session's shell starts in the root unless given a cwd"""
+        root = Path(tempfile.mkdtemp()).resolve()
+        self.addCleanup(shutil.rmtree, root, True)
+        (root / 'sub').mkdir()
+        shell = ShellTool(root=str(root))
+
+        async def run():
+            tails = [(await shell.session_cmd({'session': 'a', 'cmd': 'pwd'}))['tail'],
+                     (await shell.session_cmd({'session': 'b', 'cmd': 'pwd', 'cwd': 'sub'}))['tail']]
+            await shell.aclose()
+            return tails
+
+        self.assertEqual(asyncio.run(run()), [f'{root}\n', f'{root / "sub"}\n'])
+
+
+if __name__ == "__main__":
+    unittest.main()